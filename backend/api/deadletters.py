@@ -1,20 +1,21 @@
 from fastapi import APIRouter, Body
-import json
-import os
-import redis
+import asyncio
 
+import async_clients
 from db import list_dead, get_dead_payloads_by_ids, delete_dead_by_ids
+import task_codec
 
 router = APIRouter(prefix="/api/deadletters", tags=["deadletters"])
-r = redis.Redis(host=os.getenv("REDIS_HOST"), decode_responses=True)
+
+# SQLite 调用放到线程里（db.py 按线程各持一个连接），Redis 走 redis.asyncio
 
 
 @router.get("")
-def api_list_deadletters():
+async def api_list_deadletters():
     """
     死信列表
     """
-    rows = list_dead(limit=200)
+    rows = await asyncio.to_thread(list_dead, limit=200)
 
     # 给前端更友好：补一个 content 预览字段
     # payload 结构与 worker 入队一致：{text, media, ...}
@@ -22,35 +23,38 @@ def api_list_deadletters():
         payload = item.get("payload") or {}
         item["content"] = (payload.get("text") or "")[:200]
         item["qq_channel_id"] = payload.get("qq_channel_id")
+        # fan-out 死信按频道拆分，targets 即本条失败的目标频道
+        item["targets"] = payload.get("targets") or []
         item["channel_name"] = payload.get("channel_name")
     return rows
 
 
 @router.post("/{dead_id}/retry")
-def api_retry_one(dead_id: int):
+async def api_retry_one(dead_id: int):
     """
     单条重放：把 payload 再次推入 Redis 队列，并从 dead 删除
     """
-    payloads = get_dead_payloads_by_ids([dead_id])
+    payloads = await asyncio.to_thread(get_dead_payloads_by_ids, [dead_id])
     if not payloads:
         return {"ok": False, "reason": "not_found"}
 
     payload = payloads[0]["payload"]
-    r.lpush("queue", json.dumps(payload, ensure_ascii=False))
-    delete_dead_by_ids([dead_id])
+    await async_clients.redis().lpush("queue", await asyncio.to_thread(task_codec.encode, payload))
+    await asyncio.to_thread(delete_dead_by_ids, [dead_id])
     return {"ok": True}
 
 
 @router.post("/retry")
-def api_retry_batch(ids: list[int] = Body(..., embed=True)):
+async def api_retry_batch(ids: list[int] = Body(..., embed=True)):
     """
     批量重放：ids = [1,2,3]
     """
-    payload_rows = get_dead_payloads_by_ids(ids)
-    for row in payload_rows:
-        payload = row["payload"]
-        r.lpush("queue", json.dumps(payload, ensure_ascii=False))
+    payload_rows = await asyncio.to_thread(get_dead_payloads_by_ids, ids)
+    # 编码会同步写 Redis 驻留模板，一并放到线程里
+    encoded = await asyncio.to_thread(lambda: [task_codec.encode(row["payload"]) for row in payload_rows])
+    if encoded:
+        await async_clients.redis().lpush("queue", *encoded)
 
     # 入队后删除死信（避免重复重放）
-    delete_dead_by_ids([r["id"] for r in payload_rows])
+    await asyncio.to_thread(delete_dead_by_ids, [r["id"] for r in payload_rows])
     return {"ok": True, "count": len(payload_rows)}
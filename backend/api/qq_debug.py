@@ -1,115 +1,70 @@
 from __future__ import annotations
 
-import os
-import requests
 from fastapi import APIRouter, HTTPException, Query
 
-from qq_auth import auth_headers
+from async_clients import TTLCache
 from config import get as cfg_get
+import qq_directory
+from qq_directory import DirectoryError
 
 router = APIRouter(prefix="/api/qq", tags=["qq"])
 
-BOT_API_BASE = str(cfg_get("qq.api_base", "https://api.sgroup.qq.com")).rstrip("/")
+# 进程内短缓存：连续刷新页面不再每次都读 Redis / 打 QQ API
+try:
+    DIRECTORY_CACHE_SECONDS = float(cfg_get("admin.directory_cache_seconds", 10))
+except Exception:
+    DIRECTORY_CACHE_SECONDS = 10.0
+
+_cache = TTLCache(DIRECTORY_CACHE_SECONDS)
+
+
+async def _channels(guild_id: str):
+    return await _cache.get(f"channels:{guild_id}", lambda: qq_directory.aget_channels(guild_id))
 
 
 @router.get("/guilds")
-def list_guilds():
+async def list_guilds():
     """列出机器人加入的所有频道（guilds）。
 
     用途：你只有邀请链接/pd 号时，通过这个接口找到真正的 guild_id（数字）。
+    读频道目录缓存；需要最新数据时先调 POST /api/qq/refresh。
     """
-    resp = requests.get(f"{BOT_API_BASE}/users/@me/guilds", headers=auth_headers(), timeout=20)
-    if not resp.ok:
-        raise HTTPException(status_code=resp.status_code, detail=resp.text)
-    return resp.json()
+    try:
+        return await _cache.get("guilds", qq_directory.aget_guilds)
+    except DirectoryError as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail)
 
 
 @router.get("/channels")
-def list_channels(guild_id: str = Query(..., description="QQ 频道 guild_id（数字）")):
-    """列出指定 guild 下的所有子频道（channels）。"""
-    resp = requests.get(
-        f"{BOT_API_BASE}/guilds/{guild_id}/channels",
-        headers=auth_headers(),
-        timeout=20,
-    )
-    if not resp.ok:
-        raise HTTPException(status_code=resp.status_code, detail=resp.text)
-    return resp.json()
+async def list_channels(guild_id: str = Query(..., description="QQ 频道 guild_id（数字）")):
+    """列出指定 guild 下的所有子频道（channels），读频道目录缓存。"""
+    try:
+        return await _channels(guild_id)
+    except DirectoryError as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail)
 
 
 @router.get("/pick-default-channel")
-def pick_default_channel(guild_id: str = Query(..., description="QQ 频道 guild_id（数字）")):
+async def pick_default_channel(guild_id: str = Query(..., description="QQ 频道 guild_id（数字）")):
     """从 guild 下自动选择一个可用的“可发言频道”，返回其 channel_id。
 
-    兼容：
-    - type=0（旧的文字子频道）
-    - type=10007/10011 等（你当前频道返回就是这些）
-
-    策略：优先选择 speak_permission==1 且类型优先（0/10007/10011），跳过分类(type=4)。
+    选择算法见 qq_directory.pick_channel（与 worker 启动时共用）。
 
     Pick a default channel from the guild with priority on speakable channels and specific types.
     """
-    data = list_channels(guild_id)
-
-    channels = data
-    if isinstance(data, dict):
-        channels = data.get("data") or data.get("channels") or data.get("items") or []
-
-    if not isinstance(channels, list):
-        raise HTTPException(status_code=500, detail="unexpected channels response")
-
-    preferred_types = [0, 10007, 10011]
-    skip_types = {4}
-
-    def _cid(ch: dict) -> str | None:
-        cid = ch.get("id") or ch.get("channel_id")
-        return str(cid) if cid else None
-
-    def _type_int(ch: dict) -> int | None:
-        try:
-            return int(ch.get("type"))
-        except Exception:
-            return None
-
-    def _can_speak(ch: dict) -> bool:
-        try:
-            return int(ch.get("speak_permission", 0)) == 1
-        except Exception:
-            return False
-
-    # 1) 优先：可发言 + 优先类型
-    for t in preferred_types:
-        for ch in channels:
-            if not isinstance(ch, dict):
-                continue
-            if _type_int(ch) in skip_types:
-                continue
-            if _type_int(ch) == t and _can_speak(ch):
-                cid = _cid(ch)
-                if cid:
-                    return {"channel_id": cid, "channel": ch}
-
-    # 2) 次优：优先类型
-    for t in preferred_types:
-        for ch in channels:
-            if not isinstance(ch, dict):
-                continue
-            if _type_int(ch) in skip_types:
-                continue
-            if _type_int(ch) == t:
-                cid = _cid(ch)
-                if cid:
-                    return {"channel_id": cid, "channel": ch}
-
-    # 3) 兜底：任何可发言频道
-    for ch in channels:
-        if not isinstance(ch, dict):
-            continue
-        if _type_int(ch) in skip_types:
-            continue
-        if _can_speak(ch):
-            cid = _cid(ch)
-            if cid:
-                return {"channel_id": cid, "channel": ch}
-
-    raise HTTPException(status_code=404, detail="no speakable channel found")
+    channels = qq_directory.extract_channels(await list_channels(guild_id))
+    ch = qq_directory.pick_channel(channels)
+    if not ch:
+        raise HTTPException(status_code=404, detail="no speakable channel found")
+    return {"channel_id": str(ch.get("id") or ch.get("channel_id")), "channel": ch}
+
+
+@router.post("/refresh")
+async def refresh_directory(guild_id: str | None = Query(None, description="同时刷新该 guild 的子频道列表")):
+    """显式刷新频道目录缓存。"""
+    try:
+        out = await qq_directory.arefresh(guild_id)
+    except DirectoryError as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail)
+    _cache.invalidate()
+    return {"ok": True, **out}
@@ -0,0 +1,58 @@
+from fastapi import APIRouter, HTTPException
+from pydantic import BaseModel
+import asyncio
+
+import rules
+
+router = APIRouter(prefix="/api/rules", tags=["rules"])
+
+# 单次试跑的语料上限（条）
+_MAX_CORPUS = 50000
+
+
+class DryRunReq(BaseModel):
+    # 语料来源：dead（最近 limit 条死信）/ queued（发送队列中待发的前 limit 条）/ jsonl（上传的 JSONL 文本）
+    source: str = "dead"
+    limit: int = 200
+    jsonl: str = ""
+    # 候选规则：{filter: {...}, transforms: [...]}，缺省项沿用线上配置
+    rules: dict | None = None
+    # 逐条明细最多返回多少条
+    max_items: int = 200
+
+
+def _load_corpus(req: DryRunReq) -> list:
+    limit = min(max(req.limit, 1), _MAX_CORPUS)
+    if req.source == "dead":
+        from db import list_dead
+
+        return [row["payload"] for row in list_dead(limit=limit)]
+    if req.source == "queued":
+        return rules.queued_payloads(limit)
+    if req.source == "jsonl":
+        return rules.parse_jsonl(req.jsonl)[:_MAX_CORPUS]
+    raise ValueError(f"unknown source: {req.source}")
+
+
+@router.post("/dry-run")
+async def dry_run(req: DryRunReq):
+    """
+    规则试跑：在语料上批量执行 rules.filter + rules.transforms，不发送、不改任何状态
+    返回逐条结果（是否放行 / 命中规则 / 清洗 diff）与逐规则命中次数、耗时（微秒）、从未命中的规则
+    """
+    candidate = req.rules or {}
+    try:
+        docs = await asyncio.to_thread(_load_corpus, req)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    # 整个评估放到线程里，不占事件循环。不开进程池：spawn 子进程会把 listen 的主模块（app.py）
+    # 重新导入一遍（TelegramClient、图片指纹索引……）；更大的语料用命令行 python rules.py 并行跑
+    return await asyncio.to_thread(
+        rules.evaluate,
+        docs,
+        candidate.get("filter"),
+        candidate.get("transforms"),
+        1,
+        min(max(req.max_items, 0), 1000),
+    )
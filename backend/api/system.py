@@ -1,28 +1,88 @@
 from fastapi import APIRouter
-import os
-import redis
+import asyncio
 
+import async_clients
+from async_clients import TTLCache
+from config import get as cfg_get
 from db import stats_today
+from drain import QUEUE_KEY, BACKLOG_KEY, LOW_KEY, UPLOAD_KEY, UPLOAD_LOW_KEY, UPLOAD_PROCESSING_KEY
+import metrics
+import quota
+from retry import DELAYED_KEY
+import rules
 
 router = APIRouter(prefix="/api/system", tags=["system"])
 
-r = redis.Redis(host=os.getenv("REDIS_HOST"), decode_responses=True)
+# Dashboard 轮询的统计结果在进程内缓存几秒（多个标签页 / 多个管理员共用一次查询）
+try:
+    STATS_CACHE_SECONDS = float(cfg_get("admin.stats_cache_seconds", 2))
+except Exception:
+    STATS_CACHE_SECONDS = 2.0
+
+_cache = TTLCache(STATS_CACHE_SECONDS)
+
+
+async def _collect_stats() -> dict:
+    ar = async_clients.redis()
+    async with ar.pipeline(transaction=False) as pipe:
+        for key in (QUEUE_KEY, BACKLOG_KEY, LOW_KEY, UPLOAD_KEY, UPLOAD_LOW_KEY, UPLOAD_PROCESSING_KEY):
+            pipe.llen(key)
+        pipe.zcard(DELAYED_KEY)
+        (
+            queue_length, backlog_length, low_length,
+            upload_length, upload_low_length, upload_processing_length, delayed_length,
+        ) = await pipe.execute()
+    # SQLite 没有异步驱动：放到线程里，与 Redis 查询并行
+    (success_today, failed_today, dead_count), quota_snapshot = await asyncio.gather(
+        asyncio.to_thread(stats_today),
+        quota.snapshot_async(ar),
+    )
+
+    return {
+        "queue_length": int(queue_length),
+        "backlog_length": int(backlog_length),
+        "low_length": int(low_length),
+        "upload_length": int(upload_length) + int(upload_low_length) + int(upload_processing_length),
+        "delayed_length": int(delayed_length),
+        "success_today": success_today,
+        "failed_today": failed_today,
+        "dead_count": dead_count,
+        "quota": quota_snapshot,
+    }
+
 
 @router.get("/stats")
-def get_system_stats():
+async def get_system_stats():
     """
     Dashboard 核心运维指标
     - queue_length：Redis 队列长度（是否堆积）
+    - backlog_length：静默时段积压中尚未排空的条数
+    - low_length：低优先级通道（历史回灌）待发条数
+    - upload_length：上传阶段（uploader.py）待预上传的带图任务数
+    - delayed_length：延迟重试队列（queue:delayed）中等待到期的任务数
     - success_today：今日成功转发数
     - failed_today：今日失败数（死信）
     - dead_count：当前死信总数
+    - quota：今日 QQ 主动消息配额用量、速率与耗尽预测
     """
-    queue_length = int(r.llen("queue"))
-    success_today, failed_today, dead_count = stats_today()
+    return await _cache.get("stats", _collect_stats)
 
-    return {
-        "queue_length": queue_length,
-        "success_today": success_today,
-        "failed_today": failed_today,
-        "dead_count": dead_count,
-    }
+
+@router.get("/rules")
+async def get_rule_stats():
+    """
+    线上规则计数（listen 的过滤 + worker 的清洗，跨进程汇总；有 rules.stats_flush_seconds 秒的延迟）
+    - rules：每条规则的执行次数 evals、命中 hits、丢弃 drops、正则超时 timeouts、
+      累计 / 平均 / 最大耗时（微秒），按累计耗时降序（热点在前）
+    - unused_rules：执行过但从未命中的规则（可以考虑删掉）
+    - stale_rules：配置里已不存在的旧编号
+    """
+    snap = await metrics.snapshot_async(async_clients.redis())
+    return rules.live_report(snap)
+
+
+@router.post("/rules/reset")
+async def reset_rule_stats():
+    """清零线上规则计数（调整规则顺序后编号会错位，重新统计）。"""
+    await asyncio.to_thread(metrics.delete_series, rules.RULE_METRICS + ("rule_regex_timeout_total",))
+    return {"ok": True}
@@ -1,40 +1,36 @@
 import os
-import json
-import random
-import re
 import time
 from pydantic import BaseModel
 from fastapi import FastAPI
 from telethon import TelegramClient, events
-import redis
 
 from config import CFG, get as cfg_get
-from db import init_db, is_processed
+from log import get_logger
+from db import init_db
+from tg_ingest import (
+    TG_API_ID,
+    TG_API_HASH,
+    SESSION,
+    TG_SESSION_DIR,
+    r,
+    normalize_source,
+    handle_message,
+    advance_hwm,
+    HWM_KEY,
+    FAILED_KEY,
+    TG_FAILED_MAX_ATTEMPTS,
+)
 from auth import login as do_login
 from auth import auth_required
 
 from api.system import router as system_router
 from api.deadletters import router as deadletters_router
 from api.qq_debug import router as qq_debug_router
-
-# === Telegram 配置（从 config.yaml）===
-TG_API_ID = int(cfg_get("telegram.api_id"))
-TG_API_HASH = cfg_get("telegram.api_hash")
-SESSION = cfg_get("telegram.session", "userbot")
-TG_SESSION_DIR = (cfg_get("telegram.session_dir") or "/app/sessions").rstrip("/")
-
-# 确保 session 目录存在
-try:
-    os.makedirs(TG_SESSION_DIR, exist_ok=True)
-except Exception:
-    pass
+from api.rules import router as rules_router
 
 # TG Client
 client = TelegramClient(f"{TG_SESSION_DIR}/{SESSION}", TG_API_ID, TG_API_HASH)
 
-# Redis
-r = redis.Redis(host=os.getenv("REDIS_HOST"), decode_responses=True)
-
 # FastAPI
 app = FastAPI()
 
@@ -46,217 +42,270 @@ admin_router = APIRouter(dependencies=[Depends(auth_required)])
 admin_router.include_router(system_router)
 admin_router.include_router(deadletters_router)
 admin_router.include_router(qq_debug_router)
+admin_router.include_router(rules_router)
 app.include_router(admin_router)
 
 
+@app.on_event("shutdown")
+async def _close_async_clients():
+    import async_clients
+
+    await async_clients.close()
+
+
 class LoginReq(BaseModel):
     password: str
 
 
-def _normalize_gray_ratio(v) -> float:
-    """兼容两种写法：
-    - 0~1 概率（推荐）
-    - 0~100 百分比（旧前端 UI 可能会写入）
-    """
-    try:
-        x = float(v)
-    except Exception:
-        return 1.0
+# === TG 源 -> chat_id 白名单缓存 ===
+_ENV_RESOLVED_SOURCES: set[str] = set()
 
-    if x <= 0:
-        return 0.0
-    if x > 1:
-        # 认为是百分比
-        return min(x / 100.0, 1.0)
-    return x
 
+_log = get_logger("listen")
 
-def pass_filter(text: str, rule: dict) -> bool:
-    """关键词/正则过滤（黑名单优先 + 可选白名单）
 
-    逻辑（与另一个 TG 项目的 filter_text 完全对齐）：
-    1) block 命中 → 直接丢弃（最高优先级）
-    2) 若 require_allows=true，则必须命中 allow 关键词/正则才放行
-    3) 若 require_allows=false（默认），allow 不生效，block 没命中就放行
+# 源 → peer_id 持久化映射（Redis 哈希）；access_hash 由 Telethon session 库保存，
+# 有映射的源重启后不再调用 get_entity（ResolveUsername 容易触发 FloodWait）
+_PEER_IDS_KEY = "tg:peer_ids"
 
-    配置来源：config.yaml → rules.filter
-    """
-    if not rule:
-        return True
+try:
+    TG_RESOLVE_CONCURRENCY = max(int(cfg_get("telegram.resolve_concurrency", 4)), 1)
+except Exception:
+    TG_RESOLVE_CONCURRENCY = 4
 
-    text = text or ""
 
-    # --- block（黑名单）：命中即丢弃 ---
-    block_kw = rule.get("block_keywords") or rule.get("keywords") or []
-    block_re = rule.get("block_regex") or rule.get("regex") or []
+async def _resolve_source(u: str, sem) -> str | None:
+    """get_entity 解析单个源；FloodWait 不超过 60s 时等待后重试一次。"""
+    import asyncio
+    from telethon.errors import FloodWaitError
+    from telethon.utils import get_peer_id
 
-    if block_kw and any(k in text for k in block_kw):
-        return False
-    if block_re:
-        for rg in block_re:
+    async with sem:
+        for attempt in (1, 2):
             try:
-                if re.search(rg, text):
-                    return False
-            except re.error:
-                pass
-
-    # --- allow（白名单）：require_allows=true 时必须命中才放行 ---
-    require_allows = rule.get("require_allows", False)
-    if require_allows:
-        allow_kw = rule.get("allow_keywords") or []
-        allow_re = rule.get("allow_regex") or []
-
-        if not allow_kw and not allow_re:
-            # 配置了 require_allows 但没给任何 allow 规则 → 全部放行（避免误杀）
-            return True
-
-        hit_allow = False
-        if allow_kw and any(k in text for k in allow_kw):
-            hit_allow = True
-        if not hit_allow and allow_re:
-            for rg in allow_re:
-                try:
-                    if re.search(rg, text):
-                        hit_allow = True
-                        break
-                except re.error:
-                    pass
-        return hit_allow
-
-    return True
-
-
-def _build_forward_conf() -> dict:
-    """从 config.yaml 构建转发配置（每次消息调用，支持热重载后的潜在扩展）。"""
-    fwd = CFG.get("forward") or {}
-    fltr = cfg_get("rules.filter") or {}
-    return {
-        "enabled": fwd.get("enabled", True),
-        "qq_channel_id": str(cfg_get("qq.target_channel_id") or "").strip(),
-        "gray_ratio": fwd.get("gray_ratio", 1),
-        "template": {
-            "prefix": fwd.get("template_prefix", ""),
-            "suffix": fwd.get("template_suffix", ""),
-        },
-        "filter": fltr,
-    }
+                entity = await client.get_entity(u)
+                return str(get_peer_id(entity))
+            except FloodWaitError as e:
+                if attempt == 2 or e.seconds > 60:
+                    _log("WARN", f"❌ TG 源解析被限流：{u} 需等待 {e.seconds}s，本次跳过")
+                    return None
+                _log("WARN", f"⏳ TG 源解析 FloodWait：{u} 等待 {e.seconds}s 后重试")
+                await asyncio.sleep(e.seconds + 1)
+            except Exception as e:
+                _log("WARN", f"❌ TG 源解析失败：{u} 错误={e}")
+                return None
+    return None
 
 
-# === TG 源 -> chat_id 白名单缓存 ===
-_ENV_RESOLVED_SOURCES: set[str] = set()
+async def refresh_env_sources_cache() -> list[int]:
+    """解析 telegram.sources 为 peer_id 集合，同时返回 int id 列表供 chats= 过滤。
 
+    已缓存的源直接使用 tg:peer_ids 里的映射；只有新增/变更的源才调用 get_entity，
+    并在 telegram.resolve_concurrency 限制下并发解析。
+    """
+    import asyncio
 
-def _log(level: str, msg: str):
-    ts = time.strftime("%Y-%m-%d %H:%M:%S")
-    print(f"[{ts}] listen   | {level:5s} | {msg}")
+    sources = [u for u in (normalize_source(x) for x in (cfg_get("telegram.sources") or [])) if u]
 
+    try:
+        cached = r.hgetall(_PEER_IDS_KEY) or {}
+    except Exception:
+        cached = {}
 
-async def refresh_env_sources_cache() -> list[int]:
-    """解析 telegram.sources 为 peer_id 集合，同时返回 int id 列表供 chats= 过滤。"""
-    from telethon.utils import get_peer_id
+    peer_ids: dict[str, str] = {u: cached[u] for u in sources if cached.get(u)}
+    pending = [u for u in sources if u not in peer_ids]
 
-    sources = cfg_get("telegram.sources") or []
-    resolved: set[str] = set()
-    entity_ids: list[int] = []
-
-    for u in sources:
-        u = str(u).strip()
-        if not u:
-            continue
-        if not u.startswith("@"):
-            u = "@" + u
+    if pending:
+        sem = asyncio.Semaphore(TG_RESOLVE_CONCURRENCY)
+        results = await asyncio.gather(*(_resolve_source(u, sem) for u in pending))
+        fresh = {u: pid for u, pid in zip(pending, results) if pid}
+        peer_ids.update(fresh)
+        if fresh:
+            try:
+                r.hset(_PEER_IDS_KEY, mapping=fresh)
+            except Exception as e:
+                _log("WARN", f"⚠️ TG 源映射写入 Redis 失败：{e}")
+
+    # 已从配置移除的源不再保留映射
+    stale = [u for u in cached if u not in sources]
+    if stale:
         try:
-            entity = await client.get_entity(u)
-            pid = str(get_peer_id(entity))
-            resolved.add(pid)
-            entity_ids.append(int(pid))
-        except Exception as e:
-            _log("WARN", f"❌ TG 源解析失败：{u} 错误={e}")
-            continue
+            r.hdel(_PEER_IDS_KEY, *stale)
+        except Exception:
+            pass
 
     global _ENV_RESOLVED_SOURCES
-    _ENV_RESOLVED_SOURCES = resolved
-    _log("INFO", f"✅ TG 源解析完成：{len(_ENV_RESOLVED_SOURCES)}/{len(sources)} 个频道")
-    return entity_ids
-
-
-def _debug_tg_events_enabled() -> bool:
-    return cfg_get("logging.debug_tg_events", False)
+    _ENV_RESOLVED_SOURCES = set(peer_ids.values())
+    _log(
+        "INFO",
+        f"✅ TG 源解析完成：{len(_ENV_RESOLVED_SOURCES)}/{len(sources)} 个频道 "
+        f"（缓存命中 {len(sources) - len(pending)}，新解析 {len(pending)}）",
+    )
+    return [int(pid) for pid in dict.fromkeys(peer_ids.values())]
 
 
 # 注意：不再用 @client.on(events.NewMessage) 静态注册。
 # 改为在 _startup() 中解析完 TG_SOURCES 后，用 chats= 参数动态注册，
 # 这样 Telethon 底层只派发白名单频道的消息，其他频道的消息根本不进入回调。
 
+# 补拉：每个源最多补多少条（防止长时间停机后一次性涌入）、同时补拉几个源
+try:
+    TG_CATCHUP_MAX_MESSAGES = max(int(cfg_get("telegram.catchup_max_messages", 200)), 0)
+except Exception:
+    TG_CATCHUP_MAX_MESSAGES = 200
+try:
+    TG_CATCHUP_CONCURRENCY = max(int(cfg_get("telegram.catchup_concurrency", 3)), 1)
+except Exception:
+    TG_CATCHUP_CONCURRENCY = 3
+
+# 补拉游标：某源这次没补完（达到条数上限 / 被限流 / 出错）时记下补到的位置，下次启动从这里继续；
+# 补完即删除。不能靠高水位：实时事件早已把它推过缺口
+_CATCHUP_CURSOR_KEY = "tg:catchup"
+
 async def on_new_message(event):
     """纯 ENV 模式：
     - Telethon 底层已通过 chats= 过滤，只有白名单频道的消息才会触发本回调
     - 统一发送到 QQ_TARGET_CHANNEL_ID（若留空由 worker 通过 guild 自动选）
     """
-    chat_id_str = str(event.chat_id)
-    msg_id = event.message.id
+    await handle_message(event.message)
 
-    if _debug_tg_events_enabled():
-        _log(
-            "INFO",
-            f"📩 收到消息 chat_id={chat_id_str} msg_id={msg_id}",
-        )
 
-    # 去重
-    if is_processed(event.chat_id, msg_id):
-        if _debug_tg_events_enabled():
-            _log("INFO", f"⏭️ 跳过（已处理）chat_id={chat_id_str} msg_id={msg_id}")
-        return
+async def _retry_failed(peer_id: int) -> tuple[int, int]:
+    """按 id 重新拉取该源之前处理失败的消息（tg_ingest.FAILED_KEY），返回 (拉取条数, 入队条数)。"""
+    key = FAILED_KEY.format(peer_id)
+    try:
+        failed = r.hgetall(key) or {}
+    except Exception:
+        return 0, 0
+    if not failed:
+        return 0, 0
+
+    give_up = [m for m, n in failed.items() if int(n) >= TG_FAILED_MAX_ATTEMPTS]
+    if give_up:
+        r.hdel(key, *give_up)
+        _log("WARN", f"❌ 消息多次处理失败，放弃 chat_id={peer_id} msg_ids={sorted(int(m) for m in give_up)}")
+    ids = sorted(int(m) for m, n in failed.items() if int(n) < TG_FAILED_MAX_ATTEMPTS)
+    if not ids:
+        return 0, 0
+
+    fetched = queued = 0
+    messages = await client.get_messages(peer_id, ids=ids)
+    for msg_id, message in zip(ids, messages):
+        if message is not None:
+            fetched += 1
+            try:
+                if await handle_message(message, origin="retry"):
+                    queued += 1
+            except Exception as e:
+                # handle_message 已把失败次数加一，下次启动再试
+                _log("WARN", f"⚠️ 失败消息重试仍失败 chat_id={peer_id} msg_id={msg_id} err={e}")
+                continue
+        r.hdel(key, str(msg_id))
+    return fetched, queued
+
+
+async def _catch_up_chat(peer_id: int, sem) -> tuple[int, int]:
+    """补拉单个源停机期间的消息（按 msg_id 升序入队）并重试之前失败的消息，返回 (拉取条数, 入队条数)。"""
+    import asyncio
+    from telethon.errors import FloodWaitError
 
-    conf = _build_forward_conf()
+    async with sem:
+        try:
+            hwm = r.hget(HWM_KEY, str(peer_id))
+            cursor = r.hget(_CATCHUP_CURSOR_KEY, str(peer_id))
+        except Exception:
+            hwm = cursor = None
 
-    if not conf.get("enabled", True):
-        if _debug_tg_events_enabled():
-            _log("INFO", "⏭️ 跳过（转发已关闭）")
-        return
+        # 首次见到该源：只记录当前最新 msg_id 作为起点，不回灌历史（历史用 backfill）
+        if not hwm:
+            try:
+                latest = await client.get_messages(peer_id, limit=1)
+                if latest:
+                    advance_hwm(peer_id, latest[0].id)
+            except Exception as e:
+                _log("WARN", f"⚠️ 高水位初始化失败 chat_id={peer_id} err={e}")
+            return 0, 0
 
-    if random.random() > _normalize_gray_ratio(conf.get("gray_ratio", 1)):
-        if _debug_tg_events_enabled():
-            _log("INFO", f"⏭️ 跳过（灰度过滤）gray_ratio={conf.get('gray_ratio')}")
-        return
+        try:
+            fetched, queued = await _retry_failed(peer_id)
+        except Exception as e:
+            _log("WARN", f"⚠️ 失败消息重试异常 chat_id={peer_id} err={e}")
+            fetched = queued = 0
+
+        # 本轮补拉实际处理到的位置：FloodWait 后从这里继续，没补完时存为游标
+        # （不能重读高水位：实时事件早已把它推到最新，中间的缺口会被永久跳过）
+        last_id = int(cursor or hwm)
+        caught = 0
+        done = False
+        for attempt in (1, 2):
+            try:
+                async for message in client.iter_messages(
+                    peer_id, min_id=last_id, reverse=True,
+                    limit=TG_CATCHUP_MAX_MESSAGES - caught,
+                ):
+                    caught += 1
+                    try:
+                        if await handle_message(message, origin="catchup"):
+                            queued += 1
+                    except Exception as e:
+                        # 已记进失败列表，下次启动按 id 重试；不挡住后面的消息
+                        _log("WARN", f"⚠️ 补拉消息处理失败 chat_id={peer_id} msg_id={message.id} err={e}")
+                    last_id = message.id
+                done = caught < TG_CATCHUP_MAX_MESSAGES
+                break
+            except FloodWaitError as e:
+                if attempt == 2:
+                    _log("WARN", f"❌ 补拉被限流 chat_id={peer_id} 需等待 {e.seconds}s，下次启动从 msg_id={last_id} 继续")
+                    break
+                _log("WARN", f"⏳ 补拉 FloodWait chat_id={peer_id} 等待 {e.seconds}s 后继续")
+                await asyncio.sleep(e.seconds + 1)
+                if caught >= TG_CATCHUP_MAX_MESSAGES:
+                    break
+            except Exception as e:
+                _log("WARN", f"⚠️ 补拉失败 chat_id={peer_id} err={e}，下次启动从 msg_id={last_id} 继续")
+                break
+        fetched += caught
 
-    text = event.message.text or ""
+        try:
+            if done:
+                r.hdel(_CATCHUP_CURSOR_KEY, str(peer_id))
+            else:
+                r.hset(_CATCHUP_CURSOR_KEY, str(peer_id), last_id)
+        except Exception:
+            pass
+        if not done and caught >= TG_CATCHUP_MAX_MESSAGES:
+            try:
+                gap = max(int(r.hget(HWM_KEY, str(peer_id)) or 0) - last_id, 0)
+            except Exception:
+                gap = 0
+            _log(
+                "WARN",
+                f"⚠️ 补拉达到上限 {TG_CATCHUP_MAX_MESSAGES} 条 chat_id={peer_id} last_id={last_id} "
+                f"剩余缺口约 {gap} 条（按 msg_id 估算），下次启动继续",
+            )
+        return fetched, queued
 
-    if not pass_filter(text, conf.get("filter")):
-        if _debug_tg_events_enabled():
-            _log("INFO", "⏭️ 跳过（关键词过滤）")
-        return
 
-    media = None
-    if event.message.photo:
-        media = f"/tmp/{chat_id_str}_{msg_id}.jpg"
-        await event.message.download_media(media)
-    elif event.message.document:
-        # 部分 TG 频道以 document 形式发送图片（大图/PNG/GIF）
-        mime = getattr(event.message.document, "mime_type", "") or ""
-        if mime.startswith("image/"):
-            ext = mime.split("/")[-1].replace("jpeg", "jpg")
-            media = f"/tmp/{chat_id_str}_{msg_id}.{ext}"
-            await event.message.download_media(media)
-
-    payload = {
-        "chat_id": int(event.chat_id),
-        "msg_id": int(msg_id),
-        "text": text,
-        "media": media,
-        # 纯 env 模式：qq_channel_id 可以为空，worker 会用 QQ_TARGET_GUILD_ID 自动选择
-        "qq_channel_id": conf.get("qq_channel_id") or "",
-        "template": conf.get("template"),
-        "channel_name": getattr(event.chat, "title", "") or "",
-    }
+async def catch_up_sources(peer_ids: list[int]):
+    """启动补拉：各源从补拉游标（没有则高水位）之后 iter_messages，走与实时消息相同的过滤/去重/入队路径；
+    之前处理失败的消息按 id 重拉。
 
-    r.lpush("queue", json.dumps(payload, ensure_ascii=False))
+    与实时事件并行运行；同一条消息由入队认领（_claim）保证只入队一次。
+    """
+    import asyncio
 
-    if _debug_tg_events_enabled():
-        _log(
-            "INFO",
-            f"✅ 已入队 chat_id={chat_id_str} msg_id={msg_id} 有图片={bool(media)}",
-        )
+    if not peer_ids or TG_CATCHUP_MAX_MESSAGES <= 0:
+        return
+    t = time.perf_counter()
+    sem = asyncio.Semaphore(TG_CATCHUP_CONCURRENCY)
+    results = await asyncio.gather(*(_catch_up_chat(pid, sem) for pid in peer_ids))
+    fetched = sum(f for f, _ in results)
+    queued = sum(q for _, q in results)
+    _log(
+        "INFO",
+        f"🧩 停机补拉完成：{len(peer_ids)} 个源 拉取 {fetched} 条 入队 {queued} 条 "
+        f"耗时 {(time.perf_counter() - t) * 1000:.0f}ms",
+    )
 
 
 @app.post("/api/login")
@@ -264,6 +313,17 @@ def api_login(req: LoginReq):
     return {"token": do_login(req.password)}
 
 
+@app.get("/metrics")
+async def prometheus_metrics():
+    """不鉴权 Prometheus 指标（WS 心跳 RTT、重连耗时等，由各后台进程写入 Redis）。"""
+    from fastapi.responses import PlainTextResponse
+    import async_clients
+    import metrics
+
+    snap = await metrics.snapshot_async(async_clients.redis())
+    return PlainTextResponse(metrics.render_prometheus(snap), media_type="text/plain; version=0.0.4")
+
+
 @app.get("/healthz")
 def healthz():
     """不鉴权健康检查。"""
@@ -287,6 +347,14 @@ if __name__ == "__main__":
     import asyncio
     import uvicorn
 
+    _t_boot = time.perf_counter()
+    _startup_timings: dict[str, float] = {}
+
+    def _mark_startup(name: str, since: float) -> float:
+        now = time.perf_counter()
+        _startup_timings[name] = (now - since) * 1000.0
+        return now
+
     init_db()
 
     fwd = CFG.get("forward") or {}
@@ -310,8 +378,10 @@ if __name__ == "__main__":
 
     # 正常启动：若 session 不存在且需要交互输入，会在容器中 EOF。
     # 这里捕获后给出明确指引，避免无限重启刷屏。
+    _t = _mark_startup("init", _t_boot)
     try:
         client.start()
+        _mark_startup("tg_login", _t)
     except EOFError:
         _log(
             "ERROR",
@@ -330,9 +400,12 @@ if __name__ == "__main__":
 
     async def _startup():
         """在同一个事件循环里完成：TG 源解析 -> 注册事件监听 -> Uvicorn 启动。"""
+        t = time.perf_counter()
+
         # 确保 Telethon 连接仍然有效
         if not client.is_connected():
             await client.connect()
+        t = _mark_startup("tg_connect", t)
 
         # 解析 TG_SOURCES，返回 entity id 列表
         entity_ids = []
@@ -340,6 +413,7 @@ if __name__ == "__main__":
             entity_ids = await refresh_env_sources_cache()
         except Exception as e:
             _log("ERROR", f"❌ TG 源缓存刷新失败：{e}")
+        t = _mark_startup("resolve_sources", t)
 
         # 动态注册事件处理器，chats= 限定只接收白名单频道的消息
         # 这样 Telethon 底层直接过滤，其他频道的消息根本不会进入回调
@@ -349,11 +423,27 @@ if __name__ == "__main__":
                 events.NewMessage(chats=entity_ids),
             )
             _log("INFO", f"📡 Telethon 事件监听已注册：chats={entity_ids}")
+
+            # 补拉停机期间漏掉的消息（后台进行，不阻塞 HTTP 服务启动）
+            asyncio.ensure_future(catch_up_sources(entity_ids))
         else:
             _log("WARN", "⚠️ 无可用 TG 源，事件监听未注册（不会转发任何消息）")
 
         _log("INFO", "🟢 Telethon 事件循环运行中，开始接收 TG 消息")
 
+        # QQ 频道目录后台刷新（worker 启动选频道、/api/qq/* 都读这份缓存）
+        import qq_directory
+
+        qq_directory.start_refresher([str(cfg_get("qq.target_guild_id") or "").strip()])
+        _mark_startup("handlers", t)
+
+        total = (time.perf_counter() - _t_boot) * 1000.0
+        _log(
+            "INFO",
+            f"⏱️ 启动耗时 total={total:.0f}ms "
+            + " ".join(f"{k}={v:.0f}ms" for k, v in _startup_timings.items()),
+        )
+
         # 启动 Uvicorn（作为同一个 loop 内的 Server，不会抢占事件循环）
         config = uvicorn.Config(app, host="0.0.0.0", port=8000, loop="none")
         server = uvicorn.Server(config)
@@ -0,0 +1,93 @@
+"""
+listen 进程共用的异步客户端与短 TTL 缓存（管理 API 用）。
+
+管理接口和 Telethon 跑在同一个事件循环里。以前这些路由是同步 def：
+走 uvicorn 线程池，阻塞调用 requests / redis-py，后台刷新一下频道列表就占住线程和 GIL，
+TG 消息事件跟着排队。这里提供：
+
+- redis()：redis.asyncio 客户端（进程内共享，首次使用时在当前事件循环创建）
+- http()：httpx.AsyncClient（连接池复用）
+- TTLCache：进程内短 TTL 缓存；同一 key 并发请求合并为一次上游调用（single-flight）
+- close()：关闭上面两个客户端（FastAPI shutdown 时调用）
+
+SQLite（db.py）没有异步驱动，调用方用 asyncio.to_thread 包一层。
+"""
+
+import asyncio
+import os
+import time
+
+import httpx
+import redis.asyncio as aioredis
+
+_redis: aioredis.Redis | None = None
+_http: httpx.AsyncClient | None = None
+
+
+def redis() -> aioredis.Redis:
+    global _redis
+    if _redis is None:
+        _redis = aioredis.Redis(host=os.getenv("REDIS_HOST"), decode_responses=True)
+    return _redis
+
+
+def http() -> httpx.AsyncClient:
+    global _http
+    if _http is None:
+        _http = httpx.AsyncClient(timeout=20)
+    return _http
+
+
+async def close():
+    global _redis, _http
+    if _http is not None:
+        await _http.aclose()
+        _http = None
+    if _redis is not None:
+        await _redis.close()
+        _redis = None
+
+
+class TTLCache:
+    """进程内短 TTL 缓存（只在事件循环里用，无需加锁）。ttl <= 0 时不缓存。"""
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self._data: dict[str, tuple[float, object]] = {}
+        self._inflight: dict[str, asyncio.Future] = {}
+
+    async def get(self, key: str, factory):
+        """命中且未过期直接返回；否则 await factory()。同 key 的并发调用共享同一次结果。"""
+        if self.ttl <= 0:
+            return await factory()
+        hit = self._data.get(key)
+        if hit is not None and time.monotonic() - hit[0] < self.ttl:
+            return hit[1]
+
+        fut = self._inflight.get(key)
+        if fut is not None:
+            return await asyncio.shield(fut)
+
+        fut = asyncio.get_running_loop().create_future()
+        self._inflight[key] = fut
+        try:
+            value = await factory()
+        except asyncio.CancelledError:
+            fut.cancel()
+            raise
+        except Exception as e:
+            fut.set_exception(e)
+            fut.exception()  # 没有并发等待者时避免 "exception was never retrieved"
+            raise
+        else:
+            self._data[key] = (time.monotonic(), value)
+            fut.set_result(value)
+            return value
+        finally:
+            self._inflight.pop(key, None)
+
+    def invalidate(self, key: str | None = None):
+        if key is None:
+            self._data.clear()
+        else:
+            self._data.pop(key, None)
@@ -0,0 +1,213 @@
+"""
+历史回灌：新加一个源时，把它最近 N 天 / N 条帖子按可控速度灌进 QQ。
+
+用法（在 backend 容器内）：
+    python backfill.py --login                # 首次：交互式登录回灌专用 session
+    python backfill.py @Q_dianying --days 3
+    python backfill.py @Q_dianying --limit 200 --rate-per-minute 30
+
+流程：
+- 复用 tg_ingest.handle_message（去重 / 过滤 / 图片去重 / 入队与 listener 同一条路径）；不导入 app.py
+- 按页（--page-size）流式读取历史，msg_id 升序
+- 每页的图片并发预取（--concurrency），随后按顺序入队，保证同一源内的先后
+- 入队到低优先级通道 queue:low（priority=low），worker 只有在 queue / backlog 都空时才消费
+- 检查点：backfill:ckpt:{peer_id} 记录已入队的最大 msg_id，中断后重跑从检查点继续，
+  已处理的消息不会再下载
+- 结束时输出吞吐（条/秒、图片 MB/s）
+
+回灌使用单独登录的 session（telegram.backfill_session）：与 listener 共用同一个授权密钥同时连接，
+Telegram 可能回 AUTH_KEY_DUPLICATED 并吊销线上 session。未配置、与 telegram.session 相同或尚未登录时直接退出。
+"""
+
+import argparse
+import asyncio
+import datetime
+import os
+import time
+
+from telethon import TelegramClient
+from telethon.errors import FloodWaitError
+from telethon.utils import get_peer_id
+
+from config import get as cfg_get
+from db import init_db, is_processed
+from drain import LOW_KEY
+from log import get_logger
+import tg_ingest
+
+_CKPT_KEY = "backfill:ckpt:{}"
+
+
+_log = get_logger("backfill")
+
+
+def _backfill_client(login: bool = False) -> TelegramClient:
+    """回灌专用 session 的客户端；配置不对或（非 login 时）尚未登录则直接退出。"""
+    session = str(cfg_get("telegram.backfill_session") or "").strip()
+    if not session:
+        raise SystemExit("❌ 未配置 telegram.backfill_session（回灌必须使用单独登录的 session）")
+    if session == tg_ingest.SESSION:
+        raise SystemExit("❌ telegram.backfill_session 不能与 telegram.session 相同（会与 listener 共用授权密钥）")
+    name = f"{tg_ingest.TG_SESSION_DIR}/{session}"
+    if not login and not os.path.exists(name + ".session"):
+        raise SystemExit(f"❌ 回灌 session 尚未登录：先运行 python backfill.py --login 生成 {name}.session")
+    return TelegramClient(name, tg_ingest.TG_API_ID, tg_ingest.TG_API_HASH)
+
+
+class _Stats:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.scanned = 0
+        self.queued = 0
+        self.media_files = 0
+        self.media_bytes = 0
+
+    def report(self) -> str:
+        elapsed = max(time.perf_counter() - self.started, 1e-6)
+        return (
+            f"扫描 {self.scanned} 条 入队 {self.queued} 条 图片 {self.media_files} 张 "
+            f"({self.media_bytes / 1048576:.1f}MB) 耗时 {elapsed:.1f}s "
+            f"吞吐 {self.scanned / elapsed:.1f} 条/s {self.media_bytes / 1048576 / elapsed:.2f} MB/s"
+        )
+
+
+async def _start_min_id(client, entity, days: float | None, limit: int | None) -> int:
+    """按 --days / --limit 计算起点（不含）：返回 min_id。"""
+    if limit:
+        # 倒数第 N 条的 id 即起点
+        older = await client.get_messages(entity, limit=1, add_offset=limit - 1)
+        return max(older[0].id - 1, 0) if older else 0
+    if days:
+        since = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(days=days)
+        # offset_date 取该时间点之前的最新一条，其 id 即起点
+        before = await client.get_messages(entity, limit=1, offset_date=since)
+        return before[0].id if before else 0
+    return 0
+
+
+async def _prefetch(messages: list, sem: asyncio.Semaphore, stats: _Stats) -> set[str]:
+    """并发预取一页里的图片（已存在则跳过），返回本次下载的文件路径。"""
+    fetched: set[str] = set()
+
+    async def _one(m):
+        path = tg_ingest.media_path_for(m)
+        if not path or os.path.exists(path) or is_processed(m.chat_id, m.id):
+            return
+        async with sem:
+            try:
+                await m.download_media(path)
+                fetched.add(path)
+                stats.media_files += 1
+                stats.media_bytes += os.path.getsize(path)
+            except Exception as e:
+                _log("WARN", f"⚠️ 图片预取失败 msg_id={m.id} err={e}")
+
+    await asyncio.gather(*(_one(m) for m in messages))
+    return fetched
+
+
+async def backfill(
+    source: str,
+    days: float | None,
+    limit: int | None,
+    page_size: int,
+    concurrency: int,
+    rate_per_minute: float,
+    restart: bool,
+):
+    client = _backfill_client()
+    await client.start()
+    stats = _Stats()
+    try:
+        entity = await client.get_entity(tg_ingest.normalize_source(source))
+        peer_id = get_peer_id(entity)
+        ckpt_key = _CKPT_KEY.format(peer_id)
+        if restart:
+            tg_ingest.r.delete(ckpt_key)
+
+        min_id = await _start_min_id(client, entity, days, limit)
+        ckpt = int(tg_ingest.r.hget(ckpt_key, "last_id") or 0)
+        if ckpt > min_id:
+            _log("INFO", f"↩️ 从检查点继续：last_id={ckpt}（起点 {min_id}）")
+            min_id = ckpt
+        tg_ingest.r.hset(ckpt_key, mapping={"source": source, "updated_at": int(time.time())})
+
+        _log("INFO", f"🚚 开始回灌 {source} peer_id={peer_id} min_id={min_id} → {LOW_KEY}")
+        sem = asyncio.Semaphore(concurrency)
+        interval = 60.0 / rate_per_minute if rate_per_minute > 0 else 0.0
+        page: list = []
+
+        async def _flush():
+            fetched = await _prefetch(page, sem, stats)
+            for m in page:
+                if await tg_ingest.handle_message(m, origin="backfill", queue_key=LOW_KEY, priority="low"):
+                    stats.queued += 1
+                    if interval:
+                        await asyncio.sleep(interval)
+                else:
+                    # 被过滤掉的消息：删掉本次预取的图片
+                    path = tg_ingest.media_path_for(m)
+                    if path in fetched and os.path.exists(path):
+                        os.remove(path)
+                tg_ingest.r.hset(ckpt_key, mapping={"last_id": m.id, "updated_at": int(time.time())})
+            page.clear()
+
+        while True:
+            try:
+                async for m in client.iter_messages(entity, min_id=min_id, reverse=True, wait_time=1):
+                    stats.scanned += 1
+                    page.append(m)
+                    if len(page) >= page_size:
+                        await _flush()
+                        _log("INFO", f"📦 进度 last_id={m.id} {stats.report()}")
+                if page:
+                    await _flush()
+                break
+            except FloodWaitError as e:
+                _log("WARN", f"⏳ FloodWait {e.seconds}s，稍后从检查点继续")
+                if page:
+                    await _flush()
+                await asyncio.sleep(e.seconds + 1)
+                min_id = int(tg_ingest.r.hget(ckpt_key, "last_id") or min_id)
+
+        _log("INFO", f"✅ 回灌完成 {source}：{stats.report()}")
+    finally:
+        await client.disconnect()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="把某个 TG 源的历史帖子回灌到 QQ（低优先级通道）")
+    parser.add_argument("source", nargs="?", help="源，如 @Q_dianying")
+    parser.add_argument("--login", action="store_true", help="交互式登录回灌专用 session 后退出")
+    scope = parser.add_mutually_exclusive_group()
+    scope.add_argument("--days", type=float, help="回灌最近 N 天")
+    scope.add_argument("--limit", type=int, help="回灌最近 N 条")
+    parser.add_argument("--page-size", type=int, default=50, help="每页条数（默认 50）")
+    parser.add_argument("--concurrency", type=int, default=4, help="图片并发预取数（默认 4）")
+    parser.add_argument("--rate-per-minute", type=float, default=0, help="入队限速（条/分钟，0 = 不限，由 worker 节流）")
+    parser.add_argument("--restart", action="store_true", help="忽略检查点，从头开始")
+    args = parser.parse_args()
+
+    if args.login:
+        client = _backfill_client(login=True)
+        client.start()  # 这里会要求输入手机号/验证码
+        client.disconnect()
+        _log("INFO", "✅ 回灌 session 登录完成")
+        return
+    if not args.source or not (args.days or args.limit):
+        parser.error("需要指定源和 --days / --limit 之一")
+
+    init_db()
+    asyncio.run(backfill(
+        args.source,
+        args.days,
+        args.limit,
+        max(args.page_size, 1),
+        max(args.concurrency, 1),
+        args.rate_per_minute,
+        args.restart,
+    ))
+
+
+if __name__ == "__main__":
+    main()
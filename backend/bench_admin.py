@@ -0,0 +1,103 @@
+"""
+管理 API 并发压测：验证后台被频繁刷新时，listen 进程的事件循环不受影响。
+
+做法（单进程、单事件循环，与 app.py 的 Telethon + Uvicorn 部署形态一致）：
+- 探针协程模拟 TG 事件分发：每 --interval-ms 醒来一次，记录实际醒来比预期晚了多少（事件循环延迟）
+- 先空载跑 --seconds 秒作基线，再用 --concurrency 个客户端循环请求管理 API 跑 --seconds 秒
+- 请求经 httpx.ASGITransport 直接进 FastAPI（含 JWT 鉴权），不经网络
+- 输出两阶段的延迟 p50 / p99 / max 与管理 API 吞吐
+
+用法（在 backend 容器内，需要 Redis / SQLite 可用）：
+    python bench_admin.py
+    python bench_admin.py --concurrency 50 --paths /api/system/stats,/api/qq/guilds
+"""
+
+import argparse
+import asyncio
+
+import httpx
+
+import app
+import async_clients
+from auth import ADMIN_PASS, login
+
+
+def _pct(xs: list[float], p: float) -> float:
+    if not xs:
+        return 0.0
+    xs = sorted(xs)
+    return xs[min(int(len(xs) * p), len(xs) - 1)]
+
+
+async def _probe(interval: float, stop: asyncio.Event) -> list[float]:
+    lags: list[float] = []
+    loop = asyncio.get_running_loop()
+    while not stop.is_set():
+        t = loop.time()
+        await asyncio.sleep(interval)
+        lags.append((loop.time() - t - interval) * 1000.0)
+    return lags
+
+
+async def _client(http: httpx.AsyncClient, paths: list[str], stop: asyncio.Event, stats: dict):
+    i = 0
+    while not stop.is_set():
+        path = paths[i % len(paths)]
+        i += 1
+        try:
+            resp = await http.get(path)
+            stats["ok" if resp.status_code < 500 else "error"] += 1
+        except Exception:
+            stats["error"] += 1
+
+
+async def _phase(name: str, seconds: float, interval: float, concurrency: int, paths: list[str], http) -> None:
+    stop = asyncio.Event()
+    stats = {"ok": 0, "error": 0}
+    probe = asyncio.ensure_future(_probe(interval, stop))
+    clients = [asyncio.ensure_future(_client(http, paths, stop, stats)) for _ in range(concurrency)]
+    await asyncio.sleep(seconds)
+    stop.set()
+    await asyncio.gather(*clients)
+    lags = await probe
+    print(
+        f"[{name:8s}] 事件循环延迟 p50={_pct(lags, 0.5):.2f}ms p99={_pct(lags, 0.99):.2f}ms "
+        f"max={max(lags, default=0.0):.2f}ms 样本={len(lags)} | "
+        f"管理 API {stats['ok'] / seconds:.0f} req/s 错误={stats['error']}"
+    )
+
+
+async def main_async(args):
+    paths = [p.strip() for p in args.paths.split(",") if p.strip()]
+    token = login(ADMIN_PASS)
+    transport = httpx.ASGITransport(app=app.app)
+    async with httpx.AsyncClient(
+        transport=transport,
+        base_url="http://bench",
+        headers={"Authorization": f"Bearer {token}"},
+        timeout=30,
+    ) as http:
+        interval = args.interval_ms / 1000.0
+        await _phase("idle", args.seconds, interval, 0, paths, http)
+        await _phase("admin", args.seconds, interval, args.concurrency, paths, http)
+    await async_clients.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="管理 API 并发压测（测 listen 事件循环延迟）")
+    parser.add_argument("--concurrency", type=int, default=20, help="并发客户端数（默认 20）")
+    parser.add_argument("--seconds", type=float, default=10, help="每个阶段时长（默认 10 秒）")
+    parser.add_argument("--interval-ms", type=float, default=10, help="探针间隔（默认 10ms）")
+    parser.add_argument(
+        "--paths",
+        default="/api/system/stats,/api/deadletters",
+        help="逗号分隔的管理 API 路径（/api/qq/* 会访问 QQ API）",
+    )
+    args = parser.parse_args()
+
+    app.init_db()
+    asyncio.run(main_async(args))
+
+
+if __name__ == "__main__":
+    main()
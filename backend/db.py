@@ -1,8 +1,9 @@
 import os
-import json
 import sqlite3
 import threading
 
+import task_codec
+
 DB_PATH = os.getenv("DB_PATH", "/app/data/tg2qq.db")
 
 _local = threading.local()
@@ -59,7 +60,8 @@ def save_dead(chat_id: int, msg_id: int, error: str, payload: dict):
     conn = _get_conn()
     conn.execute(
         "INSERT INTO dead (tg_chat_id, tg_msg_id, error, payload) VALUES (?,?,?,?)",
-        (chat_id, msg_id, error, json.dumps(payload, ensure_ascii=False))
+        # 自包含编码（不驻留模板/频道名）：死信长期保存，不依赖 Redis 里的驻留表
+        (chat_id, msg_id, error, task_codec.encode(payload, intern=False))
     )
     conn.commit()
 
@@ -75,7 +77,7 @@ def list_dead(limit: int = 200):
             "tg_chat_id": r["tg_chat_id"],
             "tg_msg_id": r["tg_msg_id"],
             "error": r["error"],
-            "payload": json.loads(r["payload"]),
+            "payload": task_codec.decode(r["payload"]),
             "created_at": r["created_at"],
         }
         for r in rows
@@ -89,7 +91,7 @@ def get_dead_payloads_by_ids(ids: list[int]):
     rows = _get_conn().execute(
         f"SELECT id, payload FROM dead WHERE id IN ({placeholders})", ids
     ).fetchall()
-    return [{"id": r["id"], "payload": json.loads(r["payload"])} for r in rows]
+    return [{"id": r["id"], "payload": task_codec.decode(r["payload"])} for r in rows]
 
 
 def delete_dead_by_ids(ids: list[int]):
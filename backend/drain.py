@@ -0,0 +1,199 @@
+"""
+静默时段结束后的积压排空规划（drain planner）。
+
+背景：00:00~06:00 期间消息全部堆积在 Redis "queue"，06:00 恢复后若按
+SEND_INTERVAL 逐条猛发，很快触发 QQ 频率限制（304045）再冻结 300s。
+
+恢复时先调用 plan_backlog()：
+1. 把 "queue" 整体 RENAME 为 BACKLOG_KEY（原子操作，之后新消息照常进 "queue"）
+2. 扫描积压：超过 TTL 的条目进死信（可手动重放），重复条目折叠为一条（被折叠的进死信，reason=folded）
+3. 写回 BACKLOG_KEY，顺序不变
+
+消费侧用 BRPOP ["queue", BACKLOG_KEY, LOW_KEY]：Redis 按 key 顺序检查，
+新消息永远优先，积压只在没有新消息时才发，低优先级通道（backfill.py 回灌）排在最后 → 新旧自然穿插，不会被六小时积压堵住。
+从积压（以及低优先级通道）取出的任务按 drain.rate_per_minute 放慢发送（见 drain_interval），新消息不受影响。
+worker 启动时若已有积压（上次排空途中重启），只重新规划积压本身（absorb_queue=False）；
+配额延后到次日的任务（quota.release_deferred）也放进积压再规划一遍，同样经过过期与折叠。
+"""
+
+import os
+import time
+
+from config import get as cfg_get
+from log import get_logger
+import task_codec
+
+QUEUE_KEY = "queue"
+BACKLOG_KEY = "queue:backlog"
+# 低优先级通道（历史回灌等）：只有 queue 与 backlog 都空时才消费
+LOW_KEY = "queue:low"
+# 上传阶段（uploader.py）：带图任务先进这里，预上传后再推进上面的发送队列
+UPLOAD_KEY = "queue:upload"
+UPLOAD_LOW_KEY = "queue:upload:low"
+# uploader 已出队、尚未转发完的任务（崩溃 / 重启后找回）
+UPLOAD_PROCESSING_KEY = "queue:upload:processing"
+
+# 积压条目存活时间（秒），超过即过期；0 = 不过期
+try:
+    BACKLOG_TTL_SECONDS = int(cfg_get("drain.ttl_seconds", 6 * 3600))
+except Exception:
+    BACKLOG_TTL_SECONDS = 6 * 3600
+
+# 积压排空速率（条/分钟），按 QQ 已知配额保守设置
+try:
+    DRAIN_RATE_PER_MINUTE = float(cfg_get("drain.rate_per_minute", 10))
+except Exception:
+    DRAIN_RATE_PER_MINUTE = 10.0
+
+# 过期条目处理方式：dead（进死信，可重放）/ drop（直接丢弃）
+EXPIRED_ACTION = str(cfg_get("drain.expired_action", "dead")).strip().lower()
+
+
+_log = get_logger("drain")
+
+
+def _dup_key(task: dict) -> str:
+    """折叠键：发往同一组频道的同一条 TG 消息（死信重放 + 原消息），或同一源里正文与图片都相同的帖子视为重复。
+
+    不同源、文案相同但图片不同、或目标频道不同的条目各自保留
+    （重试 / 限流冷却会把一条消息拆成只差 targets 的几份，每份都要发）。
+    """
+    targets = ",".join(sorted(str(t) for t in task.get("targets") or []))
+    text = (task.get("text") or "").strip()
+    if text:
+        return f"t:{task.get('chat_id')}:{task.get('media_phash') or ''}:{targets}:{text}"
+    return f"m:{task.get('chat_id')}:{task.get('msg_id')}:{targets}"
+
+
+def _cleanup_media(task: dict):
+    media = task.get("media")
+    if not media:
+        return
+    for f in (media, media.replace(".jpg", "_compressed.jpg")):
+        try:
+            if os.path.exists(f):
+                os.remove(f)
+        except Exception:
+            pass
+
+
+def plan_backlog(r, save_dead=None, absorb_queue: bool = True) -> dict:
+    """把当前队列转为积压队列并清洗，返回统计信息。
+
+    save_dead: 可选回调 save_dead(chat_id, msg_id, error, payload)，用于过期 / 被折叠的条目进死信。
+    absorb_queue: False 时不动 "queue"，只清洗已有积压（启动时 / 放回延后任务后）。
+    """
+    stats = {"total": 0, "kept": 0, "expired": 0, "duplicates": 0, "invalid": 0}
+
+    try:
+        # 原子搬走当前队列；此后 listener 的新消息进入空的 "queue"
+        if absorb_queue and r.exists(QUEUE_KEY):
+            if r.exists(BACKLOG_KEY):
+                # 上一轮还没排空：把新积压接在旧积压前面（更晚被消费）
+                # rpoplpush 从最旧的开始搬，放到 BACKLOG_KEY 头部，FIFO 不变
+                while r.rpoplpush(QUEUE_KEY, BACKLOG_KEY) is not None:
+                    pass
+            else:
+                r.rename(QUEUE_KEY, BACKLOG_KEY)
+    except Exception as e:
+        _log("ERROR", f"❌ 积压队列切换失败：{e}")
+        return stats
+
+    raws = r.lrange(BACKLOG_KEY, 0, -1)
+    stats["total"] = len(raws)
+    if not raws:
+        return stats
+
+    now = time.time()
+    # lrange 返回 [最新 ... 最旧]；重复时保留最新一条
+    kept: list[str] = []
+    seen: dict[str, str] = {}  # 折叠键 -> 保留条目的 chat_id:msg_id
+    kept_media: set[str] = set()
+    dropped: list[dict] = []  # 被折叠、且没有写进死信的条目（最后清理图片）
+
+    for raw in raws:  # 最新 → 最旧
+        try:
+            task = task_codec.decode(raw)
+        except Exception:
+            stats["invalid"] += 1
+            continue
+
+        ts = task.get("ts")
+        if BACKLOG_TTL_SECONDS > 0 and ts and now - float(ts) > BACKLOG_TTL_SECONDS:
+            stats["expired"] += 1
+            if EXPIRED_ACTION == "dead" and save_dead is not None:
+                try:
+                    save_dead(
+                        int(task.get("chat_id") or 0),
+                        int(task.get("msg_id") or 0),
+                        f"expired in quiet-hours backlog (age={int(now - float(ts))}s)",
+                        task,
+                    )
+                except Exception as e:
+                    _log("WARN", f"⚠️ 过期条目写死信失败：{e}")
+            else:
+                _cleanup_media(task)
+            continue
+
+        key = _dup_key(task)
+        if key in seen:
+            stats["duplicates"] += 1
+            if save_dead is not None:
+                try:
+                    save_dead(
+                        int(task.get("chat_id") or 0),
+                        int(task.get("msg_id") or 0),
+                        f"folded in backlog (duplicate of {seen[key]})",
+                        task,
+                    )
+                    continue
+                except Exception as e:
+                    _log("WARN", f"⚠️ 折叠条目写死信失败：{e}")
+            dropped.append(task)
+            continue
+        seen[key] = f"{task.get('chat_id')}:{task.get('msg_id')}"
+        kept.append(raw)
+        if task.get("media"):
+            kept_media.add(task["media"])
+
+    # 同一条消息的几份共用一张本地图片：只删没有保留条目再引用的
+    for task in dropped:
+        if task.get("media") not in kept_media:
+            _cleanup_media(task)
+
+    stats["kept"] = len(kept)
+
+    # 原子写回（保持 [最新 ... 最旧] 顺序）
+    pipe = r.pipeline()
+    pipe.delete(BACKLOG_KEY)
+    if kept:
+        pipe.rpush(BACKLOG_KEY, *kept)
+    pipe.execute()
+
+    _log(
+        "INFO",
+        f"📦 积压规划完成：共 {stats['total']} 条，保留 {stats['kept']}，"
+        f"过期 {stats['expired']}，折叠 {stats['duplicates']}，无效 {stats['invalid']}；"
+        f"预计 {drain_eta_seconds(stats['kept']) // 60} 分钟排空",
+    )
+    return stats
+
+
+def backlog_length(r) -> int:
+    try:
+        return int(r.llen(BACKLOG_KEY))
+    except Exception:
+        return 0
+
+
+def drain_interval(base_interval: float) -> float:
+    """积压排空期间的发送间隔：不快于 drain.rate_per_minute。"""
+    if DRAIN_RATE_PER_MINUTE <= 0:
+        return base_interval
+    return max(base_interval, 60.0 / DRAIN_RATE_PER_MINUTE)
+
+
+def drain_eta_seconds(n: int) -> int:
+    if DRAIN_RATE_PER_MINUTE <= 0:
+        return 0
+    return int(n * 60.0 / DRAIN_RATE_PER_MINUTE)
@@ -0,0 +1,247 @@
+"""
+感知哈希（dHash）图片索引：识别换了文案、重新编码后的同一张海报。
+
+- dhash：灰度缩放到 9x8，相邻像素比较得到 64 位指纹；重新压缩/缩放后基本不变
+- BKTree：按汉明距离组织的度量树，半径查询只遍历少量分支
+- ImageDupIndex：BKTree + 滑动时间窗口 + Redis ZSET（imghash:sigs）
+- 上传缓存：指纹 → 已上传的图床 URL（Redis，带 TTL），同图重复出现时 worker 直接复用
+
+listener 下载完图片后立即查询：命中即在上传/发布之前处理（skip 丢弃 / flag 复用已上传 URL）。
+指纹只在 worker 发布成功后登记（record）：被舍弃、近似去重跳过、进死信的帖子不会挡住后来的正常转发。
+listener 每次查询前增量拉取 ZSET 里新登记的指纹（_sync）。
+"""
+
+import collections
+import threading
+import time
+
+from config import get as cfg_get
+from log import get_logger
+
+REDIS_KEY = "imghash:sigs"
+URL_CACHE_PREFIX = "imghash:url:"
+
+IMAGE_DUP_ENABLED = bool(cfg_get("dedup.image.enabled", True))
+# 判定为同一张图的最大汉明距离（64 位 dHash，一般 ≤ 5）
+IMAGE_DUP_MAX_DISTANCE = max(int(cfg_get("dedup.image.max_distance", 4)), 0)
+IMAGE_DUP_WINDOW_SECONDS = float(cfg_get("dedup.image.window_hours", 24)) * 3600
+# 命中后动作：skip（不入队，记为已处理）/ flag（照常入队，仅复用已上传的图床 URL）
+IMAGE_DUP_ACTION = str(cfg_get("dedup.image.action", "flag")).strip().lower()
+# 上传缓存有效期（秒）
+UPLOAD_CACHE_TTL_SECONDS = int(cfg_get("dedup.image.upload_cache_ttl_seconds", 7 * 86400))
+
+# 增量同步时往回多看几秒（各进程写入时间戳有先后，避免漏掉稍早写入的成员）
+_SYNC_OVERLAP_SECONDS = 5.0
+
+
+_log = get_logger("imghash")
+
+
+def dhash(path: str, hash_size: int = 8) -> int | None:
+    """计算 64 位差值哈希；图片无法解析时返回 None。"""
+    try:
+        from PIL import Image
+
+        with Image.open(path) as img:
+            img.draft("L", (hash_size * 16, hash_size * 16))  # JPEG 直接按缩小尺寸解码
+            small = img.convert("L").resize((hash_size + 1, hash_size), Image.LANCZOS)
+            px = list(small.getdata())
+    except Exception:
+        return None
+
+    h = 0
+    w = hash_size + 1
+    for row in range(hash_size):
+        base = row * w
+        for col in range(hash_size):
+            h = (h << 1) | (1 if px[base + col] > px[base + col + 1] else 0)
+    return h
+
+
+def _hamming(a: int, b: int) -> int:
+    return (a ^ b).bit_count()
+
+
+class BKTree:
+    """汉明距离 BK 树；删除采用墓碑标记，墓碑过半时由调用方重建。"""
+
+    __slots__ = ("_root", "_size")
+
+    def __init__(self):
+        # 节点：[hash, keys(set), children(dict 距离→节点)]
+        self._root: list | None = None
+        self._size = 0
+
+    def __len__(self) -> int:
+        return self._size
+
+    def add(self, h: int, key: str):
+        self._size += 1
+        if self._root is None:
+            self._root = [h, {key}, {}]
+            return
+        node = self._root
+        while True:
+            d = _hamming(h, node[0])
+            if d == 0:
+                node[1].add(key)
+                return
+            child = node[2].get(d)
+            if child is None:
+                node[2][d] = [h, {key}, {}]
+                return
+            node = child
+
+    def discard(self, h: int, key: str):
+        node = self._root
+        while node is not None:
+            d = _hamming(h, node[0])
+            if d == 0:
+                if key in node[1]:
+                    node[1].discard(key)
+                    self._size -= 1
+                return
+            node = node[2].get(d)
+
+    def search(self, h: int, radius: int) -> list[tuple[int, int, str]]:
+        """返回 [(距离, hash, key)]，按距离升序。"""
+        out: list[tuple[int, int, str]] = []
+        if self._root is None:
+            return out
+        stack = [self._root]
+        while stack:
+            node = stack.pop()
+            d = _hamming(h, node[0])
+            if d <= radius:
+                for key in node[1]:
+                    out.append((d, node[0], key))
+            lo, hi = d - radius, d + radius
+            for cd, child in node[2].items():
+                if lo <= cd <= hi:
+                    stack.append(child)
+        out.sort()
+        return out
+
+
+class ImageDupIndex:
+    """BKTree + 时间窗口，内容与 Redis ZSET 增量同步。
+
+    query / add 会访问 Redis，listener 经 asyncio.to_thread 调用，可能多个线程同时进来：用锁串行化。
+    """
+
+    def __init__(self, r):
+        self._r = r
+        self._tree = BKTree()
+        self._entries: dict[str, tuple[int, float]] = {}  # key -> (hash, ts)
+        self._order: collections.deque = collections.deque()  # (ts, key)，按时间先后
+        self._dead = 0
+        self._synced_at = 0.0
+        self._lock = threading.Lock()
+        self._load()
+
+    def _load(self):
+        try:
+            self._r.zremrangebyscore(REDIS_KEY, "-inf", time.time() - IMAGE_DUP_WINDOW_SECONDS)
+            self._sync(raise_errors=True)
+            _log("INFO", f"📚 图片指纹索引已加载：{len(self._entries)} 条")
+        except Exception as e:
+            _log("WARN", f"⚠️ 图片指纹索引加载失败，使用空索引：{e}")
+
+    def _sync(self, raise_errors: bool = False):
+        """拉取上次同步之后新登记的指纹（worker 发布成功后写入）。"""
+        since = max(self._synced_at - _SYNC_OVERLAP_SECONDS, time.time() - IMAGE_DUP_WINDOW_SECONDS)
+        try:
+            items = self._r.zrangebyscore(REDIS_KEY, since, "+inf", withscores=True)
+        except Exception:
+            if raise_errors:
+                raise
+            return
+        for member, score in items:
+            h_hex, _, key = member.partition(":")
+            score = float(score)
+            old = self._entries.get(key)
+            if old is None or old[1] != score:
+                self._add_local(key, int(h_hex, 16), score)
+            self._synced_at = max(self._synced_at, score)
+
+    def _add_local(self, key: str, h: int, ts: float):
+        old = self._entries.get(key)
+        if old is not None:
+            self._tree.discard(old[0], key)
+            self._dead += 1
+        self._entries[key] = (h, ts)
+        self._order.append((ts, key))
+        self._tree.add(h, key)
+
+    def _expire(self):
+        cutoff = time.time() - IMAGE_DUP_WINDOW_SECONDS
+        while self._order and self._order[0][0] < cutoff:
+            ts, k = self._order.popleft()
+            entry = self._entries.get(k)
+            # 被重复登记过的 key 以最新时间戳为准
+            if entry is not None and entry[1] == ts:
+                del self._entries[k]
+                self._tree.discard(entry[0], k)
+                self._dead += 1
+        # 墓碑过半：重建，保持树的查询效率
+        if self._dead > max(len(self._entries), 64):
+            tree = BKTree()
+            for k, (h, _) in self._entries.items():
+                tree.add(h, k)
+            self._tree = tree
+            self._dead = 0
+
+    def query(self, h: int) -> tuple[str, int, int] | None:
+        """返回最近的 (key, hash, 距离)；窗口内无 ≤ max_distance 的则返回 None。"""
+        if not IMAGE_DUP_ENABLED:
+            return None
+        with self._lock:
+            self._sync()
+            self._expire()
+            hits = self._tree.search(h, IMAGE_DUP_MAX_DISTANCE)
+        if not hits:
+            return None
+        d, hh, key = hits[0]
+        return key, hh, d
+
+    def add(self, key: str, h: int):
+        if not IMAGE_DUP_ENABLED:
+            return
+        ts = record(self._r, key, f"{h:016x}")
+        with self._lock:
+            self._add_local(key, h, ts)
+
+
+def record(r, key: str, phash: str | None) -> float:
+    """登记一张已发布的图片（worker 发布成功后调用），顺带按窗口修剪 ZSET；返回登记时间。"""
+    now = time.time()
+    if not IMAGE_DUP_ENABLED or not phash:
+        return now
+    try:
+        pipe = r.pipeline()
+        pipe.zadd(REDIS_KEY, {f"{phash}:{key}": now})
+        pipe.zremrangebyscore(REDIS_KEY, "-inf", now - IMAGE_DUP_WINDOW_SECONDS)
+        pipe.execute()
+    except Exception as e:
+        _log("WARN", f"⚠️ 图片指纹持久化失败：{e}")
+    return now
+
+
+# ── 上传缓存（worker 使用）──────────────────────────────────────
+
+def cached_upload_url(r, phash: str | None) -> str | None:
+    if not phash:
+        return None
+    try:
+        return r.get(URL_CACHE_PREFIX + phash) or None
+    except Exception:
+        return None
+
+
+def remember_upload_url(r, phash: str | None, url: str):
+    if not phash or not url:
+        return
+    try:
+        r.set(URL_CACHE_PREFIX + phash, url, ex=UPLOAD_CACHE_TTL_SECONDS)
+    except Exception:
+        pass
@@ -0,0 +1,413 @@
+"""
+图床路由：imgbb / QQ CDN / 本地自建，按健康度择优，必要时对冲（hedge）。
+
+以前固定先 imgbb（30s 超时）再 QQ CDN（30s 超时），imgbb 一降级每张图就多等 30s。这里：
+
+- 每个图床一个 ImageHost 实现，统一 upload(path, channel_id) -> URL（失败抛异常）
+- 滚动统计：最近 image_hosts.window 次上传的成功率与耗时（p50 / p90）
+- 择优：按 成功率 / (1 + p50 秒数 / 10) 打分，分数高的先上；没有样本的按乐观先验。
+  消耗配额的图床（QQ CDN）永远排在不耗配额的图床之后，分数只在组内比较
+- 熔断：连续失败 image_hosts.breaker_failures 次 → 断开 breaker_cooldown_seconds，
+  期间直接跳过，不再白等超时；冷却结束放行一次试探（半开）
+- 对冲：首选图床超过其 p90 耗时仍未返回，就并行启动下一个图床，先成功者胜出。
+  QQ CDN 上传会消耗消息配额并产生空消息，默认不作为对冲目标（image_hosts.hedge_to_qq_cdn）
+- 流式上传：请求体由 _MultipartBody 按块从磁盘读出，不再整张读进内存再 base64 一遍；
+  只接受 base64 文本的图床用 _base64_form_chunks 分块编码（单块上限 _CHUNK_BYTES）
+"""
+
+import base64
+import io
+import os
+import shutil
+import threading
+import time
+import uuid
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import requests
+
+from config import get as cfg_get
+from log import get_logger
+from qq_auth import auth_headers
+import metrics
+import quota
+
+BOT_API_BASE = str(cfg_get("qq.api_base", "https://api.sgroup.qq.com")).rstrip("/")
+
+HOST_ORDER = [str(h).strip() for h in (cfg_get("image_hosts.order") or ["imgbb", "qq_cdn", "local"])]
+
+try:
+    WINDOW = max(int(cfg_get("image_hosts.window", 50)), 5)
+except Exception:
+    WINDOW = 50
+try:
+    BREAKER_FAILURES = max(int(cfg_get("image_hosts.breaker_failures", 3)), 1)
+except Exception:
+    BREAKER_FAILURES = 3
+try:
+    BREAKER_COOLDOWN_SECONDS = float(cfg_get("image_hosts.breaker_cooldown_seconds", 120))
+except Exception:
+    BREAKER_COOLDOWN_SECONDS = 120.0
+try:
+    UPLOAD_TIMEOUT_SECONDS = float(cfg_get("image_hosts.timeout_seconds", 30))
+except Exception:
+    UPLOAD_TIMEOUT_SECONDS = 30.0
+
+HEDGE_ENABLED = bool(cfg_get("image_hosts.hedge", True))
+HEDGE_TO_QQ_CDN = bool(cfg_get("image_hosts.hedge_to_qq_cdn", False))
+# 对冲延迟下限（秒）：样本不足时用它
+try:
+    HEDGE_MIN_DELAY_SECONDS = float(cfg_get("image_hosts.hedge_min_delay_seconds", 2))
+except Exception:
+    HEDGE_MIN_DELAY_SECONDS = 2.0
+
+# 流式读取 / 分块 base64 的块大小（3 的倍数，base64 分块拼接后与整体编码一致）
+_CHUNK_BYTES = 48 * 1024
+
+_log = get_logger("imghost")
+
+
+class _MultipartBody:
+    """multipart/form-data 流式请求体。
+
+    文本字段与分隔符放在内存里，文件部分按块从磁盘读；实现 read() + __len__，
+    requests 会带上 Content-Length 并按块发送，峰值内存与图片大小无关。
+    每次上传新建一个（可读一次），用完 close()。
+    """
+
+    def __init__(self, fields: dict, file_field: str, path: str, content_type: str = "image/jpeg"):
+        boundary = uuid.uuid4().hex
+        self.content_type = f"multipart/form-data; boundary={boundary}"
+        head = b"".join(
+            f'--{boundary}\r\nContent-Disposition: form-data; name="{k}"\r\n\r\n{v}\r\n'.encode("utf-8")
+            for k, v in fields.items()
+        )
+        filename = os.path.basename(path) or "image.jpg"
+        head += (
+            f'--{boundary}\r\nContent-Disposition: form-data; name="{file_field}"; filename="{filename}"\r\n'
+            f"Content-Type: {content_type}\r\n\r\n"
+        ).encode("utf-8")
+        tail = f"\r\n--{boundary}--\r\n".encode("ascii")
+        self._len = len(head) + os.path.getsize(path) + len(tail)
+        self._segments = [io.BytesIO(head), open(path, "rb"), io.BytesIO(tail)]
+
+    def __len__(self) -> int:
+        return self._len
+
+    def read(self, size: int = -1) -> bytes:
+        if size is None or size < 0:
+            size = self._len
+        out = bytearray()
+        while self._segments and len(out) < size:
+            chunk = self._segments[0].read(min(size - len(out), _CHUNK_BYTES))
+            if chunk:
+                out += chunk
+            else:
+                self._segments.pop(0).close()
+        return bytes(out)
+
+    def close(self):
+        for seg in self._segments:
+            seg.close()
+        self._segments = []
+
+
+def _base64_form_chunks(fields: dict, file_field: str, path: str):
+    """application/x-www-form-urlencoded 请求体生成器：文件字段按块 base64 + URL 编码。
+
+    长度事先未知，requests 以 chunked 方式发送；内存里同时只有一块。
+    """
+    from urllib.parse import quote, urlencode
+
+    prefix = urlencode(fields)
+    yield f"{prefix}{'&' if prefix else ''}{file_field}=".encode("ascii")
+    with open(path, "rb") as f:
+        while True:
+            raw = f.read(_CHUNK_BYTES)
+            if not raw:
+                break
+            yield quote(base64.b64encode(raw), safe="").encode("ascii")
+
+
+class ImageHost:
+    """图床接口：upload 成功返回公开 URL，失败抛异常。"""
+
+    name = ""
+    # 作为对冲目标是否安全（无副作用、不耗配额）
+    hedgeable = True
+    # 是否消耗 QQ 消息配额（upload 服务预上传时默认不用这类图床）
+    consumes_quota = False
+
+    def available(self) -> bool:
+        return True
+
+    def upload(self, path: str, channel_id: str, source: str = "") -> str:
+        raise NotImplementedError
+
+
+class ImgbbHost(ImageHost):
+    """imgbb 图床（需要 qq.imgbb_api_key；不消耗 QQ API 配额，无副作用）。
+
+    image 字段直接接受二进制文件，默认 multipart 流式上传；
+    image_hosts.imgbb.multipart: false 时退回分块 base64 表单。
+    """
+
+    name = "imgbb"
+    _API = "https://api.imgbb.com/1/upload"
+
+    def __init__(self):
+        self.api_key = str(cfg_get("qq.imgbb_api_key", "")).strip()
+        self.multipart = bool(cfg_get("image_hosts.imgbb.multipart", True))
+
+    def available(self) -> bool:
+        return bool(self.api_key)
+
+    def upload(self, path: str, channel_id: str, source: str = "") -> str:
+        if self.multipart:
+            body = _MultipartBody({"key": self.api_key}, "image", path)
+            try:
+                resp = requests.post(
+                    self._API,
+                    data=body,
+                    headers={"Content-Type": body.content_type},
+                    timeout=UPLOAD_TIMEOUT_SECONDS,
+                )
+            finally:
+                body.close()
+        else:
+            resp = requests.post(
+                self._API,
+                data=_base64_form_chunks({"key": self.api_key}, "image", path),
+                headers={"Content-Type": "application/x-www-form-urlencoded"},
+                timeout=UPLOAD_TIMEOUT_SECONDS,
+            )
+        if not resp.ok:
+            raise RuntimeError(f"imgbb status={resp.status_code} body={resp.text[:200]}")
+        data = resp.json().get("data", {})
+        url = data.get("url") or data.get("display_url") or ""
+        if not url:
+            raise RuntimeError("imgbb response without url")
+        return url
+
+
+class QQCdnHost(ImageHost):
+    """POST /channels/{channel_id}/messages 上传 file_image（消耗 QQ 消息配额，记入账本 upload）。"""
+
+    name = "qq_cdn"
+    hedgeable = HEDGE_TO_QQ_CDN
+    consumes_quota = True
+
+    def __init__(self, r):
+        self._r = r
+
+    def upload(self, path: str, channel_id: str, source: str = "") -> str:
+        if not channel_id:
+            raise RuntimeError("qq_cdn requires channel_id")
+        # requests 的 files= 会把整个文件读进内存拼 multipart，这里改为流式请求体
+        body = _MultipartBody({"content": " "}, "file_image", path)  # content 最少需要一个字符
+        try:
+            resp = requests.post(
+                f"{BOT_API_BASE}/channels/{channel_id}/messages",
+                headers={**auth_headers(), "Content-Type": body.content_type},
+                data=body,
+                timeout=UPLOAD_TIMEOUT_SECONDS,
+            )
+        finally:
+            body.close()
+        _log("DEBUG", f"🖼️ 图片上传(QQ CDN) status={resp.status_code} body={resp.text[:200]}")
+        if not resp.ok:
+            raise RuntimeError(f"qq_cdn status={resp.status_code}")
+        quota.record(self._r, source, "upload")
+        attachments = (resp.json() or {}).get("attachments") or []
+        url = (attachments[0].get("url") or "") if attachments and isinstance(attachments, list) else ""
+        if not url:
+            raise RuntimeError("qq_cdn response without attachment url")
+        return url if url.startswith("http") else "https://" + url
+
+
+class LocalHost(ImageHost):
+    """自建静态目录：复制到 image_hosts.local.dir，由 nginx 等按 base_url 对外提供。"""
+
+    name = "local"
+
+    def __init__(self):
+        self.dir = str(cfg_get("image_hosts.local.dir", "") or "").rstrip("/")
+        self.base_url = str(cfg_get("image_hosts.local.base_url", "") or "").rstrip("/")
+
+    def available(self) -> bool:
+        return bool(self.dir and self.base_url)
+
+    def upload(self, path: str, channel_id: str, source: str = "") -> str:
+        ext = os.path.splitext(path)[1] or ".jpg"
+        name = f"{uuid.uuid4().hex}{ext}"
+        os.makedirs(self.dir, exist_ok=True)
+        tmp = f"{self.dir}/.{name}"
+        shutil.copyfile(path, tmp)
+        os.replace(tmp, f"{self.dir}/{name}")
+        return f"{self.base_url}/{name}"
+
+
+class _HostHealth:
+    """单个图床的滚动统计 + 熔断状态（线程安全）。"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._samples: deque = deque(maxlen=WINDOW)  # (ok, 耗时秒)
+        self._consecutive_failures = 0
+        self._open_until = 0.0
+        self._probing = False
+
+    def record(self, ok: bool, seconds: float):
+        with self._lock:
+            self._samples.append((ok, seconds))
+            self._probing = False
+            if ok:
+                self._consecutive_failures = 0
+                self._open_until = 0.0
+            else:
+                self._consecutive_failures += 1
+                if self._consecutive_failures >= BREAKER_FAILURES:
+                    self._open_until = time.time() + BREAKER_COOLDOWN_SECONDS
+
+    def allow(self) -> bool:
+        """熔断中返回 False；冷却结束后只放行一次试探。"""
+        with self._lock:
+            if not self._open_until:
+                return True
+            if time.time() < self._open_until or self._probing:
+                return False
+            self._probing = True
+            return True
+
+    @property
+    def tripped(self) -> bool:
+        with self._lock:
+            return bool(self._open_until) and time.time() < self._open_until
+
+    def success_rate(self) -> float:
+        with self._lock:
+            if not self._samples:
+                return 1.0  # 乐观先验
+            return sum(1 for ok, _ in self._samples if ok) / len(self._samples)
+
+    def latency(self, pct: float) -> float | None:
+        with self._lock:
+            xs = sorted(s for ok, s in self._samples if ok)
+        if not xs:
+            return None
+        return xs[min(int(len(xs) * pct), len(xs) - 1)]
+
+    def score(self) -> float:
+        p50 = self.latency(0.5)
+        return self.success_rate() / (1.0 + (p50 if p50 is not None else 1.0) / 10.0)
+
+
+class ImageHostRouter:
+    def __init__(self, r):
+        registry = {"imgbb": ImgbbHost(), "qq_cdn": QQCdnHost(r), "local": LocalHost()}
+        self.hosts: list[ImageHost] = [registry[n] for n in HOST_ORDER if n in registry]
+        self._health = {h.name: _HostHealth() for h in self.hosts}
+        # upload 服务会并行调用 upload()，每次最多占两个线程（首选 + 对冲）
+        self._pool = ThreadPoolExecutor(max_workers=8, thread_name_prefix="imghost")
+
+    def _ranked(self, allow_quota: bool = True) -> list[ImageHost]:
+        candidates = [h for h in self.hosts if h.available() and (allow_quota or not h.consumes_quota)]
+        # 消耗配额的图床（QQ CDN：占消息配额、往频道发空消息）只做兜底，排在所有不耗配额的图床之后；
+        # 健康分只在各组内部排序（没有样本的图床先验分偏高，不能让它越过健康的 imgbb）
+        # 同分时保持配置顺序（sorted 稳定）
+        return sorted(candidates, key=lambda h: (h.consumes_quota, -self._health[h.name].score()))
+
+    def _attempt(self, host: ImageHost, path: str, channel_id: str, source: str) -> str:
+        t = time.perf_counter()
+        try:
+            url = host.upload(path, channel_id, source)
+        except Exception as e:
+            self._finish(host, False, time.perf_counter() - t)
+            raise RuntimeError(f"{host.name}: {e}") from e
+        self._finish(host, True, time.perf_counter() - t)
+        return url
+
+    def _finish(self, host: ImageHost, ok: bool, seconds: float):
+        health = self._health[host.name]
+        was_tripped = health.tripped
+        health.record(ok, seconds)
+        metrics.incr("image_upload_total", host=host.name, result="ok" if ok else "error")
+        metrics.set_gauge("image_host_success_rate", round(health.success_rate(), 3), host=host.name)
+        if health.tripped and not was_tripped:
+            _log("WARN", f"🔌 图床 {host.name} 连续失败，熔断 {BREAKER_COOLDOWN_SECONDS:.0f}s")
+        metrics.set_gauge("image_host_open", 1 if health.tripped else 0, host=host.name)
+
+    def _hedge_delay(self, host: ImageHost) -> float:
+        p90 = self._health[host.name].latency(0.9)
+        return min(max(p90 if p90 is not None else HEDGE_MIN_DELAY_SECONDS, HEDGE_MIN_DELAY_SECONDS), UPLOAD_TIMEOUT_SECONDS)
+
+    def _take(self, queue: list[ImageHost], hedge: bool = False) -> ImageHost | None:
+        """取出下一个可用图床（熔断中的跳过；半开的放行一次试探）。"""
+        for host in list(queue):
+            if hedge and not host.hedgeable:
+                continue
+            queue.remove(host)
+            if self._health[host.name].allow():
+                return host
+        return None
+
+    def upload(self, path: str, channel_id: str = "", source: str = "", allow_quota: bool = True) -> str | None:
+        """按健康度依次尝试；首选慢于其 p90 时对冲下一个可对冲的图床。全部失败返回 None。
+
+        allow_quota=False 时跳过消耗 QQ 配额的图床（QQ CDN）。
+        """
+        queue = self._ranked(allow_quota)
+        errors: list[str] = []
+        running: dict = {}
+        while True:
+            if not running:
+                host = self._take(queue)
+                if host is None:
+                    break
+                running[self._pool.submit(self._attempt, host, path, channel_id, source)] = host
+
+            timeout = None
+            if HEDGE_ENABLED and len(running) == 1 and any(h.hedgeable for h in queue):
+                timeout = self._hedge_delay(next(iter(running.values())))
+
+            done, _ = wait(list(running), timeout=timeout, return_when=FIRST_COMPLETED)
+            if not done:
+                # 首选超过 p90 仍未返回：并行启动下一个可对冲的图床
+                backup = self._take(queue, hedge=True)
+                if backup is not None:
+                    primary = next(iter(running.values()))
+                    _log("INFO", f"🏁 图床 {primary.name} 慢于 p90（{timeout:.1f}s），对冲 {backup.name}", event="image_hedge")
+                    metrics.incr("image_upload_hedged_total", host=backup.name)
+                    running[self._pool.submit(self._attempt, backup, path, channel_id, source)] = backup
+                continue
+
+            for fut in done:
+                host = running.pop(fut)
+                try:
+                    url = fut.result()
+                except Exception as e:
+                    errors.append(str(e))
+                    continue
+                _log("INFO", f"🖼️ 图片已上传 {host.name}：{url}", event="image_uploaded")
+                # 落后的那个请求无法取消，结果直接丢弃
+                return url
+
+        if errors:
+            _log("WARN", f"⚠️ 所有图床上传失败：{'; '.join(errors)}")
+        else:
+            _log("WARN", "⚠️ 没有可用图床（全部熔断或未配置）")
+        return None
+
+    def snapshot(self) -> dict:
+        out = {}
+        for h in self.hosts:
+            health = self._health[h.name]
+            out[h.name] = {
+                "available": h.available(),
+                "success_rate": round(health.success_rate(), 3),
+                "p50_seconds": health.latency(0.5),
+                "p90_seconds": health.latency(0.9),
+                "tripped": health.tripped,
+            }
+        return out
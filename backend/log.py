@@ -0,0 +1,195 @@
+"""
+统一日志：listen / publish / qq_ws 等进程共用。
+
+以前各模块各自 print(time.strftime(...))，在热路径上同步写 stdout（经 supervisord 转发），
+debug_tg_events 打开时每条消息好几行，日志量大时会拖慢事件循环和 worker。这里：
+
+- 非阻塞：调用方只把 LogRecord 放进有界队列（QueueHandler），由后台 QueueListener 线程写 stdout；
+  队列满时直接丢弃并计数，绝不阻塞业务
+- 格式：logging.format = text（默认，与旧的 [时间] 组件 | 等级 | 消息 一致，附加字段以 k=v 接在行尾）/
+  json（一行一个 JSON 对象，需要采集时再打开）
+- 等级：logging.level（DEBUG / INFO / WARN / ERROR）
+- 采样：logging.sample = {事件名: 比例}，如 tg_event: 0.1 只输出 10%
+- 限流：只针对指定了事件名的行（高频事件都带 event），每个事件名每分钟最多 logging.rate_limit_per_minute 条；
+  被压掉的条数附在该事件下一条输出里（suppressed），累计总数附在之后每一行（log_suppressed_total）；
+  不带 event 的普通日志不限流
+
+用法：
+    from log import get_logger
+    _log = get_logger("publish")
+    _log("INFO", "✅ 发送成功", event="publish_ok", chat_id=1)
+"""
+
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import sys
+import threading
+import time
+
+from config import get as cfg_get
+
+_LEVELS = {
+    "DEBUG": logging.DEBUG,
+    "INFO": logging.INFO,
+    "WARN": logging.WARNING,
+    "WARNING": logging.WARNING,
+    "ERROR": logging.ERROR,
+}
+
+LOG_LEVEL = _LEVELS.get(str(cfg_get("logging.level", "INFO")).strip().upper(), logging.INFO)
+LOG_FORMAT = str(cfg_get("logging.format", "text")).strip().lower()
+
+try:
+    RATE_LIMIT_PER_MINUTE = max(int(cfg_get("logging.rate_limit_per_minute", 120)), 0)
+except Exception:
+    RATE_LIMIT_PER_MINUTE = 120
+
+SAMPLE_RATES: dict[str, float] = {}
+for _k, _v in (cfg_get("logging.sample") or {}).items():
+    try:
+        SAMPLE_RATES[str(_k)] = min(max(float(_v), 0.0), 1.0)
+    except Exception:
+        pass
+
+_QUEUE_SIZE = 10000
+
+_setup_lock = threading.Lock()
+_listener: logging.handlers.QueueListener | None = None
+_dropped = 0
+_suppressed_total = 0
+
+
+class _JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        out = {
+            "ts": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(record.created))
+            + f".{int(record.msecs):03d}",
+            "level": _short_level(record.levelno),
+            "component": getattr(record, "component", record.name),
+            "msg": record.getMessage(),
+        }
+        out.update(getattr(record, "fields", None) or {})
+        return json.dumps(out, ensure_ascii=False, default=str)
+
+
+class _TextFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        ts = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(record.created))
+        component = getattr(record, "component", record.name)
+        line = f"[{ts}] {component:8s} | {_short_level(record.levelno):5s} | {record.getMessage()}"
+        fields = getattr(record, "fields", None)
+        if fields:
+            line += " " + " ".join(f"{k}={v}" for k, v in fields.items())
+        return line
+
+
+class _DroppingQueueHandler(logging.handlers.QueueHandler):
+    """队列满时丢弃（计数），不阻塞、不打印 handleError 堆栈。"""
+
+    def enqueue(self, record):
+        global _dropped
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            _dropped += 1
+
+    def prepare(self, record):
+        # 格式化在后台线程做；这里只保证 msg 已是字符串，不提前拼接
+        return record
+
+
+def _short_level(levelno: int) -> str:
+    return "WARN" if levelno == logging.WARNING else logging.getLevelName(levelno)
+
+
+def _ensure_setup() -> logging.Logger:
+    global _listener
+    root = logging.getLogger("tg2qq")
+    if _listener is not None:
+        return root
+    with _setup_lock:
+        if _listener is not None:
+            return root
+        stream = logging.StreamHandler(sys.stdout)
+        stream.setFormatter(_JsonFormatter() if LOG_FORMAT == "json" else _TextFormatter())
+        q: queue.Queue = queue.Queue(maxsize=_QUEUE_SIZE)
+        root.handlers[:] = [_DroppingQueueHandler(q)]
+        root.setLevel(LOG_LEVEL)
+        root.propagate = False
+        _listener = logging.handlers.QueueListener(q, stream, respect_handler_level=False)
+        _listener.start()
+        atexit.register(_listener.stop)  # 退出前把队列里剩下的写完
+    return root
+
+
+class _RateLimiter:
+    """每个 key 固定窗口计数（1 分钟）。"""
+
+    def __init__(self, per_minute: int):
+        self._per_minute = per_minute
+        self._lock = threading.Lock()
+        self._windows: dict[str, list] = {}  # key -> [窗口起点, 已输出, 已压掉]
+
+    def admit(self, key: str) -> tuple[bool, int]:
+        """返回 (是否输出, 之前被压掉的条数)。"""
+        global _suppressed_total
+        if self._per_minute <= 0:
+            return True, 0
+        now = time.monotonic()
+        with self._lock:
+            w = self._windows.get(key)
+            if w is None or now - w[0] >= 60.0:
+                suppressed = w[2] if w else 0
+                self._windows[key] = [now, 1, 0]
+                return True, suppressed
+            if w[1] < self._per_minute:
+                w[1] += 1
+                return True, 0
+            w[2] += 1
+            _suppressed_total += 1
+            return False, 0
+
+
+_limiter = _RateLimiter(RATE_LIMIT_PER_MINUTE)
+
+
+class Logger:
+    """组件日志器；调用方式与旧的 _log(level, msg) 一致。"""
+
+    __slots__ = ("component", "_logger")
+
+    def __init__(self, component: str):
+        self.component = component
+        self._logger = _ensure_setup()
+
+    def __call__(self, level: str, msg: str, event: str | None = None, **fields):
+        levelno = _LEVELS.get(level.upper(), logging.INFO)
+        if levelno < LOG_LEVEL:
+            return
+
+        if event is not None:
+            rate = SAMPLE_RATES.get(event)
+            if rate is not None and random.random() >= rate:
+                return
+
+        if event is not None:
+            ok, suppressed = _limiter.admit(event)
+            if not ok:
+                return
+            if suppressed:
+                fields["suppressed"] = suppressed
+            fields["event"] = event
+
+        if _dropped:
+            fields["log_dropped_total"] = _dropped
+        if _suppressed_total:
+            fields["log_suppressed_total"] = _suppressed_total
+        self._logger.log(levelno, msg, extra={"component": self.component, "fields": fields})
+
+
+def get_logger(component: str) -> Logger:
+    return Logger(component)
@@ -0,0 +1,124 @@
+"""
+跨进程运行指标（Redis 存储，Prometheus 文本格式输出）。
+
+worker / keepalive 等后台进程写入，listen 进程的 GET /metrics 统一输出：
+- gauge：metrics:gauges 哈希，字段 = 'name{label="v"}'，值 = 最新值
+- counter：metrics:counters 哈希，HINCRBYFLOAT 累加
+- incr_many / max_many：批量写入（一次 pipeline），热路径先在进程内聚合再定期刷写时用
+
+写入失败一律忽略：指标永远不能影响业务路径。
+"""
+
+import os
+
+import redis
+
+_GAUGES_KEY = "metrics:gauges"
+_COUNTERS_KEY = "metrics:counters"
+
+_r = redis.Redis(host=os.getenv("REDIS_HOST"), decode_responses=True)
+
+
+def _series(name: str, labels: dict) -> str:
+    if not labels:
+        return name
+    inner = ",".join(f'{k}="{str(v)}"' for k, v in sorted(labels.items()))
+    return f"{name}{{{inner}}}"
+
+
+def set_gauge(name: str, value: float, **labels):
+    try:
+        _r.hset(_GAUGES_KEY, _series(name, labels), float(value))
+    except Exception:
+        pass
+
+
+def incr(name: str, n: float = 1, **labels):
+    try:
+        _r.hincrbyfloat(_COUNTERS_KEY, _series(name, labels), n)
+    except Exception:
+        pass
+
+
+# gauge 只增不减（最大值类指标）
+_MAX_LUA = """
+local cur = tonumber(redis.call('hget', KEYS[1], ARGV[1]) or '0')
+if tonumber(ARGV[2]) > cur then
+    redis.call('hset', KEYS[1], ARGV[1], ARGV[2])
+end
+return 0
+"""
+
+
+def incr_many(items: list[tuple[str, float, dict]]):
+    """批量累加 counter：[(name, n, labels), ...]。"""
+    if not items:
+        return
+    try:
+        pipe = _r.pipeline(transaction=False)
+        for name, n, labels in items:
+            pipe.hincrbyfloat(_COUNTERS_KEY, _series(name, labels), n)
+        pipe.execute()
+    except Exception:
+        pass
+
+
+def max_many(items: list[tuple[str, float, dict]]):
+    """批量更新最大值 gauge：[(name, value, labels), ...]，只在新值更大时写入。"""
+    if not items:
+        return
+    try:
+        pipe = _r.pipeline(transaction=False)
+        for name, value, labels in items:
+            pipe.eval(_MAX_LUA, 1, _GAUGES_KEY, _series(name, labels), float(value))
+        pipe.execute()
+    except Exception:
+        pass
+
+
+def delete_series(prefixes: tuple[str, ...]):
+    """删除名字以 prefixes 开头的所有 series（重置某类指标）。"""
+    try:
+        for key in (_GAUGES_KEY, _COUNTERS_KEY):
+            fields = [f for f in _r.hkeys(key) if f.startswith(prefixes)]
+            if fields:
+                _r.hdel(key, *fields)
+    except Exception:
+        pass
+
+
+def snapshot() -> dict:
+    try:
+        gauges = _r.hgetall(_GAUGES_KEY) or {}
+        counters = _r.hgetall(_COUNTERS_KEY) or {}
+    except Exception:
+        gauges, counters = {}, {}
+    return {"gauges": gauges, "counters": counters}
+
+
+async def snapshot_async(ar) -> dict:
+    """snapshot() 的异步版（listen 的管理 API 用，ar 为 redis.asyncio 客户端）。"""
+    try:
+        async with ar.pipeline(transaction=False) as pipe:
+            pipe.hgetall(_GAUGES_KEY)
+            pipe.hgetall(_COUNTERS_KEY)
+            gauges, counters = await pipe.execute()
+    except Exception:
+        gauges, counters = {}, {}
+    return {"gauges": gauges or {}, "counters": counters or {}}
+
+
+def render_prometheus(snap: dict | None = None) -> str:
+    """Prometheus 文本暴露格式；snap 缺省时同步读取（异步调用方先 await snapshot_async 再传入）。"""
+    if snap is None:
+        snap = snapshot()
+    lines: list[str] = []
+    for kind, series in (("gauge", snap["gauges"]), ("counter", snap["counters"])):
+        seen: set[str] = set()
+        for key in sorted(series):
+            name = key.split("{", 1)[0]
+            if name not in seen:
+                lines.append(f"# TYPE {name} {kind}")
+                seen.add(name)
+            lines.append(f"{key} {series[key]}")
+    return "\n".join(lines) + "\n"
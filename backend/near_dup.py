@@ -0,0 +1,215 @@
+"""
+跨源近似重复检测（SimHash + LSH 分段索引）。
+
+多个 TG 源经常用略有不同的文案转发同一条影视更新。这里对清洗后的正文
+计算 64 位 SimHash，汉明距离 ≤ max_distance 视为近似重复。
+
+只认跨源重复：
+- 同一 chat_id 的帖子互不比对（同一频道的连载更新文案高度相似，不是重复）
+- 正文里的数字序列（集数、季数、日期）不同 → 不算重复："更新至12集" 与 "更新至13集"
+  指纹距离只有 2，但显然是两条帖子
+
+索引：
+- 鸽笼原理：64 位切成 (max_distance + 1) 段，两指纹距离 ≤ k 时至少有一段完全相同
+- 每段一个 dict：段值 → 条目 id 集合；查询只比对候选，万级条目下也是亚毫秒
+- 滑动时间窗口：超过 window_hours 的条目从内存和 Redis 中淘汰
+- 持久化：Redis ZSET（member = "指纹:数字签名:chat_id:msg_id"，score = 时间戳），
+  worker 重启后从 Redis 重建内存索引（旧格式 "指纹:chat_id:msg_id" 照常可读，没有数字签名）
+"""
+
+import collections
+import hashlib
+import re
+import time
+
+from config import get as cfg_get
+from log import get_logger
+
+REDIS_KEY = "neardup:sigs"
+
+NEAR_DUP_ENABLED = bool(cfg_get("dedup.near_dup.enabled", True))
+# 判定为近似重复的最大汉明距离（64 位指纹）
+NEAR_DUP_MAX_DISTANCE = max(int(cfg_get("dedup.near_dup.max_distance", 6)), 0)
+# 滑动窗口（小时）
+NEAR_DUP_WINDOW_SECONDS = float(cfg_get("dedup.near_dup.window_hours", 24)) * 3600
+# 命中后的动作：skip（不发送，记为已处理）/ flag（照常发送，仅记录日志）
+NEAR_DUP_ACTION = str(cfg_get("dedup.near_dup.action", "flag")).strip().lower()
+# 少于该字数的正文不参与检测（短文本指纹不稳定，容易误判）
+NEAR_DUP_MIN_CHARS = int(cfg_get("dedup.near_dup.min_chars", 20))
+
+_SHINGLE = 2
+_RE_NOISE = re.compile(r"[\s\W_]+", re.UNICODE)
+_RE_NUMBER = re.compile(r"\d+")
+
+
+_log = get_logger("neardup")
+
+
+def _features(text: str) -> collections.Counter:
+    """字符 2-gram（中文无需分词），去掉空白与标点，降低排版差异的影响。"""
+    t = _RE_NOISE.sub("", (text or "").lower())
+    if len(t) <= _SHINGLE:
+        return collections.Counter([t]) if t else collections.Counter()
+    return collections.Counter(t[i:i + _SHINGLE] for i in range(len(t) - _SHINGLE + 1))
+
+
+def simhash(text: str) -> int:
+    """64 位 SimHash；特征权重 = 出现次数。"""
+    weights = [0] * 64
+    for gram, w in _features(text).items():
+        h = int.from_bytes(hashlib.blake2b(gram.encode("utf-8"), digest_size=8).digest(), "big")
+        for bit in range(64):
+            if (h >> bit) & 1:
+                weights[bit] += w
+            else:
+                weights[bit] -= w
+    fp = 0
+    for bit in range(64):
+        if weights[bit] > 0:
+            fp |= 1 << bit
+    return fp
+
+
+def number_signature(text: str) -> str:
+    """正文里数字序列（按出现顺序）的短签名；数字不同的两条正文不视为重复。"""
+    nums = "-".join(n.lstrip("0") or "0" for n in _RE_NUMBER.findall(text or ""))
+    return hashlib.blake2b(nums.encode("ascii"), digest_size=4).hexdigest()
+
+
+_NO_NUMBERS = number_signature("")
+
+
+class SimHashIndex:
+    """汉明距离近邻索引（分段 LSH + 时间窗口）。"""
+
+    def __init__(self, max_distance: int = 6, window_seconds: float = 86400):
+        self.max_distance = max_distance
+        self.window_seconds = window_seconds
+        self._bands = max_distance + 1
+        self._band_bits = 64 // self._bands
+        self._tables: list[dict[int, set[str]]] = [dict() for _ in range(self._bands)]
+        self._entries: dict[str, tuple[int, float, object]] = {}  # key -> (fp, ts, meta)
+        self._order: collections.deque = collections.deque()  # (ts, key)，按时间先后
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _band_values(self, fp: int):
+        for i in range(self._bands):
+            shift = i * self._band_bits
+            # 最后一段吃掉剩余位
+            bits = 64 - shift if i == self._bands - 1 else self._band_bits
+            yield i, (fp >> shift) & ((1 << bits) - 1)
+
+    def add(self, key: str, fp: int, ts: float | None = None, meta=None):
+        ts = time.time() if ts is None else ts
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (fp, ts, meta)
+        self._order.append((ts, key))
+        for i, v in self._band_values(fp):
+            self._tables[i].setdefault(v, set()).add(key)
+
+    def _remove(self, key: str):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        for i, v in self._band_values(entry[0]):
+            bucket = self._tables[i].get(v)
+            if bucket:
+                bucket.discard(key)
+                if not bucket:
+                    del self._tables[i][v]
+
+    def expire(self, now: float | None = None) -> int:
+        now = time.time() if now is None else now
+        cutoff = now - self.window_seconds
+        n = 0
+        while self._order and self._order[0][0] < cutoff:
+            ts, key = self._order.popleft()
+            entry = self._entries.get(key)
+            # 被重复 add 过的 key 以最新时间戳为准
+            if entry is not None and entry[1] == ts:
+                self._remove(key)
+                n += 1
+        return n
+
+    def query(self, fp: int, accept=None) -> tuple[str, int] | None:
+        """返回距离最近的 (key, distance)，没有 ≤ max_distance 的则返回 None。
+
+        accept(key, meta) 返回 False 的条目不参与比对。
+        """
+        best: tuple[str, int] | None = None
+        seen: set[str] = set()
+        for i, v in self._band_values(fp):
+            for key in self._tables[i].get(v, ()):
+                if key in seen:
+                    continue
+                seen.add(key)
+                entry = self._entries[key]
+                if accept is not None and not accept(key, entry[2]):
+                    continue
+                d = (entry[0] ^ fp).bit_count()
+                if d <= self.max_distance and (best is None or d < best[1]):
+                    best = (key, d)
+        return best
+
+
+class NearDupDetector:
+    """SimHashIndex + Redis 持久化。Redis 不可用时退化为纯内存索引。"""
+
+    def __init__(self, r):
+        self._r = r
+        self.index = SimHashIndex(NEAR_DUP_MAX_DISTANCE, NEAR_DUP_WINDOW_SECONDS)
+        self._load()
+
+    def _load(self):
+        try:
+            cutoff = time.time() - NEAR_DUP_WINDOW_SECONDS
+            self._r.zremrangebyscore(REDIS_KEY, "-inf", cutoff)
+            for member, score in self._r.zrange(REDIS_KEY, 0, -1, withscores=True):
+                parts = member.split(":")
+                if len(parts) == 4:
+                    fp_hex, nums, key = parts[0], parts[1], f"{parts[2]}:{parts[3]}"
+                else:
+                    fp_hex, _, key = member.partition(":")
+                    nums = None
+                self.index.add(key, int(fp_hex, 16), float(score), nums)
+            _log("INFO", f"📚 近似去重索引已加载：{len(self.index)} 条（窗口 {NEAR_DUP_WINDOW_SECONDS / 3600:.0f}h）")
+        except Exception as e:
+            _log("WARN", f"⚠️ 近似去重索引加载失败，使用空索引：{e}")
+
+    def check(self, text: str, chat_id) -> tuple[tuple[int, str] | None, tuple[str, int] | None]:
+        """返回 (签名, 命中)；签名交给 record()，命中为 (原条目 key, 汉明距离) 或 None。
+
+        只和其他 chat_id、数字序列相同的条目比对。
+        """
+        if not NEAR_DUP_ENABLED or len(text or "") < NEAR_DUP_MIN_CHARS:
+            return None, None
+        fp = simhash(text)
+        nums = number_signature(text)
+        own = f"{chat_id}:"
+
+        def _accept(key: str, meta) -> bool:
+            if key.startswith(own):
+                return False
+            # 旧格式条目没有数字签名：只在本条正文也不含数字时比对
+            return meta == nums or (meta is None and nums == _NO_NUMBERS)
+
+        self.index.expire()
+        return (fp, nums), self.index.query(fp, _accept)
+
+    def record(self, key: str, sig: tuple[int, str] | None):
+        """发送成功后登记指纹（sig 为 check() 返回的签名）。"""
+        if not NEAR_DUP_ENABLED or not sig:
+            return
+        fp, nums = sig
+        now = time.time()
+        self.index.add(key, fp, now, nums)
+        try:
+            pipe = self._r.pipeline()
+            pipe.zadd(REDIS_KEY, {f"{fp:016x}:{nums}:{key}": now})
+            pipe.zremrangebyscore(REDIS_KEY, "-inf", now - NEAR_DUP_WINDOW_SECONDS)
+            pipe.execute()
+        except Exception as e:
+            _log("WARN", f"⚠️ 近似去重指纹持久化失败：{e}")
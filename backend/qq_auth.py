@@ -1,9 +1,14 @@
 import os
+import json
 import time
+import uuid
+import random
 import threading
 import requests
+import redis
 
 from config import get as cfg_get
+from log import get_logger
 
 BOT_API_BASE = str(cfg_get("qq.api_base", "https://api.sgroup.qq.com")).rstrip("/")
 
@@ -16,12 +21,39 @@ MANUAL_ACCESS_TOKEN = str(cfg_get("qq.access_token", "")).strip()
 # 提前多少秒刷新 token
 REFRESH_SKEW_SECONDS = int(cfg_get("qq.access_token_refresh_skew", 60))
 
+# getAppAccessToken 只在过期前约 60s 内才签发新 token，更早调用返回同一个 token 和过期时间
+_QQ_REISSUE_WINDOW_SECONDS = 60
+
+# ── 跨进程共享：listen / worker / keepalive 共用 Redis 里的同一个 token ──
+# qq:token       JSON {token, expires_at, refreshed_at}
+# qq:token:lock  分布式锁（SET NX PX），同一时刻只有一个进程调用 getAppAccessToken
+_REDIS_TOKEN_KEY = "qq:token"
+_REDIS_LOCK_KEY = "qq:token:lock"
+_LOCK_TTL_MS = 20000
+# 未抢到锁时，等待持锁进程写回新 token 的最长时间（秒）
+_LOCK_WAIT_SECONDS = 15.0
+
+_RELEASE_LOCK_LUA = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+_r = redis.Redis(host=os.getenv("REDIS_HOST"), decode_responses=True)
+
 _lock = threading.Lock()
 _cached_token: str | None = None
 _expires_at: float = 0.0
 _last_refresh_error: str | None = None
 _last_refresh_at: float = 0.0
 
+_refresher: threading.Thread | None = None
+_refresher_lock = threading.Lock()
+
+
+_log = get_logger("qq_auth")
+
 
 def _fetch_access_token() -> tuple[str, int]:
     """从 bots.qq.com 获取 access_token。
@@ -48,48 +80,170 @@ def _fetch_access_token() -> tuple[str, int]:
     return token, expires_in
 
 
-def get_access_token(force_refresh: bool = False) -> str:
-    """获取可用 access_token（带轻量缓存与自动刷新）。
+def _read_shared() -> tuple[str | None, float]:
+    try:
+        raw = _r.get(_REDIS_TOKEN_KEY)
+        if not raw:
+            return None, 0.0
+        data = json.loads(raw)
+        return (data.get("token") or None), float(data.get("expires_at") or 0)
+    except Exception:
+        return None, 0.0
+
+
+def _write_shared(token: str, expires_at: float):
+    try:
+        _r.set(
+            _REDIS_TOKEN_KEY,
+            json.dumps({"token": token, "expires_at": expires_at, "refreshed_at": time.time()}),
+            ex=max(int(expires_at - time.time()), 1),
+        )
+    except Exception as e:
+        _log("WARN", f"⚠️ token 写入 Redis 失败（仅本进程可用）：{e}")
+
+
+def _adopt(token: str, expires_at: float):
+    global _cached_token, _expires_at
+    with _lock:
+        if expires_at >= _expires_at or token != _cached_token:
+            _cached_token = token
+            _expires_at = expires_at
+
+
+def _refresh_single_flight(stale_token: str | None) -> str | None:
+    """分布式单飞刷新：抢到锁的进程去拉 token，其余进程等它写回 Redis。
 
-    force_refresh=True 可用于在鉴权失败后强制重新拉取。
+    stale_token：调用方手里已知失效/将过期的 token；Redis 里出现不同的 token 即视为已被他人刷新。
+    返回新 token；失败返回 None（调用方决定是否继续用旧 token）。
     """
-    global _cached_token, _expires_at, _last_refresh_error, _last_refresh_at
+    global _last_refresh_error, _last_refresh_at
+
+    # 别的进程已经刷新过了，直接用
+    shared, shared_exp = _read_shared()
+    if shared and shared != stale_token and time.time() < shared_exp - REFRESH_SKEW_SECONDS:
+        _adopt(shared, shared_exp)
+        return shared
+
+    lock_val = uuid.uuid4().hex
+    try:
+        got_lock = bool(_r.set(_REDIS_LOCK_KEY, lock_val, nx=True, px=_LOCK_TTL_MS))
+    except Exception:
+        got_lock = True  # Redis 不可用：退化为进程内刷新
+
+    if not got_lock:
+        deadline = time.time() + _LOCK_WAIT_SECONDS
+        while time.time() < deadline:
+            time.sleep(0.2)
+            shared, shared_exp = _read_shared()
+            if shared and shared != stale_token:
+                _adopt(shared, shared_exp)
+                return shared
+        return None
+
+    try:
+        now = time.time()
+        token, expires_in = _fetch_access_token()
+        expires_at = now + expires_in
+        _adopt(token, expires_at)
+        _write_shared(token, expires_at)
+        _last_refresh_error = None
+        _last_refresh_at = now
+        return token
+    except Exception as e:
+        _last_refresh_error = str(e)
+        _log("WARN", f"⚠️ access_token 刷新失败：{e}")
+        return None
+    finally:
+        try:
+            _r.eval(_RELEASE_LOCK_LUA, 1, _REDIS_LOCK_KEY, lock_val)
+        except Exception:
+            pass
+
+
+def _refresher_loop():
+    """后台续期：在 expires_at - REFRESH_SKEW_SECONDS 之前主动刷新，请求路径不再等待拉 token。"""
+    while True:
+        try:
+            token, expires_at = _read_shared()
+            if token:
+                _adopt(token, expires_at)
+            with _lock:
+                token, expires_at = _cached_token, _expires_at
+            # 刷新点落在 QQ 的重新签发窗口内（过期前 ≤60s）；
+            # 多进程错开：提前量上再减 0~10s 随机抖动，通常只有一个进程真正去拉
+            lead = min(REFRESH_SKEW_SECONDS, _QQ_REISSUE_WINDOW_SECONDS - 5) - random.uniform(0, 10)
+            refresh_at = expires_at - max(lead, 5)
+            delay = refresh_at - time.time()
+            if token and delay > 0:
+                time.sleep(min(delay, 300))
+                continue
+            new_token = _refresh_single_flight(token)
+            with _lock:
+                extended = _expires_at > expires_at
+            # 失败，或 QQ 返回了同一个 token（还没到签发窗口）：过期时间没变，稍后再试，不要空转
+            if new_token is None or not extended:
+                time.sleep(5)
+        except Exception as e:
+            _log("WARN", f"⚠️ token 后台续期异常：{e}")
+            time.sleep(5)
+
+
+def _ensure_refresher():
+    global _refresher
+    if MANUAL_ACCESS_TOKEN or (_refresher is not None and _refresher.is_alive()):
+        return
+    with _refresher_lock:
+        if _refresher is None or not _refresher.is_alive():
+            _refresher = threading.Thread(target=_refresher_loop, name="qq-token-refresher", daemon=True)
+            _refresher.start()
+
 
+def get_access_token(force_refresh: bool = False) -> str:
+    """获取可用 access_token（进程内缓存 → Redis 共享缓存 → 单飞刷新）。
+
+    - 正常路径只读缓存，续期由后台线程完成，不会阻塞在拉 token 上
+    - 只有完全没有 token（冷启动）时才同步拉取一次
+    - force_refresh=True 用于鉴权失败后：若其他进程已换了新 token 直接复用，否则单飞刷新
+    """
     if MANUAL_ACCESS_TOKEN:
         return MANUAL_ACCESS_TOKEN
 
+    _ensure_refresher()
+
     now = time.time()
     with _lock:
-        if (
-            (not force_refresh)
-            and _cached_token
-            and now < (_expires_at - REFRESH_SKEW_SECONDS)
-        ):
-            return _cached_token
-
-        try:
-            token, expires_in = _fetch_access_token()
-            _cached_token = token
-            _expires_at = now + expires_in
-            _last_refresh_error = None
-            _last_refresh_at = now
-            return _cached_token
-        except Exception as e:
-            _last_refresh_error = str(e)
-            # 若曾经有可用 token，允许继续用旧 token（给重试/恢复留机会）
-            if _cached_token:
-                return _cached_token
-            raise
+        token, expires_at = _cached_token, _expires_at
+
+    if not force_refresh:
+        if token and now < expires_at - REFRESH_SKEW_SECONDS:
+            return token
+        shared, shared_exp = _read_shared()
+        if shared and now < shared_exp:
+            _adopt(shared, shared_exp)
+            return shared
+        # 快过期但仍有效：照常返回，后台线程会续期
+        if token and now < expires_at:
+            return token
+
+    new_token = _refresh_single_flight(token)
+    if new_token:
+        return new_token
+    # 若曾经有可用 token，允许继续用旧 token（给重试/恢复留机会）
+    if token:
+        return token
+    raise RuntimeError(f"access_token unavailable: {_last_refresh_error}")
 
 
 def get_token_status() -> dict:
     """用于日志/排查，不包含 secret。"""
     now = time.time()
+    shared, shared_exp = _read_shared()
     with _lock:
         return {
             "has_manual_token": bool(MANUAL_ACCESS_TOKEN),
             "has_cached_token": bool(_cached_token),
             "expires_in": max(int(_expires_at - now), 0),
+            "shared_expires_in": max(int(shared_exp - now), 0) if shared else 0,
             "last_refresh_at": int(_last_refresh_at) if _last_refresh_at else 0,
             "last_refresh_error": _last_refresh_error,
         }
@@ -0,0 +1,312 @@
+"""
+QQ 频道目录服务：缓存 guild / 子频道列表，统一“可发言频道”选择算法。
+
+worker 启动选频道、/api/qq/* 调试接口都从这里读：
+- 缓存：Redis JSON（qqdir:guilds / qqdir:channels:{guild_id}），TTL = qq.directory_ttl_seconds
+- 过半 TTL 视为陈旧：先返回缓存，同时后台线程刷新（不阻塞调用方）
+- 缓存缺失才会同步拉取一次
+- refresh() 供 POST /api/qq/refresh 显式刷新
+- aget_guilds / aget_channels / arefresh：同样逻辑的异步版本（httpx + redis.asyncio），
+  供 listen 进程里的管理 API 使用，不阻塞 Telethon 所在的事件循环
+"""
+
+import asyncio
+import json
+import os
+import threading
+import time
+
+import redis
+import requests
+
+from config import get as cfg_get
+from log import get_logger
+from qq_auth import auth_headers
+
+BOT_API_BASE = str(cfg_get("qq.api_base", "https://api.sgroup.qq.com")).rstrip("/")
+
+try:
+    DIRECTORY_TTL_SECONDS = max(int(cfg_get("qq.directory_ttl_seconds", 600)), 30)
+except Exception:
+    DIRECTORY_TTL_SECONDS = 600
+
+_GUILDS_KEY = "qqdir:guilds"
+_CHANNELS_KEY = "qqdir:channels:{}"
+
+# 已知可发消息的类型（会因 QQ 频道形态而变化，先覆盖常见）
+PREFERRED_TYPES = [0, 10007, 10011]
+SKIP_TYPES = {4}
+
+r = redis.Redis(host=os.getenv("REDIS_HOST"), decode_responses=True)
+
+_refreshing: set[str] = set()
+_refreshing_lock = threading.Lock()
+
+
+class DirectoryError(Exception):
+    """上游 QQ API 返回非 2xx。"""
+
+    def __init__(self, status_code: int, detail: str):
+        super().__init__(f"status={status_code} body={detail}")
+        self.status_code = status_code
+        self.detail = detail
+
+
+_log = get_logger("qqdir")
+
+
+# ── 选择算法（唯一实现）──────────────────────────────────────────
+
+def extract_channels(data) -> list[dict]:
+    """兼容 list 与 {data|channels|items: [...]} 两种返回形态。"""
+    channels = data
+    if isinstance(data, dict):
+        channels = data.get("data") or data.get("channels") or data.get("items") or []
+    if not isinstance(channels, list):
+        return []
+    return [ch for ch in channels if isinstance(ch, dict)]
+
+
+def _cid(ch: dict) -> str | None:
+    cid = ch.get("id") or ch.get("channel_id")
+    return str(cid) if cid else None
+
+
+def _type_int(ch: dict) -> int | None:
+    try:
+        return int(ch.get("type"))
+    except Exception:
+        return None
+
+
+def _can_speak(ch: dict) -> bool:
+    # speak_permission: 1 表示可发言
+    try:
+        return int(ch.get("speak_permission", 0)) == 1
+    except Exception:
+        return False
+
+
+def pick_channel(channels: list[dict], allow_any: bool = False) -> dict | None:
+    """挑选一个可用的“可发言频道”。
+
+    兼容：
+    - 旧逻辑：type=0（文字）
+    - 新频道形态：type=10007/10011 等
+
+    选择策略：
+    1) 优先选择 speak_permission == 1 且类型优先（0 → 10007 → 10011）
+    2) 次优：类型优先（不强制 speak_permission 字段存在）
+    3) 兜底：任何可发言的频道
+    4) allow_any=True 时最后回退到第一个带 id 的频道
+    跳过分类节点（type=4）。
+    """
+    usable = [ch for ch in channels if _cid(ch) and _type_int(ch) not in SKIP_TYPES]
+
+    for t in PREFERRED_TYPES:
+        for ch in usable:
+            if _type_int(ch) == t and _can_speak(ch):
+                return ch
+
+    for t in PREFERRED_TYPES:
+        for ch in usable:
+            if _type_int(ch) == t:
+                return ch
+
+    for ch in usable:
+        if _can_speak(ch):
+            return ch
+
+    if allow_any:
+        for ch in channels:
+            if _cid(ch):
+                return ch
+    return None
+
+
+# ── 缓存读写 ────────────────────────────────────────────────────
+
+def _fetch(path: str):
+    resp = requests.get(f"{BOT_API_BASE}{path}", headers=auth_headers(), timeout=20)
+    if not resp.ok:
+        raise DirectoryError(resp.status_code, resp.text)
+    return resp.json()
+
+
+def _store(key: str, data):
+    try:
+        r.set(key, json.dumps({"fetched_at": time.time(), "data": data}, ensure_ascii=False), ex=DIRECTORY_TTL_SECONDS)
+    except Exception as e:
+        _log("WARN", f"⚠️ 目录缓存写入失败 key={key} err={e}")
+
+
+def _load(key: str) -> dict | None:
+    try:
+        raw = r.get(key)
+        return json.loads(raw) if raw else None
+    except Exception:
+        return None
+
+
+def _refresh_in_background(key: str, path: str):
+    with _refreshing_lock:
+        if key in _refreshing:
+            return
+        _refreshing.add(key)
+
+    def _run():
+        try:
+            _store(key, _fetch(path))
+        except Exception as e:
+            _log("WARN", f"⚠️ 目录后台刷新失败 path={path} err={e}")
+        finally:
+            with _refreshing_lock:
+                _refreshing.discard(key)
+
+    threading.Thread(target=_run, name="qqdir-refresh", daemon=True).start()
+
+
+def _get_cached(key: str, path: str):
+    cached = _load(key)
+    if cached is not None:
+        if time.time() - float(cached.get("fetched_at", 0)) > DIRECTORY_TTL_SECONDS / 2:
+            _refresh_in_background(key, path)
+        return cached.get("data")
+    data = _fetch(path)
+    _store(key, data)
+    return data
+
+
+def get_guilds():
+    """机器人加入的所有频道（guilds），读缓存。"""
+    return _get_cached(_GUILDS_KEY, "/users/@me/guilds")
+
+
+def get_channels(guild_id: str):
+    """指定 guild 下的所有子频道（原始响应），读缓存。"""
+    return _get_cached(_CHANNELS_KEY.format(guild_id), f"/guilds/{guild_id}/channels")
+
+
+def refresh(guild_id: str | None = None) -> dict:
+    """显式刷新：总是刷新 guild 列表；提供 guild_id 时同时刷新其子频道。"""
+    out = {}
+    guilds = _fetch("/users/@me/guilds")
+    _store(_GUILDS_KEY, guilds)
+    out["guilds"] = len(guilds) if isinstance(guilds, list) else None
+    if guild_id:
+        channels = _fetch(f"/guilds/{guild_id}/channels")
+        _store(_CHANNELS_KEY.format(guild_id), channels)
+        out["channels"] = len(extract_channels(channels))
+    return out
+
+
+# ── 异步版本（管理 API）───────────────────────────────────────────
+# async_clients（httpx / redis.asyncio）按需导入：worker 也导入本模块，但用不到异步版本
+
+async def _afetch(path: str):
+    import async_clients
+
+    # access_token 过期时 auth_headers 会同步刷新，放到线程里
+    headers = await asyncio.to_thread(auth_headers)
+    resp = await async_clients.http().get(f"{BOT_API_BASE}{path}", headers=headers)
+    if not resp.is_success:
+        raise DirectoryError(resp.status_code, resp.text)
+    return resp.json()
+
+
+async def _astore(key: str, data):
+    import async_clients
+
+    try:
+        await async_clients.redis().set(
+            key, json.dumps({"fetched_at": time.time(), "data": data}, ensure_ascii=False), ex=DIRECTORY_TTL_SECONDS
+        )
+    except Exception as e:
+        _log("WARN", f"⚠️ 目录缓存写入失败 key={key} err={e}")
+
+
+async def _aload(key: str) -> dict | None:
+    import async_clients
+
+    try:
+        raw = await async_clients.redis().get(key)
+        return json.loads(raw) if raw else None
+    except Exception:
+        return None
+
+
+async def _arefresh_key(key: str, path: str):
+    try:
+        await _astore(key, await _afetch(path))
+    except Exception as e:
+        _log("WARN", f"⚠️ 目录后台刷新失败 path={path} err={e}")
+    finally:
+        with _refreshing_lock:
+            _refreshing.discard(key)
+
+
+async def _aget_cached(key: str, path: str):
+    cached = await _aload(key)
+    if cached is not None:
+        if time.time() - float(cached.get("fetched_at", 0)) > DIRECTORY_TTL_SECONDS / 2:
+            with _refreshing_lock:
+                stale = key not in _refreshing
+                _refreshing.add(key)
+            if stale:
+                asyncio.ensure_future(_arefresh_key(key, path))
+        return cached.get("data")
+    data = await _afetch(path)
+    await _astore(key, data)
+    return data
+
+
+async def aget_guilds():
+    return await _aget_cached(_GUILDS_KEY, "/users/@me/guilds")
+
+
+async def aget_channels(guild_id: str):
+    return await _aget_cached(_CHANNELS_KEY.format(guild_id), f"/guilds/{guild_id}/channels")
+
+
+async def arefresh(guild_id: str | None = None) -> dict:
+    out = {}
+    guilds = await _afetch("/users/@me/guilds")
+    await _astore(_GUILDS_KEY, guilds)
+    out["guilds"] = len(guilds) if isinstance(guilds, list) else None
+    if guild_id:
+        channels = await _afetch(f"/guilds/{guild_id}/channels")
+        await _astore(_CHANNELS_KEY.format(guild_id), channels)
+        out["channels"] = len(extract_channels(channels))
+    return out
+
+
+def pick_default_channel_id(guild_id: str, allow_any: bool = True) -> str | None:
+    """从缓存的子频道列表里挑选默认发送频道；失败返回 None（不抛异常）。"""
+    if not guild_id:
+        return None
+    try:
+        ch = pick_channel(extract_channels(get_channels(guild_id)), allow_any=allow_any)
+        return _cid(ch) if ch else None
+    except Exception as e:
+        _log("ERROR", f"❌ 频道列表查询异常 guild_id={guild_id} err={e}")
+        return None
+
+
+def start_refresher(guild_ids: list[str]) -> threading.Thread:
+    """后台定期刷新（每 TTL/2 一次），保证读者几乎总能命中新鲜缓存。"""
+
+    def _loop():
+        while True:
+            for gid in [None] + [g for g in guild_ids if g]:
+                try:
+                    if gid is None:
+                        _store(_GUILDS_KEY, _fetch("/users/@me/guilds"))
+                    else:
+                        _store(_CHANNELS_KEY.format(gid), _fetch(f"/guilds/{gid}/channels"))
+                except Exception as e:
+                    _log("WARN", f"⚠️ 目录定期刷新失败 guild_id={gid} err={e}")
+            time.sleep(DIRECTORY_TTL_SECONDS / 2)
+
+    t = threading.Thread(target=_loop, name="qqdir-refresher", daemon=True)
+    t.start()
+    return t
@@ -1,18 +1,26 @@
 import os
 import json
+import asyncio
 import time
+import uuid
+import socket
+import sys
 import threading
+from concurrent.futures import ThreadPoolExecutor
 from typing import Optional
 
+import redis
 import requests
 
 try:
-    import websocket  # websocket-client
+    import websockets
 except Exception as e:  # pragma: no cover
-    websocket = None
+    websockets = None
 
 from qq_auth import get_access_token
 from config import get as cfg_get
+from log import get_logger
+import metrics
 
 BOT_API_BASE = str(cfg_get("qq.api_base", "https://api.sgroup.qq.com")).rstrip("/")
 
@@ -22,9 +30,49 @@ QQ_WS_INTENTS = int(cfg_get("qq.ws_intents", 1))
 QQ_WS_LOG_INTERVAL_SECONDS = int(cfg_get("qq.ws_log_interval_seconds", 60))
 QQ_WS_READY_TIMEOUT_SECONDS = int(cfg_get("qq.ws_ready_timeout_seconds", 20))
 
+# 心跳 ACK(op=11) 超时：心跳间隔的多少比例内没收到 ACK，就判定为僵尸连接并立即重连
+try:
+    QQ_WS_ACK_TIMEOUT_RATIO = min(max(float(cfg_get("qq.ws_ack_timeout_ratio", 0.5)), 0.1), 1.0)
+except Exception:
+    QQ_WS_ACK_TIMEOUT_RATIO = 0.5
+
+# 会话续连：session_id/seq 与 gateway URL 持久化到 Redis，进程重启后也能 Resume(op=6)
+# elect / external：全局只有一条会话，用共享 key（新持有者接管后直接 Resume）
+# local：每个进程各连各的，key 按主机名 + 入口脚本区分（见 _local_session_key）
+_SESSION_KEY = "qq:ws:session"
+# 心跳触发的会话持久化最多每隔多少秒写一次（seq 稍旧只会让 Resume 多补发几条事件）
+_SESSION_SAVE_INTERVAL = 10.0
+_GATEWAY_URL_KEY = "qq:ws:gateway_url"
+_GATEWAY_URL_TTL = 24 * 3600
+
+# 网关连接归属：elect（多个进程通过 Redis 租约选出唯一持有者，默认）
+#              external（本进程从不连 WS，只读共享状态；由独立的 python qq_ws_keepalive.py 持有）
+#              local（每个进程自己连，旧行为）
+QQ_WS_MODE = str(cfg_get("qq.ws_mode", "elect")).strip().lower()
+
+# 租约与共享状态
+_LEASE_KEY = "qq:ws:leader"
+_STATE_KEY = "qq:ws:state"
+_KICK_KEY = "qq:ws:kick"
+_LEASE_TTL_MS = 15000
+_STATE_PUBLISH_INTERVAL = 2.0
+# 共享状态超过多久没更新即视为持有者已失联
+_STATE_STALE_SECONDS = 10.0
+
+_RENEW_LEASE_LUA = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('pexpire', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+_r = redis.Redis(host=os.getenv("REDIS_HOST"), decode_responses=True)
+
+_log = get_logger("qq_ws")
+
 
 def _get_gateway_url() -> tuple[str, dict]:
-    """获取 gateway URL，同时返回 session_start_limit 信息。"""
+    """获取 gateway URL，同时返回 session_start_limit 信息（仅 Identify 前调用）。"""
     resp = requests.get(
         f"{BOT_API_BASE}/gateway/bot",
         headers={"Authorization": f"QQBot {get_access_token()}"},
@@ -36,18 +84,38 @@ def _get_gateway_url() -> tuple[str, dict]:
     if not url:
         raise RuntimeError(f"invalid gateway response: {data}")
     limit = data.get("session_start_limit") or {}
-    ts = time.strftime("%Y-%m-%d %H:%M:%S")
-    print(f"[{ts}] qq_ws    | INFO  | 🌐 Gateway: url={url} shards={data.get('shards')} limit={limit}")
+    _log("INFO", f"🌐 Gateway: url={url} shards={data.get('shards')} limit={limit}")
+    try:
+        _r.set(_GATEWAY_URL_KEY, url, ex=_GATEWAY_URL_TTL)
+    except Exception:
+        pass
     return url, limit
 
 
+def _cached_gateway_url() -> str | None:
+    try:
+        return _r.get(_GATEWAY_URL_KEY) or None
+    except Exception:
+        return None
+
+
+class _ZombieConnection(Exception):
+    """心跳 ACK 超时：连接半开，需要立即重连。"""
+
+
 class QQWsKeepAlive:
-    """最小 WebSocket 在线保活。
+    """最小 WebSocket 在线保活（asyncio 实现，单线程单事件循环）。
 
     目标：满足"发送频道消息要求机器人接口需要连接到 websocket 上保持在线状态"。
     - 连接 gateway
     - 收到 Hello(op=10) 后按 heartbeat_interval 发送心跳(op=1)
     - Identify(op=2) 登录，token 需要 "QQBot {AccessToken}"
+    - 断线/op=7 重连时优先 Resume(op=6)：复用 session_id/seq 与缓存的 gateway URL，
+      不消耗 session_start_limit；只有 op=9（会话失效）才重新 Identify
+
+    线程模型：start() 起一个线程跑事件循环，连接 / 读帧 / 心跳 / 状态日志都是其中的 task，
+    不再每个连接起心跳线程；心跳按 loop.time() 绝对时刻调度，不随处理耗时漂移；
+    stop() 取消主 task 并 join 线程，返回时 socket 已关闭。
 
     保护机制：
     - 连接配额保护：remaining=0 时等待 reset_after 再连
@@ -62,15 +130,19 @@ class QQWsKeepAlive:
     # 熔断后休眠多少秒（默认 30 分钟）
     CIRCUIT_BREAKER_SLEEP = 1800
 
-    def __init__(self):
-        self._stop = threading.Event()
+    def __init__(self, session_key: str = _SESSION_KEY):
         self._thread: Optional[threading.Thread] = None
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._main_task: asyncio.Task | None = None
+        self._stopping = False
 
         self._ws = None
         self._heartbeat_interval = 45.0
         self._last_seq = None
 
+        # 同步调用方（worker 主循环）等 threading.Event；事件循环内部等 asyncio.Event
         self._ready = threading.Event()
+        self._ready_async: asyncio.Event | None = None
         self._last_heartbeat_at: float = 0.0
         self._last_connect_at: float = 0.0
         self._last_error: str | None = None
@@ -79,8 +151,25 @@ class QQWsKeepAlive:
         # 连续失败计数器（每次 READY 成功后归零）
         self._consecutive_failures = 0
 
-        # 每次连接独立的心跳退出信号，防止旧线程用已关闭的 socket 发心跳
-        self._hb_stop: threading.Event = threading.Event()
+        # 外部唤醒信号：打断退避/熔断休眠，立即重连（见 reconnect_now）
+        self._kick: asyncio.Event | None = None
+
+        # 会话续连状态；Redis 写入放在单线程执行器里（不阻塞事件循环，且保持写入先后顺序）
+        self._session_key = session_key
+        self._session_io = ThreadPoolExecutor(max_workers=1, thread_name_prefix="qq-ws-session")
+        self._session_saved_at = 0.0
+        self._session_id: str | None = None
+        self._disconnected_at: float = 0.0
+        self._last_reconnect_ms: float | None = None
+        self._resume_count = 0
+        self._identify_count = 0
+        self._load_session()
+
+        # 心跳 ACK 记账（僵尸连接检测）
+        self._hb_sent_at: float = 0.0
+        self._ack: asyncio.Event | None = None
+        self._heartbeat_rtt_ms: float | None = None
+        self._zombie_count = 0
 
     @property
     def ready(self) -> bool:
@@ -94,37 +183,179 @@ class QQWsKeepAlive:
     def last_heartbeat_at(self) -> float:
         return self._last_heartbeat_at
 
+    @property
+    def last_reconnect_ms(self) -> float | None:
+        """最近一次断线到重新就绪（READY/RESUMED）的耗时（毫秒）。"""
+        return self._last_reconnect_ms
+
+    @property
+    def heartbeat_rtt_ms(self) -> float | None:
+        """最近一次心跳往返时间（op=1 发出 → op=11 ACK，毫秒）。"""
+        return self._heartbeat_rtt_ms
+
+    def _set_ready(self, flag: bool):
+        if flag:
+            self._ready.set()
+            if self._ready_async is not None:
+                self._ready_async.set()
+        else:
+            self._ready.clear()
+            if self._ready_async is not None:
+                self._ready_async.clear()
+
+    def _on_heartbeat_ack(self):
+        if self._ack is not None and not self._ack.is_set() and self._hb_sent_at:
+            self._heartbeat_rtt_ms = (time.time() - self._hb_sent_at) * 1000.0
+            metrics.set_gauge("qq_ws_heartbeat_rtt_ms", round(self._heartbeat_rtt_ms, 1))
+            self._ack.set()
+
+    def _load_session(self):
+        try:
+            raw = _r.get(self._session_key)
+            if raw:
+                data = json.loads(raw)
+                self._session_id = data.get("session_id") or None
+                self._last_seq = data.get("seq")
+        except Exception:
+            pass
+
+    def _save_session(self, debounce: bool = False):
+        """持久化会话（在事件循环里调用，写 Redis 交给 _session_io）；debounce=True 时按 _SESSION_SAVE_INTERVAL 限频。"""
+        now = time.monotonic()
+        if debounce and now - self._session_saved_at < _SESSION_SAVE_INTERVAL:
+            return
+        self._session_saved_at = now
+        data = json.dumps({"session_id": self._session_id, "seq": self._last_seq}) if self._session_id else None
+        try:
+            self._session_io.submit(self._write_session, data)
+        except RuntimeError:
+            pass  # 执行器已关闭（进程退出中）
+
+    def _write_session(self, data: str | None):
+        try:
+            if data:
+                _r.set(self._session_key, data)
+            else:
+                _r.delete(self._session_key)
+        except Exception:
+            pass
+
+    def _clear_session(self):
+        self._session_id = None
+        self._last_seq = None
+        self._save_session()
+
     def wait_until_ready(self, timeout: float | None = None) -> bool:
         timeout = QQ_WS_READY_TIMEOUT_SECONDS if timeout is None else timeout
         return self._ready.wait(timeout=timeout)
 
+    async def wait_ready(self, timeout: float | None = None) -> bool:
+        """wait_until_ready 的协程版本，可在任意事件循环里 await（不占线程）。"""
+        timeout = QQ_WS_READY_TIMEOUT_SECONDS if timeout is None else timeout
+        if self.ready:
+            return True
+        loop = self._loop
+        if loop is None or loop.is_closed():
+            return False
+
+        async def _wait() -> bool:
+            try:
+                await asyncio.wait_for(self._ready_async.wait(), timeout=timeout)
+                return True
+            except asyncio.TimeoutError:
+                return False
+
+        if asyncio.get_running_loop() is loop:
+            return await _wait()
+        return await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(_wait(), loop))
+
     def start(self):
-        if websocket is None:
-            raise RuntimeError("websocket-client not installed")
+        if websockets is None:
+            raise RuntimeError("websockets not installed")
         if self._thread and self._thread.is_alive():
             return
-        self._thread = threading.Thread(target=self._run, name="qq-ws-keepalive", daemon=True)
+        started = threading.Event()
+        self._thread = threading.Thread(target=self._thread_main, args=(started,), name="qq-ws-keepalive", daemon=True)
         self._thread.start()
+        started.wait(timeout=5)
+
+    def stop(self, timeout: float = 5.0):
+        """取消所有 task、关闭 socket，并等待事件循环线程退出。"""
+        self._stopping = True
+        self._set_ready(False)
+        loop, task = self._loop, self._main_task
+        if loop is not None and task is not None and not loop.is_closed():
+            try:
+                loop.call_soon_threadsafe(task.cancel)
+            except RuntimeError:
+                pass
+        if self._thread and self._thread is not threading.current_thread():
+            self._thread.join(timeout=timeout)
+
+    def reconnect_now(self):
+        """打断退避/熔断休眠，立即发起一轮连接（已就绪时无操作）。"""
+        if self.ready or self._loop is None:
+            return
+
+        def _kick():
+            self._consecutive_failures = 0
+            if self._kick is not None:
+                self._kick.set()
 
-    def stop(self):
-        self._stop.set()
-        self._ready.clear()
         try:
-            if self._ws:
-                self._ws.close()
-        except Exception:
+            self._loop.call_soon_threadsafe(_kick)
+        except RuntimeError:
             pass
 
-    def _send(self, payload: dict):
-        if not self._ws:
+    def _thread_main(self, started: threading.Event):
+        loop = asyncio.new_event_loop()
+        self._loop = loop
+        asyncio.set_event_loop(loop)
+        try:
+            self._ready_async = asyncio.Event()
+            self._kick = asyncio.Event()
+            self._ack = asyncio.Event()
+            self._main_task = loop.create_task(self._main())
+            started.set()
+            loop.run_until_complete(self._main_task)
+        except asyncio.CancelledError:
+            pass
+        finally:
+            started.set()
+            try:
+                loop.run_until_complete(loop.shutdown_asyncgens())
+            finally:
+                loop.close()
+
+    async def _main(self):
+        if self._stopping:
+            return
+        log_task = asyncio.create_task(self._log_loop())
+        try:
+            await self._run()
+        finally:
+            log_task.cancel()
+            await asyncio.gather(log_task, return_exceptions=True)
+            self._set_ready(False)
+
+    async def _sleep(self, timeout: float):
+        """可被 reconnect_now() 打断的休眠；stop() 通过取消 task 打断。"""
+        try:
+            await asyncio.wait_for(self._kick.wait(), timeout=max(timeout, 0.0))
+        except asyncio.TimeoutError:
+            pass
+        self._kick.clear()
+
+    async def _send(self, payload: dict):
+        ws = self._ws
+        if ws is None:
             return
-        self._ws.send(json.dumps(payload, ensure_ascii=False))
+        await ws.send(json.dumps(payload, ensure_ascii=False))
 
-    def _identify(self):
-        token = get_access_token()
-        ts = time.strftime("%Y-%m-%d %H:%M:%S")
-        print(f"[{ts}] qq_ws    | INFO  | 🔑 Identify: intents={QQ_WS_INTENTS} token={token[:8]}...{token[-4:]}")
-        self._send(
+    async def _identify(self):
+        token = await asyncio.to_thread(get_access_token)
+        _log("INFO", f"🔑 Identify: intents={QQ_WS_INTENTS} token={token[:8]}...{token[-4:]}")
+        await self._send(
             {
                 "op": 2,
                 "d": {
@@ -140,49 +371,162 @@ class QQWsKeepAlive:
             }
         )
 
-    def _heartbeat_loop(self, conn_stop: threading.Event):
-        """每个连接独立的心跳线程；conn_stop 被 set 后立即退出，避免用旧 socket 发心跳。"""
-        while not self._stop.is_set() and not conn_stop.is_set():
+    async def _resume(self):
+        token = await asyncio.to_thread(get_access_token)
+        _log("INFO", f"🔁 Resume: session_id={self._session_id} seq={self._last_seq}")
+        await self._send(
+            {
+                "op": 6,
+                "d": {
+                    "token": f"QQBot {token}",
+                    "session_id": self._session_id,
+                    "seq": self._last_seq or 0,
+                },
+            }
+        )
+
+    def _mark_ready(self, how: str):
+        self._set_ready(True)
+        self._consecutive_failures = 0  # ★ 成功连接，重置失败计数
+        if self._disconnected_at:
+            self._last_reconnect_ms = (time.time() - self._disconnected_at) * 1000.0
+        self._save_session()
+        metrics.set_gauge("qq_ws_ready", 1)
+        if self._last_reconnect_ms is not None:
+            metrics.set_gauge("qq_ws_reconnect_ms", round(self._last_reconnect_ms, 1))
+        metrics.incr("qq_ws_sessions_total", how=how)
+        cost = f"{self._last_reconnect_ms:.0f}ms" if self._last_reconnect_ms is not None else "-"
+        _log(
+            "INFO",
+            f"✅ WS 连接就绪（{how}），会话已建立 "
+            f"重连耗时={cost} resume={self._resume_count} identify={self._identify_count}"
+        )
+
+    async def _heartbeat_loop(self):
+        """本连接的心跳 task；随连接一起被取消，不会用旧 socket 发心跳。
+
+        按 loop.time() 的绝对时刻调度（第 n 次心跳 = 起点 + n × interval），处理耗时不累积漂移。
+        每次心跳后等待 ACK(op=11)：超过 heartbeat_interval × ws_ack_timeout_ratio 仍未收到，
+        说明是半开的僵尸连接 —— 抛 _ZombieConnection，由 _connection 立即断开走重连（优先 Resume）。
+        """
+        loop = asyncio.get_running_loop()
+        next_at = loop.time()
+        while True:
+            interval = float(self._heartbeat_interval)
+            ack_timeout = max(interval * QQ_WS_ACK_TIMEOUT_RATIO, 3.0)
+
+            self._ack.clear()
+            self._hb_sent_at = time.time()
+            await self._send({"op": 1, "d": self._last_seq})
+            self._last_heartbeat_at = self._hb_sent_at
+            self._save_session(debounce=True)
+
             try:
-                self._send({"op": 1, "d": self._last_seq})
-                self._last_heartbeat_at = time.time()
-            except Exception:
-                break  # socket 已关闭，直接退出
-            # 用 wait 代替 sleep，这样 conn_stop.set() 后能立即退出
-            conn_stop.wait(timeout=float(self._heartbeat_interval))
+                await asyncio.wait_for(self._ack.wait(), timeout=ack_timeout)
+            except asyncio.TimeoutError:
+                self._zombie_count += 1
+                self._set_ready(False)
+                metrics.incr("qq_ws_zombie_connections_total")
+                metrics.set_gauge("qq_ws_ready", 0)
+                _log("WARN", f"🧟 心跳 {ack_timeout:.1f}s 未收到 ACK，判定僵尸连接，立即重连")
+                raise _ZombieConnection(f"heartbeat ack timeout ({ack_timeout:.1f}s)")
+
+            next_at += interval
+            await asyncio.sleep(max(next_at - loop.time(), 0.0))
+
+    async def _reader(self, ws):
+        async for raw in ws:
+            msg = json.loads(raw)
+            op = msg.get("op")
+            s = msg.get("s")
+            t = msg.get("t")
+            if s is not None:
+                self._last_seq = s
+
+            # READY / RESUMED 到来，标记可用
+            if op == 0 and t == "READY":
+                self._session_id = (msg.get("d") or {}).get("session_id") or None
+                self._mark_ready("identify")
+            elif op == 0 and t == "RESUMED":
+                self._mark_ready("resume")
+
+            if op == 11:
+                self._on_heartbeat_ack()  # Heartbeat ACK，记 RTT
+            elif op == 7:  # Reconnect（服务端要求重连，不算失败；保留会话，下一轮 Resume）
+                raise RuntimeError("gateway requested reconnect")
+            elif op == 9:  # Invalid Session：会话不可恢复，下一轮重新 Identify
+                self._clear_session()
+                raise RuntimeError(f"invalid session: {msg}")
+        raise RuntimeError("connection closed by gateway")
+
+    async def _connection(self, url: str, resuming: bool):
+        """一条连接的完整生命周期：Hello → Identify/Resume → 读帧 + 心跳，任一失败即整体退出。"""
+        async with websockets.connect(
+            url, open_timeout=20, close_timeout=2, ping_interval=None, max_size=None,
+        ) as ws:
+            self._ws = ws
+            self._last_connect_at = time.time()
+            try:
+                hello = json.loads(await asyncio.wait_for(ws.recv(), timeout=20))
+                if int(hello.get("op", -1)) != 10:
+                    raise RuntimeError(f"expected hello(op=10), got: {hello}")
+
+                interval_ms = (hello.get("d") or {}).get("heartbeat_interval")
+                self._heartbeat_interval = max(float(interval_ms or 45000) / 1000.0, 5.0)
+
+                if resuming:
+                    self._resume_count += 1
+                    await self._resume()
+                else:
+                    self._identify_count += 1
+                    await self._identify()
 
-    def _log_loop(self):
+                tasks = [
+                    asyncio.create_task(self._reader(ws), name="qq-ws-reader"),
+                    asyncio.create_task(self._heartbeat_loop(), name="qq-ws-heartbeat"),
+                ]
+                try:
+                    done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                finally:
+                    for task in tasks:
+                        task.cancel()
+                    await asyncio.gather(*tasks, return_exceptions=True)
+                for task in done:
+                    task.result()  # 抛出首个失败原因
+            finally:
+                self._ws = None
+
+    async def _log_loop(self):
         # 限频输出：默认每 60s 打印一次（由 QQ_WS_LOG_INTERVAL_SECONDS 控制）
-        while not self._stop.is_set():
+        while True:
             try:
-                ts = time.strftime("%Y-%m-%d %H:%M:%S")
                 if self.ready:
                     age = int(time.time() - (self._last_heartbeat_at or time.time()))
-                    print(
-                        f"[{ts}] qq_ws    | INFO  | ✅ 在线 url={self._connected_url} seq={self._last_seq} "
-                        f"心跳间隔={self._heartbeat_interval:.1f}s 上次心跳={age}s前"
+                    rtt = f"{self._heartbeat_rtt_ms:.0f}ms" if self._heartbeat_rtt_ms is not None else "-"
+                    _log(
+                        "INFO",
+                        f"✅ 在线 url={self._connected_url} seq={self._last_seq} "
+                        f"心跳间隔={self._heartbeat_interval:.1f}s 上次心跳={age}s前 RTT={rtt}"
                     )
                 else:
                     err = self._last_error or "(无)"
-                    print(f"[{ts}] qq_ws    | WARN  | ⚠️ 未就绪 last_error={err}")
+                    _log("WARN", f"⚠️ 未就绪 last_error={err}")
             except Exception:
-                # 永不让日志线程崩
+                # 永不让日志 task 崩
                 pass
 
             # 至少 5s，但默认 60s（避免刷屏）
-            time.sleep(max(QQ_WS_LOG_INTERVAL_SECONDS, 5))
+            await asyncio.sleep(max(QQ_WS_LOG_INTERVAL_SECONDS, 5))
 
-    def _run(self):
+    async def _run(self):
         backoff = 5
-        log_thread = threading.Thread(target=self._log_loop, name="qq-ws-log", daemon=True)
-        log_thread.start()
 
-        while not self._stop.is_set():
+        while True:
             # ── 熔断检查：连续失败 N 次 → 长休眠，防止刷光配额 ──
             if self._consecutive_failures >= self.CIRCUIT_BREAKER_THRESHOLD:
-                ts = time.strftime("%Y-%m-%d %H:%M:%S")
-                print(
-                    f"[{ts}] qq_ws    | ERROR | 🔴 熔断触发："
+                _log(
+                    "ERROR",
+                    f"🔴 熔断触发："
                     f"连续失败 {self._consecutive_failures} 次，"
                     f"休眠 {self.CIRCUIT_BREAKER_SLEEP}s ({self.CIRCUIT_BREAKER_SLEEP//60}min)。"
                     f"last_error={self._last_error}"
@@ -191,114 +535,270 @@ class QQWsKeepAlive:
                     f"circuit breaker: {self._consecutive_failures} failures, "
                     f"sleeping {self.CIRCUIT_BREAKER_SLEEP//60}min"
                 )
-                self._stop.wait(timeout=self.CIRCUIT_BREAKER_SLEEP)
-                if self._stop.is_set():
-                    break
+                await self._sleep(self.CIRCUIT_BREAKER_SLEEP)
                 # 休眠结束后重置计数器和退避，给一轮新机会
                 self._consecutive_failures = 0
                 backoff = 5
-                ts = time.strftime("%Y-%m-%d %H:%M:%S")
-                print(f"[{ts}] qq_ws    | INFO  | 🔄 熔断重置，重新尝试连接...")
-
-            # 通知上一轮心跳线程退出
-            self._hb_stop.set()
-            conn_stop = threading.Event()
-            self._hb_stop = conn_stop
+                _log("INFO", "🔄 熔断重置，重新尝试连接...")
 
+            attempt_at = time.time()
             try:
-                self._ready.clear()
+                self._set_ready(False)
                 self._last_error = None
 
-                url, limit = _get_gateway_url()
+                # 有会话且有缓存 URL → 直接 Resume，跳过 /gateway/bot 与配额检查
+                resuming = bool(self._session_id)
+                url = _cached_gateway_url() if resuming else None
+                if not url:
+                    url, limit = await asyncio.to_thread(_get_gateway_url)
+
+                    # ── 连接配额保护（仅 Identify 消耗 session_start_limit）──
+                    remaining = int(limit.get("remaining", 999))
+                    reset_after_ms = int(limit.get("reset_after", 0))
+                    if remaining <= 0 and not resuming:
+                        wait_sec = max(reset_after_ms / 1000.0, 60) + 5  # 多等 5 秒余量
+                        _log(
+                            "WARN",
+                            f"⚠️ 连接配额耗尽！"
+                            f"remaining=0，等待 {wait_sec:.0f}s 后重置"
+                        )
+                        self._last_error = f"rate limited, waiting {wait_sec:.0f}s"
+                        await self._sleep(wait_sec)
+                        continue
+
+                    # ── 配额低警告 ──
+                    if remaining < 20:
+                        _log("WARN", f"⚠️ 连接配额偏低：remaining={remaining}")
+
                 self._connected_url = url
+                await self._connection(url, resuming)
 
-                # ── 连接配额保护 ──
-                remaining = int(limit.get("remaining", 999))
-                reset_after_ms = int(limit.get("reset_after", 0))
-                if remaining <= 0:
-                    wait_sec = max(reset_after_ms / 1000.0, 60) + 5  # 多等 5 秒余量
-                    ts = time.strftime("%Y-%m-%d %H:%M:%S")
-                    print(
-                        f"[{ts}] qq_ws    | WARN  | ⚠️ 连接配额耗尽！"
-                        f"remaining=0，等待 {wait_sec:.0f}s 后重置"
-                    )
-                    self._last_error = f"rate limited, waiting {wait_sec:.0f}s"
-                    self._stop.wait(timeout=wait_sec)
-                    continue
+            except Exception as e:
+                err_str = str(e)
+                self._last_error = err_str
+                zombie = isinstance(e, _ZombieConnection)
+                if self._ready.is_set() or not self._disconnected_at or zombie:
+                    self._disconnected_at = time.time()
+                self._set_ready(False)
+                metrics.set_gauge("qq_ws_ready", 0)
+                self._save_session()
 
-                # ── 配额低警告 ──
-                if remaining < 20:
-                    ts = time.strftime("%Y-%m-%d %H:%M:%S")
-                    print(f"[{ts}] qq_ws    | WARN  | ⚠️ 连接配额偏低：remaining={remaining}")
+                # 本轮 socket 已建立过：退避从 5s 重新开始
+                if self._last_connect_at >= attempt_at:
+                    backoff = 5
 
-                self._ws = websocket.create_connection(url, timeout=20)
-                self._ws.settimeout(60)
-                self._last_connect_at = time.time()
+                # 如果是 gateway reconnect（op=7），不计入连续失败
+                is_reconnect = "gateway requested reconnect" in err_str
+                if not is_reconnect:
+                    self._consecutive_failures += 1
 
-                hello_raw = self._ws.recv()
-                hello = json.loads(hello_raw)
-                if int(hello.get("op", -1)) != 10:
-                    raise RuntimeError(f"expected hello(op=10), got: {hello}")
+                # 可 Resume 的首次重连只等 1s（不耗配额），否则指数退避
+                delay = 1 if (self._session_id and (is_reconnect or self._consecutive_failures <= 1)) else backoff
 
-                interval_ms = (hello.get("d") or {}).get("heartbeat_interval")
-                self._heartbeat_interval = max(float(interval_ms or 45000) / 1000.0, 5.0)
+                _log(
+                    "WARN",
+                    f"⚠️ 连接失败：{e}，"
+                    f"连续失败={self._consecutive_failures}，{delay}s 后重试"
+                    f"（{'Resume' if self._session_id else 'Identify'}）"
+                )
 
-                self._identify()
+                # 指数退避：5 → 10 → 20 → 40 → 60（封顶）
+                await self._sleep(delay)
+                if delay == backoff:
+                    backoff = min(backoff * 2, 60)
 
-                hb_thread = threading.Thread(
-                    target=self._heartbeat_loop, args=(conn_stop,),
-                    name="qq-ws-heartbeat", daemon=True,
-                )
-                hb_thread.start()
 
-                backoff = 5
+class SharedWsGate:
+    """跨进程共享的 WS 就绪门闸（与 QQWsKeepAlive 相同的对外接口）。
 
-                while not self._stop.is_set():
-                    raw = self._ws.recv()
-                    msg = json.loads(raw)
-                    op = msg.get("op")
-                    s = msg.get("s")
-                    t = msg.get("t")
-                    if s is not None:
-                        self._last_seq = s
-
-                    # READY 到来，标记可用
-                    if op == 0 and t == "READY":
-                        self._ready.set()
-                        self._consecutive_failures = 0  # ★ 成功连接，重置失败计数
-                        ts_now = time.strftime("%Y-%m-%d %H:%M:%S")
-                        print(f"[{ts_now}] qq_ws    | INFO  | ✅ WS 连接就绪，会话已建立")
-
-                    if op == 11:
-                        pass  # Heartbeat ACK，正常
-                    elif op == 7:  # Reconnect（服务端要求重连，不算失败）
-                        raise RuntimeError("gateway requested reconnect")
-                    elif op == 9:  # Invalid Session
-                        raise RuntimeError(f"invalid session: {msg}")
+    多个 worker 副本只需要一条网关会话：
+    - 各进程用 Redis 租约（SET NX PX + 续约）竞选，只有持有者运行 QQWsKeepAlive
+    - 持有者每 2s 把 ready / last_error / 心跳时间 / RTT 发布到 qq:ws:state
+    - 其他进程只读共享状态来决定是否消费队列；持有者退出后租约过期，由其他进程接管，
+      会话信息在 Redis 里，新持有者直接 Resume
+    - ws_mode=external 时本进程从不竞选，只读共享状态
+    """
 
-            except Exception as e:
-                err_str = str(e)
-                self._last_error = err_str
-                self._ready.clear()
-                conn_stop.set()  # 通知本轮心跳线程立即退出
-                try:
-                    if self._ws:
-                        self._ws.close()
-                except Exception:
-                    pass
-                self._ws = None
+    def __init__(self, elect: bool = True):
+        self._elect = elect
+        self._owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+        self._local: QQWsKeepAlive | None = None
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._state: dict = {}
 
-                # 如果是 gateway reconnect（op=7），不计入连续失败
-                is_reconnect = "gateway requested reconnect" in err_str
-                if not is_reconnect:
-                    self._consecutive_failures += 1
+    # ── 与 QQWsKeepAlive 一致的接口 ──
+
+    @property
+    def is_leader(self) -> bool:
+        return self._local is not None
+
+    @property
+    def ready(self) -> bool:
+        local = self._local
+        if local is not None:
+            return local.ready
+        st = self._read_state()
+        return st.get("ready") == "1"
+
+    @property
+    def last_error(self) -> str | None:
+        local = self._local
+        if local is not None:
+            return local.last_error
+        st = self._read_state()
+        if not st:
+            return "no keepalive owner"
+        return st.get("last_error") or None
+
+    @property
+    def last_heartbeat_at(self) -> float:
+        local = self._local
+        if local is not None:
+            return local.last_heartbeat_at
+        return float(self._read_state().get("heartbeat_at") or 0)
 
-                ts = time.strftime("%Y-%m-%d %H:%M:%S")
-                print(
-                    f"[{ts}] qq_ws    | WARN  | ⚠️ 连接失败：{e}，"
-                    f"连续失败={self._consecutive_failures}，{backoff}s 后重试"
+    def wait_until_ready(self, timeout: float | None = None) -> bool:
+        timeout = QQ_WS_READY_TIMEOUT_SECONDS if timeout is None else timeout
+        deadline = time.time() + timeout
+        while True:
+            local = self._local
+            if local is not None:
+                return local.wait_until_ready(timeout=max(deadline - time.time(), 0))
+            if self.ready:
+                return True
+            left = deadline - time.time()
+            if left <= 0:
+                return False
+            time.sleep(min(0.5, left))
+
+    async def wait_ready(self, timeout: float | None = None) -> bool:
+        timeout = QQ_WS_READY_TIMEOUT_SECONDS if timeout is None else timeout
+        deadline = time.time() + timeout
+        while True:
+            local = self._local
+            if local is not None:
+                return await local.wait_ready(timeout=max(deadline - time.time(), 0))
+            if self.ready:
+                return True
+            left = deadline - time.time()
+            if left <= 0:
+                return False
+            await asyncio.sleep(min(0.5, left))
+
+    def reconnect_now(self):
+        local = self._local
+        if local is not None:
+            local.reconnect_now()
+            return
+        try:
+            _r.set(_KICK_KEY, self._owner, ex=30)
+        except Exception:
+            pass
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._thread = threading.Thread(target=self._loop, name="qq-ws-gate", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._step_down()
+
+    # ── 内部 ──
+
+    def _read_state(self) -> dict:
+        try:
+            st = _r.hgetall(_STATE_KEY) or {}
+        except Exception:
+            return {}
+        if time.time() - float(st.get("updated_at") or 0) > _STATE_STALE_SECONDS:
+            return {}
+        return st
+
+    def _try_acquire(self) -> bool:
+        try:
+            return bool(_r.set(_LEASE_KEY, self._owner, nx=True, px=_LEASE_TTL_MS))
+        except Exception:
+            return False
+
+    def _renew(self) -> bool:
+        try:
+            return bool(_r.eval(_RENEW_LEASE_LUA, 1, _LEASE_KEY, self._owner, _LEASE_TTL_MS))
+        except Exception:
+            return False
+
+    def _step_down(self):
+        local, self._local = self._local, None
+        if local is not None:
+            local.stop()
+            try:
+                _r.eval(
+                    "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('del', KEYS[1]) end return 0",
+                    1, _LEASE_KEY, self._owner,
                 )
+            except Exception:
+                pass
 
-                # 指数退避：5 → 10 → 20 → 40 → 60（封顶）
-                self._stop.wait(timeout=backoff)
-                backoff = min(backoff * 2, 60)
+    def _publish(self):
+        local = self._local
+        if local is None:
+            return
+        try:
+            pipe = _r.pipeline()
+            pipe.hset(_STATE_KEY, mapping={
+                "owner": self._owner,
+                "ready": "1" if local.ready else "0",
+                "last_error": local.last_error or "",
+                "heartbeat_at": local.last_heartbeat_at,
+                "heartbeat_rtt_ms": local.heartbeat_rtt_ms if local.heartbeat_rtt_ms is not None else "",
+                "updated_at": time.time(),
+            })
+            pipe.expire(_STATE_KEY, int(_STATE_STALE_SECONDS * 6))
+            pipe.execute()
+            metrics.set_gauge("qq_ws_heartbeat_age_seconds", round(time.time() - (local.last_heartbeat_at or time.time()), 1))
+        except Exception:
+            pass
+
+    def _loop(self):
+        while not self._stop.is_set():
+            if self._local is not None:
+                if not self._renew():
+                    _log("WARN", "⚠️ 网关持有租约丢失，停止本进程的 WS 保活")
+                    self._step_down()
+                else:
+                    try:
+                        if _r.getdel(_KICK_KEY):
+                            self._local.reconnect_now()
+                    except Exception:
+                        pass
+                    self._publish()
+            elif self._elect and self._try_acquire():
+                _log("INFO", f"👑 成为网关持有者 owner={self._owner}，启动 WS 保活")
+                local = QQWsKeepAlive()
+                local.start()
+                self._local = local
+                self._publish()
+            self._stop.wait(timeout=_STATE_PUBLISH_INTERVAL)
+
+
+def _local_session_key() -> str:
+    """local 模式下本进程的会话 key：同一主机上的不同进程（worker / uploader …）互不续用对方的会话。"""
+    role = os.path.splitext(os.path.basename(sys.argv[0] or ""))[0] or "python"
+    return f"{_SESSION_KEY}:{socket.gethostname()}:{role}"
+
+
+def create_keepalive():
+    """按 qq.ws_mode 返回 worker 使用的保活对象（接口一致）。"""
+    if QQ_WS_MODE == "local":
+        return QQWsKeepAlive(session_key=_local_session_key())
+    return SharedWsGate(elect=(QQ_WS_MODE != "external"))
+
+
+if __name__ == "__main__":
+    # 独立网关保活服务：只负责持有 WS 会话并发布共享状态，不消费队列
+    gate = SharedWsGate(elect=True)
+    gate.start()
+    while True:
+        time.sleep(3600)
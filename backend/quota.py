@@ -0,0 +1,224 @@
+"""
+QQ 每日主动消息配额账本（按源分配）。
+
+QQ 机器人每天的主动消息有上限，以前只能等 _is_rate_limited 触发才知道，
+届时所有源一起饿死。这里在 Redis 里记账：
+
+- 账本：quota:{YYYYMMDD} 哈希，字段 total / publish / upload / src:{源}
+  （QQ CDN 传图走 POST /messages，同样消耗配额，记为 upload）
+- 速率：quota:events ZSET（score = 时间戳），统计最近一小时的消耗
+- 预测：按当前速率推算今天剩余可发时段内的总用量与耗尽时间
+- 分配：剩余额度按 quota.weights 权重分给各源；
+  超出份额的源只能借用保留额度之外的部分，低优先级任务在预测超额时直接舍弃
+
+decide() 返回 send / defer / shed（units = 这次要发的条数：一条帖子扇出到 N 个频道就消耗 N 条配额）：
+- defer：放入 queue:deferred，次日（配额重置后）由 release_deferred() 放进积压队列（经 drain 规划：过期、折叠）
+- shed：进死信（可手动重放）
+"""
+
+import datetime
+import time
+import uuid
+
+from config import get as cfg_get
+from log import get_logger
+
+DEFERRED_KEY = "queue:deferred"
+_DEFERRED_DAY_KEY = "quota:deferred:day"
+_EVENTS_KEY = "quota:events"
+
+# 每日配额上限（条）；0 = 只记账不限流
+try:
+    DAILY_LIMIT = int(cfg_get("quota.daily_limit", 0))
+except Exception:
+    DAILY_LIMIT = 0
+
+# 保留额度比例：超出自身份额的源不能动用这部分
+try:
+    RESERVE_RATIO = min(max(float(cfg_get("quota.reserve_ratio", 0.1)), 0.0), 1.0)
+except Exception:
+    RESERVE_RATIO = 0.1
+
+# 各源权重（键与 telegram.sources 写法一致，如 "@Q_dianying"），缺省为 1
+SOURCE_WEIGHTS: dict = {str(k): float(v) for k, v in (cfg_get("quota.weights") or {}).items()}
+
+# 低优先级源：预测会超额时直接舍弃
+LOW_PRIORITY_SOURCES: set = {str(s) for s in (cfg_get("quota.low_priority_sources") or [])}
+
+QUIET_HOURS_START = int(cfg_get("qq.quiet_hours_start", 0))
+QUIET_HOURS_END = int(cfg_get("qq.quiet_hours_end", 6))
+
+
+_log = get_logger("quota")
+
+
+def _day_key(day: str | None = None) -> str:
+    return f"quota:{day or time.strftime('%Y%m%d')}"
+
+
+def _is_quiet_hour(hour: int) -> bool:
+    if QUIET_HOURS_START < QUIET_HOURS_END:
+        return QUIET_HOURS_START <= hour < QUIET_HOURS_END
+    return hour >= QUIET_HOURS_START or hour < QUIET_HOURS_END
+
+
+def _active_hours_left_today() -> float:
+    """今天剩余的可发送时长（小时），扣除静默时段。"""
+    now = datetime.datetime.now()
+    left = 0.0
+    cursor = now
+    midnight = (now + datetime.timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
+    while cursor < midnight:
+        next_hour = (cursor + datetime.timedelta(hours=1)).replace(minute=0, second=0, microsecond=0)
+        if not _is_quiet_hour(cursor.hour):
+            left += (min(next_hour, midnight) - cursor).total_seconds()
+        cursor = next_hour
+    return left / 3600.0
+
+
+def source_of(task: dict) -> str:
+    return str(task.get("source") or task.get("chat_id") or "")
+
+
+def record(r, source: str, kind: str = "publish", n: int = 1):
+    """记一笔配额消耗。kind: publish（发帖）/ upload（QQ CDN 传图）。"""
+    now = time.time()
+    key = _day_key()
+    try:
+        pipe = r.pipeline()
+        pipe.hincrby(key, "total", n)
+        pipe.hincrby(key, kind, n)
+        if source:
+            pipe.hincrby(key, f"src:{source}", n)
+        pipe.expire(key, 3 * 86400)
+        for _ in range(n):
+            pipe.zadd(_EVENTS_KEY, {uuid.uuid4().hex[:12]: now})
+        pipe.zremrangebyscore(_EVENTS_KEY, "-inf", now - 3600)
+        pipe.execute()
+    except Exception as e:
+        _log("WARN", f"⚠️ 配额记账失败：{e}")
+
+
+def _weights() -> dict[str, float]:
+    sources = [str(s).strip() for s in (cfg_get("telegram.sources") or []) if str(s).strip()]
+    sources = [s if s.startswith("@") else "@" + s for s in sources]
+    w = {s: float(SOURCE_WEIGHTS.get(s, 1.0)) for s in sources}
+    for s, v in SOURCE_WEIGHTS.items():
+        w.setdefault(s, float(v))
+    return w
+
+
+def allocation(source: str) -> float:
+    """该源今日份额（不含保留额度）。"""
+    if DAILY_LIMIT <= 0:
+        return float("inf")
+    w = _weights()
+    total_w = sum(w.values()) or 1.0
+    return DAILY_LIMIT * (1.0 - RESERVE_RATIO) * w.get(source, 1.0) / total_w
+
+
+def snapshot(r) -> dict:
+    """当前用量与预测（Dashboard 展示用）。"""
+    now = time.time()
+    try:
+        data = r.hgetall(_day_key()) or {}
+        rate = int(r.zcount(_EVENTS_KEY, now - 3600, now))
+    except Exception:
+        data, rate = {}, 0
+    return _build_snapshot(data, rate, now)
+
+
+async def snapshot_async(ar) -> dict:
+    """snapshot 的 redis.asyncio 版本（管理 API 用，不占事件循环线程）。"""
+    now = time.time()
+    try:
+        data = await ar.hgetall(_day_key()) or {}
+        rate = int(await ar.zcount(_EVENTS_KEY, now - 3600, now))
+    except Exception:
+        data, rate = {}, 0
+    return _build_snapshot(data, rate, now)
+
+
+def _build_snapshot(data: dict, rate: int, now: float) -> dict:
+    used = int(data.get("total", 0))
+    hours_left = _active_hours_left_today()
+    projected = used + rate * hours_left
+
+    out = {
+        "limit": DAILY_LIMIT,
+        "used": used,
+        "publish": int(data.get("publish", 0)),
+        "upload": int(data.get("upload", 0)),
+        "rate_per_hour": rate,
+        "projected_total": int(projected),
+        "exhaust_at": None,
+        "by_source": {
+            k[4:]: int(v) for k, v in data.items() if k.startswith("src:")
+        },
+    }
+    if DAILY_LIMIT > 0:
+        remaining = max(DAILY_LIMIT - used, 0)
+        out["remaining"] = remaining
+        if rate > 0 and projected > DAILY_LIMIT:
+            out["exhaust_at"] = int(now + remaining / rate * 3600)
+    return out
+
+
+def decide(r, source: str, priority: str = "normal", units: int = 1) -> str:
+    """send / defer / shed；units 条消息作为一个整体判断（扇出的各频道要么一起发，要么一起延后）。"""
+    if DAILY_LIMIT <= 0:
+        return "send"
+
+    units = max(int(units), 1)
+    snap = snapshot(r)
+    used = snap["used"]
+    remaining = DAILY_LIMIT - used
+    if remaining < units:
+        return "defer"
+
+    if priority == "high":
+        return "send"
+
+    low = priority == "low" or source in LOW_PRIORITY_SOURCES
+    src_used = snap["by_source"].get(source, 0)
+    over_share = src_used + units > allocation(source)
+
+    if low and (over_share or snap["projected_total"] + units > DAILY_LIMIT):
+        return "shed"
+
+    # 超出份额：只能借用保留额度以外的部分
+    if over_share and remaining - units < DAILY_LIMIT * RESERVE_RATIO:
+        return "defer"
+
+    return "send"
+
+
+def defer(r, raw: str):
+    try:
+        pipe = r.pipeline()
+        pipe.lpush(DEFERRED_KEY, raw)
+        pipe.set(_DEFERRED_DAY_KEY, time.strftime("%Y%m%d"))
+        pipe.execute()
+    except Exception as e:
+        _log("WARN", f"⚠️ 延后入队失败：{e}")
+
+
+def release_deferred(r, target_key: str) -> int:
+    """配额重置（跨天）后，把 queue:deferred 搬进 target_key，返回搬回条数。
+
+    保持先后顺序：最早延后的放在最先被 BRPOP 取到的一端。
+    """
+    try:
+        day = r.get(_DEFERRED_DAY_KEY)
+        if not day or day == time.strftime("%Y%m%d"):
+            return 0
+        n = 0
+        while r.lmove(DEFERRED_KEY, target_key, "LEFT", "RIGHT") is not None:
+            n += 1
+        r.delete(_DEFERRED_DAY_KEY)
+        if n:
+            _log("INFO", f"♻️ 配额已重置，{n} 条延后任务放回队列")
+        return n
+    except Exception as e:
+        _log("WARN", f"⚠️ 延后任务放回失败：{e}")
+        return 0
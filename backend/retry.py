@@ -0,0 +1,170 @@
+"""
+发送失败的延迟重试（delay queue）。
+
+以前：频道限流（304045）时 worker 把任务推回队列头部再 sleep 冷却时间，整个 worker 跟着冻住，
+其它频道 / 其它任务都得等；5xx、超时这类临时故障直接进死信，只能手动重放。
+
+现在失败的任务按错误类别退避后放进 Redis 有序集合 queue:delayed：
+- 成员 = "{目标队列}|{到期时间}|{编码后的任务}"，score = 到期时间戳（秒）；
+  成员带到期时间：内容相同、先后延后的两份任务不会合并成一条
+- 退避：base * 2^(该类别第几次重试)，不超过 max，再乘 [1 - jitter, 1] 的随机系数（同一批失败的任务错开到期，
+  不会同时回来再撞一次限流）；该类别超过 max_attempts 次，或各类别合计超过 retry.max_total_attempts 次
+  （5xx 与超时交替出现时类别计数会重置，合计上限保证最终停下）→ 由调用方写死信
+- 错误类别（retry.classes）：rate_limited（304045 频率限制）/ server（5xx）/ network（超时、连接失败）
+- 频道仍在冷却中的任务不计重试次数，直接排到冷却结束（delay_until）
+- 搬运（promote_due）：读出到期成员，按目标队列分组，每组一次 Lua（KEYS = 延迟队列 + 目标队列）：
+  ZREM 成功才推回目标队列头部（BRPOP 下一个就取到），多副本同时搬也不会重复；
+  worker 启动后台线程每 retry.poll_seconds 秒执行一次
+
+重试进度记在任务的 retry 字段（{"attempt": n, "class": ..., "total": n}），写死信前用 clear() 去掉，
+死信重放时从头计数。
+"""
+
+import random
+import threading
+import time
+
+from config import get as cfg_get
+from log import get_logger
+import metrics
+import task_codec
+
+DELAYED_KEY = "queue:delayed"
+
+# 到期检查间隔（秒）
+try:
+    POLL_SECONDS = max(float(cfg_get("retry.poll_seconds", 1)), 0.1)
+except Exception:
+    POLL_SECONDS = 1.0
+
+# 退避随机系数：实际延迟落在 [delay * (1 - jitter), delay]
+try:
+    JITTER = min(max(float(cfg_get("retry.jitter", 0.5)), 0.0), 1.0)
+except Exception:
+    JITTER = 0.5
+
+# 各类别合计的重试次数上限
+try:
+    MAX_TOTAL_ATTEMPTS = max(int(cfg_get("retry.max_total_attempts", 10)), 0)
+except Exception:
+    MAX_TOTAL_ATTEMPTS = 10
+
+# 每次最多搬运多少条（避免单次 Lua 执行太久）
+_PROMOTE_BATCH = 100
+
+try:
+    _RATE_LIMIT_BASE = float(cfg_get("qq.rate_limit_cooldown_seconds", 300))
+except Exception:
+    _RATE_LIMIT_BASE = 300.0
+
+# 各错误类别的默认退避参数：(base_seconds, max_seconds, max_attempts)
+_DEFAULT_CLASSES = {
+    "rate_limited": (_RATE_LIMIT_BASE, 1800.0, 8),
+    "server": (10.0, 600.0, 6),
+    "network": (10.0, 600.0, 6),
+}
+
+
+def _load_classes() -> dict[str, tuple[float, float, int]]:
+    conf = cfg_get("retry.classes") or {}
+    out = {}
+    for name, (base, cap, attempts) in _DEFAULT_CLASSES.items():
+        c = conf.get(name) or {}
+        try:
+            out[name] = (
+                max(float(c.get("base_seconds", base)), 0.0),
+                max(float(c.get("max_seconds", cap)), 0.0),
+                max(int(c.get("max_attempts", attempts)), 0),
+            )
+        except Exception:
+            out[name] = (base, cap, attempts)
+    return out
+
+
+CLASSES = _load_classes()
+
+# KEYS[1] = 延迟队列，KEYS[2] = 目标队列；ARGV = 成员, 任务, 成员, 任务, ...
+_PROMOTE_LUA = """
+local n = 0
+for i = 1, #ARGV, 2 do
+    if redis.call('zrem', KEYS[1], ARGV[i]) == 1 then
+        redis.call('rpush', KEYS[2], ARGV[i + 1])
+        n = n + 1
+    end
+end
+return n
+"""
+
+
+_log = get_logger("retry")
+
+
+def backoff_seconds(cls: str, attempt: int) -> float:
+    """第 attempt 次重试（从 0 开始）的延迟（含随机系数）。"""
+    base, cap, _ = CLASSES.get(cls, CLASSES["server"])
+    delay = min(base * (2 ** min(attempt, 30)), cap)
+    return delay * (1.0 - JITTER * random.random())
+
+
+def clear(task: dict) -> dict:
+    """去掉重试进度（写死信前调用：重放时从头计数）。"""
+    return {k: v for k, v in task.items() if k != "retry"}
+
+
+def delay_until(r, dest: str, task: dict, due: float):
+    """把任务放进延迟队列，到 due（时间戳）后推回 dest；不计重试次数。"""
+    r.zadd(DELAYED_KEY, {f"{dest}|{due:.6f}|{task_codec.encode(task)}": due})
+
+
+def schedule(r, dest: str, task: dict, cls: str) -> float | None:
+    """按错误类别退避后重试，返回延迟秒数；次数用完（或类别不可重试）返回 None，由调用方写死信。"""
+    if cls not in CLASSES:
+        return None
+    prev = task.get("retry") or {}
+    attempt = int(prev.get("attempt", 0)) if prev.get("class") == cls else 0
+    total = int(prev.get("total", 0))
+    if attempt >= CLASSES[cls][2] or total >= MAX_TOTAL_ATTEMPTS:
+        metrics.incr("retry_exhausted_total", reason=cls)
+        return None
+    delay = backoff_seconds(cls, attempt)
+    delay_until(r, dest, {**task, "retry": {"attempt": attempt + 1, "class": cls, "total": total + 1}}, time.time() + delay)
+    metrics.incr("retry_scheduled_total", reason=cls)
+    return delay
+
+
+def promote_due(r, now: float | None = None) -> int:
+    """把已到期的任务推回各自的目标队列，返回搬运条数。"""
+    now = time.time() if now is None else now
+    total = 0
+    while True:
+        members = r.zrangebyscore(DELAYED_KEY, "-inf", now, start=0, num=_PROMOTE_BATCH)
+        groups: dict[str, list[str]] = {}
+        for m in members:
+            parts = m.split("|", 2)
+            if len(parts) < 3:
+                # 无法解析的成员：直接移除，避免每轮都卡在队首
+                r.zrem(DELAYED_KEY, m)
+                continue
+            groups.setdefault(parts[0], []).extend((m, parts[2]))
+        for dest, argv in groups.items():
+            total += int(r.eval(_PROMOTE_LUA, 2, DELAYED_KEY, dest, *argv) or 0)
+        if len(members) < _PROMOTE_BATCH:
+            return total
+
+
+def _mover(r):
+    while True:
+        try:
+            n = promote_due(r)
+            if n:
+                _log("INFO", f"♻️ {n} 条延迟重试任务到期，放回队列", event="retry_promote", count=n)
+            metrics.set_gauge("retry_delayed", r.zcard(DELAYED_KEY))
+        except Exception as e:
+            _log("WARN", f"⚠️ 延迟队列搬运失败：{e}")
+        time.sleep(POLL_SECONDS)
+
+
+def start_mover(r) -> threading.Thread:
+    t = threading.Thread(target=_mover, args=(r,), name="retry-mover", daemon=True)
+    t.start()
+    return t
@@ -0,0 +1,834 @@
+"""
+规则引擎：rules.filter（黑白名单过滤）+ rules.transforms（文案清洗）。
+
+listen 用 pass_filter 过滤，worker 用 normalize_forward_text 清洗，两边共用这里的实现。
+
+试跑（dry-run）：evaluate() 把规则批量跑在一批语料上，返回
+- 每条消息：是否放行、命中了哪些规则、清洗前后的 diff
+- 每条规则：命中次数、累计 / 平均 / 最大耗时（微秒）、从未命中的规则
+语料较大时（>= _PARALLEL_THRESHOLD 条）分块交给进程池并行。
+入口：POST /api/rules/dry-run（api/rules.py）与命令行：
+
+    python rules.py --dead 200
+    python rules.py --jsonl corpus.jsonl --rules candidate.yaml
+
+候选规则文件与 config.yaml 的 rules 段同形：{filter: {...}, transforms: [...]}，不写的部分沿用线上配置。
+
+规则编号：filter.block_keywords[0] / filter.block_regex[1] / filter.allow_keywords[0] /
+filter.allow_regex[0] / transforms[3]（下标与 config.yaml 中的顺序一致）。
+
+正则执行预算：频道文案不可控，一条病态帖子就能让嵌套量词灾难性回溯，卡死唯一的 worker 线程。
+- 正则用 regex 模块编译（语法与 re 兼容），每次执行带 timeout（rules.regex_timeout_ms）
+- 超时：本条消息跳过该规则（过滤规则视为未命中，清洗规则不改动文本），记日志 + 计数
+  rule_regex_timeout_total{rule=...}，消息照常发送
+- 加载时静态检查（backtracking_risks）：嵌套无界量词、相邻的可重叠无界量词 → WARN，
+  试跑报告里也会列出
+未安装 regex 时退回 re（无法限时，启动时 WARN）。
+
+线上计数：pass_filter / normalize_forward_text 每执行一条规则就在进程内累加
+执行次数、命中次数、丢弃次数（黑名单命中 / 白名单未命中）、累计与最大耗时。
+热路径只做内存累加；后台线程每 rules.stats_flush_seconds 秒把增量一次 pipeline 写进 metrics
+（rule_evaluations_total / rule_matches_total / rule_drops_total / rule_seconds_total / rule_max_seconds，
+标签 rule=规则编号），listen 与 worker 的计数在 Redis 里汇总。
+查看：GET /metrics 与 GET /api/system/rules（按当前配置逐条列出，含从未命中的规则）。
+"""
+
+import argparse
+import atexit
+import difflib
+import functools
+import json
+import multiprocessing
+import os
+import re
+import sys
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from config import get as cfg_get
+from log import get_logger
+import metrics
+
+try:
+    import regex as _engine  # 支持 timeout 参数
+except Exception:  # pragma: no cover
+    _engine = re
+
+try:
+    import re._parser as _sre_parse  # Python 3.11+
+    from re._constants import ANY, ASSERT, ASSERT_NOT, BRANCH, MAX_REPEAT, MAXREPEAT, MIN_REPEAT, SUBPATTERN
+except ImportError:  # pragma: no cover
+    import sre_parse as _sre_parse
+    from sre_constants import ANY, ASSERT, ASSERT_NOT, BRANCH, MAX_REPEAT, MAXREPEAT, MIN_REPEAT, SUBPATTERN
+
+_REGEX_ERRORS = (re.error,) if _engine is re else (re.error, _engine.error)
+
+# 单条正则单次执行的时间预算（毫秒）；0 = 不限时
+try:
+    REGEX_TIMEOUT_MS = max(float(cfg_get("rules.regex_timeout_ms", 50)), 0.0)
+except Exception:
+    REGEX_TIMEOUT_MS = 50.0
+
+_TIMEOUT_KW = {"timeout": REGEX_TIMEOUT_MS / 1000.0} if _engine is not re and REGEX_TIMEOUT_MS > 0 else {}
+
+_FLAG_MAP = {
+    "s": _engine.DOTALL,
+    "m": _engine.MULTILINE,
+    "i": _engine.IGNORECASE,
+}
+
+# 线上规则计数：开关与刷写间隔（秒）
+RULE_STATS_ENABLED = bool(cfg_get("rules.stats_enabled", True))
+try:
+    RULE_STATS_FLUSH_SECONDS = max(float(cfg_get("rules.stats_flush_seconds", 10)), 1.0)
+except Exception:
+    RULE_STATS_FLUSH_SECONDS = 10.0
+
+# 多空行收敛（内置，不可关闭）
+_RE_MULTI_NEWLINE = re.compile(r"\n{3,}")
+
+# 语料达到这么多条才开进程池（进程启动 + 传输开销比小语料本身还贵）
+_PARALLEL_THRESHOLD = 2000
+
+_log = get_logger("rules")
+
+if _engine is re:
+    _log("WARN", "⚠️ 未安装 regex 模块，规则正则无法限时执行（pip install regex）")
+
+
+# ── 带预算的正则执行 ────────────────────────────────────────────
+
+def _report_timeout(rid: str):
+    _log("WARN", f"⏱️ 规则 {rid} 超过 {REGEX_TIMEOUT_MS:.0f}ms 预算，本条消息跳过该规则", event="regex_timeout", rule=rid)
+    metrics.incr("rule_regex_timeout_total", rule=rid)
+
+
+@functools.lru_cache(maxsize=512)
+def _compile_filter(pattern: str):
+    """过滤正则按原样编译（与旧的 re.search(pattern) 一致，无额外 flags）；非法正则返回 None。"""
+    try:
+        return _engine.compile(pattern)
+    except _REGEX_ERRORS:
+        return None
+
+
+def _search(rid: str, pattern: str, text: str, on_timeout=_report_timeout) -> bool:
+    compiled = _compile_filter(pattern)
+    if compiled is None:
+        return False
+    try:
+        return compiled.search(text, **_TIMEOUT_KW) is not None
+    except TimeoutError:
+        on_timeout(rid)
+        return False
+
+
+def _subn(rule: dict, t: str, on_timeout=_report_timeout) -> tuple[str, int]:
+    try:
+        return rule["compiled"].subn(rule["repl"], t, **_TIMEOUT_KW)
+    except TimeoutError:
+        on_timeout(rule["id"])
+        return t, 0
+
+
+# ── 线上计数 ────────────────────────────────────────────────────
+
+class _LiveStats:
+    """进程内按规则累加，后台线程定期把增量批量写进 metrics（热路径不碰 Redis）。"""
+
+    def __init__(self, enabled: bool, interval: float):
+        self.enabled = enabled
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._data: dict[str, list[int]] = {}  # 执行次数, 命中, 丢弃, 累计 ns, 最大 ns
+        self._thread: threading.Thread | None = None
+
+    def observe(self, rid: str, hit: bool, ns: int, drop: bool = False):
+        if not self.enabled:
+            return
+        with self._lock:
+            s = self._data.get(rid)
+            if s is None:
+                s = self._data[rid] = [0, 0, 0, 0, 0]
+            s[0] += 1
+            if hit:
+                s[1] += 1
+            if drop:
+                s[2] += 1
+            s[3] += ns
+            if ns > s[4]:
+                s[4] = ns
+        if self._thread is None:
+            self._start()
+
+    def drop(self, rid: str):
+        """只记丢弃（白名单一条都没命中时，丢弃算在 filter.require_allows 上）。"""
+        if not self.enabled:
+            return
+        with self._lock:
+            s = self._data.get(rid)
+            if s is None:
+                s = self._data[rid] = [0, 0, 0, 0, 0]
+            s[2] += 1
+        if self._thread is None:
+            self._start()
+
+    def _start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._loop, name="rule-stats", daemon=True)
+        self._thread.start()
+        atexit.register(self.flush)
+
+    def _loop(self):
+        while True:
+            time.sleep(self.interval)
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            data, self._data = self._data, {}
+        if not data:
+            return
+        counters, maxima = [], []
+        for rid, (evals, hits, drops, total_ns, max_ns) in data.items():
+            labels = {"rule": rid}
+            if evals:
+                # 命中数为 0 也写：从未命中的规则在 /metrics 里显示为 0
+                counters.append(("rule_evaluations_total", evals, labels))
+                counters.append(("rule_matches_total", hits, labels))
+                counters.append(("rule_seconds_total", total_ns / 1e9, labels))
+                maxima.append(("rule_max_seconds", max_ns / 1e9, labels))
+            if drops:
+                counters.append(("rule_drops_total", drops, labels))
+        metrics.incr_many(counters)
+        metrics.max_many(maxima)
+
+
+_live = _LiveStats(RULE_STATS_ENABLED, RULE_STATS_FLUSH_SECONDS)
+
+RULE_METRICS = ("rule_evaluations_total", "rule_matches_total", "rule_drops_total", "rule_seconds_total", "rule_max_seconds")
+
+
+# ── 过滤 ────────────────────────────────────────────────────────
+
+def pass_filter(text: str, rule: dict) -> bool:
+    """关键词/正则过滤（黑名单优先 + 可选白名单）
+
+    逻辑（与另一个 TG 项目的 filter_text 完全对齐）：
+    1) block 命中 → 直接丢弃（最高优先级）
+    2) 若 require_allows=true，则必须命中 allow 关键词/正则才放行
+    3) 若 require_allows=false（默认），allow 不生效，block 没命中就放行
+
+    配置来源：config.yaml → rules.filter
+    """
+    if not rule:
+        return True
+
+    text = text or ""
+
+    # --- block（黑名单）：命中即丢弃 ---
+    block_kw = rule.get("block_keywords") or rule.get("keywords") or []
+    block_re = rule.get("block_regex") or rule.get("regex") or []
+
+    for i, k in enumerate(block_kw):
+        if _check(f"filter.block_keywords[{i}]", k, text, block=True):
+            return False
+    for i, rg in enumerate(block_re):
+        if _check(f"filter.block_regex[{i}]", rg, text, block=True, regex=True):
+            return False
+
+    # --- allow（白名单）：require_allows=true 时必须命中才放行 ---
+    require_allows = rule.get("require_allows", False)
+    if require_allows:
+        allow_kw = rule.get("allow_keywords") or []
+        allow_re = rule.get("allow_regex") or []
+
+        if not allow_kw and not allow_re:
+            # 配置了 require_allows 但没给任何 allow 规则 → 全部放行（避免误杀）
+            return True
+
+        hit_allow = any(_check(f"filter.allow_keywords[{i}]", k, text) for i, k in enumerate(allow_kw))
+        if not hit_allow:
+            hit_allow = any(_check(f"filter.allow_regex[{i}]", rg, text, regex=True) for i, rg in enumerate(allow_re))
+        if not hit_allow:
+            _live.drop("filter.require_allows")
+        return hit_allow
+
+    return True
+
+
+def _check(rid: str, item, text: str, block: bool = False, regex: bool = False) -> bool:
+    """执行单条过滤规则并计数（黑名单命中即记一次丢弃）。"""
+    t0 = time.perf_counter_ns()
+    hit = _search(rid, item, text) if regex else item in text
+    _live.observe(rid, hit, time.perf_counter_ns() - t0, drop=block and hit)
+    return hit
+
+
+# ── 文案清洗 ────────────────────────────────────────────────────
+
+def _parse_flags(flags_str: str) -> int:
+    """将 "msi" 这样的 flag 字符串转成 re 标志位组合。"""
+    result = 0
+    for ch in flags_str.lower():
+        if ch in _FLAG_MAP:
+            result |= _FLAG_MAP[ch]
+    return result
+
+
+def load_transforms(raw_rules: list | None = None) -> list[dict]:
+    """加载并预编译清洗规则（默认取 config.yaml 的 rules.transforms）。
+
+    返回列表，每个元素:
+      - type="regex_replace": {"id", "type", "compiled": re.Pattern, "repl": str}
+      - type="append":        {"id", "type", "text": str}
+    """
+    if raw_rules is None:
+        raw_rules = cfg_get("rules.transforms") or []
+    compiled: list[dict] = []
+
+    for idx, rule in enumerate(raw_rules):
+        rtype = rule.get("type", "")
+        rid = f"transforms[{idx}]"
+        if rtype == "regex_replace":
+            pattern = rule.get("pattern", "")
+            repl = rule.get("repl", "")
+            flags_str = rule.get("flags", "ms")
+            try:
+                compiled.append({
+                    "id": rid,
+                    "type": "regex_replace",
+                    "compiled": _engine.compile(pattern, _parse_flags(flags_str)),
+                    "repl": repl,
+                })
+            except _REGEX_ERRORS as e:
+                _log("ERROR", f"❌ 清洗规则 #{idx} 正则编译失败：{e} pattern={pattern}")
+        elif rtype == "append":
+            text = rule.get("text", "")
+            compiled.append({"id": rid, "type": "append", "text": text})
+        else:
+            _log("WARN", f"⚠️ 清洗规则 #{idx} 未知类型：{rtype}")
+
+    return compiled
+
+
+TRANSFORMS: list[dict] = load_transforms()
+
+
+def normalize_forward_text(
+    text: str,
+    apply_append: bool = True,
+    transforms: list[dict] | None = None,
+    observe: bool = True,
+) -> str:
+    """转发前文案清洗 —— 按 rules.transforms 里的规则依次执行。
+
+    执行逻辑：
+    1. 遍历规则列表，对每条规则：
+       - regex_replace：re.sub(compiled, repl, text)
+       - append：在文末追加固定文本（apply_append=False 时跳过，
+         近似去重用：每条帖子都追加同一段模板，会让指纹趋同）
+    2. 内置收尾：多空行收敛 (≥3 个换行→2 个) + 首尾去空白
+
+    规则在导入时一次性加载并预编译，修改 YAML 后只需重启 worker。
+    每条正则限时 rules.regex_timeout_ms，超时跳过该规则（文本保持原样继续下一条）。
+    transforms 不传时用线上规则（TRANSFORMS）并计入线上计数；试跑时传入候选规则，不计数。
+    observe=False：用线上规则但不计数（worker 算近似去重指纹的那一遍，发送内容那一遍才计）。
+    """
+    if not text:
+        return ""
+
+    t = text.replace("\r\n", "\n").replace("\r", "\n")
+
+    live = transforms is None and observe
+    for rule in TRANSFORMS if transforms is None else transforms:
+        rtype = rule["type"]
+        t0 = time.perf_counter_ns()
+        if rtype == "regex_replace":
+            t, n = _subn(rule, t)
+            hit = n > 0
+        elif rtype == "append" and apply_append:
+            before = t
+            t = _append(t, rule["text"])
+            hit = t != before
+        else:
+            continue
+        if live:
+            _live.observe(rule["id"], hit, time.perf_counter_ns() - t0)
+
+    return _finish(t)
+
+
+def _append(t: str, append_text: str) -> str:
+    # 追加前先去尾部空白，追加后保证以换行分隔
+    t = t.rstrip()
+    if t:
+        # YAML 的 literal block (|) 会保留尾部换行，strip 一下
+        t += "\n\n" + append_text.strip()
+    return t
+
+
+def _finish(t: str) -> str:
+    # 内置：多空行收敛，去首尾空白
+    return _RE_MULTI_NEWLINE.sub("\n\n", t).strip()
+
+
+# ── 静态回溯检查 ────────────────────────────────────────────────
+
+def _items(sub) -> list:
+    return list(sub.data if hasattr(sub, "data") else sub)
+
+
+def _children(op, av) -> list:
+    """某个节点下的子序列（SubPattern）。"""
+    if op in (MAX_REPEAT, MIN_REPEAT):
+        return [av[2]]
+    if op == SUBPATTERN:
+        return [av[-1]]
+    if op == BRANCH:
+        return list(av[1])
+    if op in (ASSERT, ASSERT_NOT):
+        return [av[1]]
+    return []
+
+
+def _is_unbounded(op, av) -> bool:
+    return op in (MAX_REPEAT, MIN_REPEAT) and av[1] == MAXREPEAT
+
+
+def _has_unbounded(sub) -> bool:
+    for op, av in _items(sub):
+        if _is_unbounded(op, av) or any(_has_unbounded(c) for c in _children(op, av)):
+            return True
+    return False
+
+
+def _has_any(sub) -> bool:
+    for op, av in _items(sub):
+        if op == ANY or any(_has_any(c) for c in _children(op, av)):
+            return True
+    return False
+
+
+def _walk(sub, risks: list[str]):
+    items = _items(sub)
+    for i, (op, av) in enumerate(items):
+        if _is_unbounded(op, av):
+            if _has_unbounded(av[2]):
+                risks.append("嵌套无界量词（如 (a+)+、(?:\\n.*?)*?）：最坏指数级回溯")
+            # 紧挨着的两个无界量词且其一是 .：同一段字符有多种切分方式，最坏多项式级回溯
+            if i + 1 < len(items) and _is_unbounded(*items[i + 1]):
+                if _has_any(av[2]) or _has_any(items[i + 1][1][2]):
+                    risks.append("相邻的可重叠无界量词（如 .*.*、\\s*.*）：最坏多项式级回溯")
+        for c in _children(op, av):
+            _walk(c, risks)
+
+
+def backtracking_risks(pattern: str, flags: int = 0) -> list[str]:
+    """静态检查正则的灾难性回溯风险（启发式，可能漏报/误报），返回风险描述（去重）。"""
+    try:
+        parsed = _sre_parse.parse(pattern, flags)
+    except Exception:
+        return []
+    risks: list[str] = []
+    _walk(parsed, risks)
+    return list(dict.fromkeys(risks))
+
+
+def _filter_rules(rule: dict) -> list[tuple[str, str, str]]:
+    """把 rules.filter 展开成 (规则编号, kind, 关键词或正则) 列表。"""
+    out = []
+    block_kw = rule.get("block_keywords") or rule.get("keywords") or []
+    block_re = rule.get("block_regex") or rule.get("regex") or []
+    for name, kind, items in (
+        ("block_keywords", "keyword", block_kw),
+        ("block_regex", "regex", block_re),
+        ("allow_keywords", "keyword", rule.get("allow_keywords") or []),
+        ("allow_regex", "regex", rule.get("allow_regex") or []),
+    ):
+        for i, item in enumerate(items):
+            out.append((f"filter.{name}[{i}]", kind, str(item)))
+    return out
+
+
+def _catalog(filter_rule: dict, raw_transforms: list) -> dict[str, tuple[str, str]]:
+    """{规则编号: (kind, 关键词 / 正则 / 追加文本)}，顺序与配置一致。"""
+    patterns = {rid: (kind, item) for rid, kind, item in _filter_rules(filter_rule)}
+    for idx, rule in enumerate(raw_transforms):
+        patterns[f"transforms[{idx}]"] = (rule.get("type", ""), rule.get("pattern") or rule.get("text") or "")
+    return patterns
+
+
+def audit(filter_rule: dict | None = None, raw_transforms: list | None = None) -> dict[str, list[str]]:
+    """对过滤 / 清洗规则里的所有正则做静态检查：{规则编号: [风险, ...]}（只含有风险的）。"""
+    if filter_rule is None:
+        filter_rule = cfg_get("rules.filter") or {}
+    if raw_transforms is None:
+        raw_transforms = cfg_get("rules.transforms") or []
+    out: dict[str, list[str]] = {}
+    for rid, kind, item in _filter_rules(filter_rule):
+        if kind == "regex":
+            risks = backtracking_risks(item)
+            if risks:
+                out[rid] = risks
+    for idx, rule in enumerate(raw_transforms):
+        if rule.get("type") == "regex_replace":
+            # 与 load_transforms 相同的 flags（这里用 re 的常量，只做解析）
+            flags = 0
+            for ch in str(rule.get("flags", "ms")).lower():
+                flags |= {"s": re.DOTALL, "m": re.MULTILINE, "i": re.IGNORECASE}.get(ch, 0)
+            risks = backtracking_risks(rule.get("pattern", ""), flags)
+            if risks:
+                out[f"transforms[{idx}]"] = risks
+    return out
+
+
+for _rid, _risks in audit().items():
+    _log("WARN", f"⚠️ 规则 {_rid} 有回溯风险：{'；'.join(_risks)}（执行限时 {REGEX_TIMEOUT_MS:.0f}ms）", event="regex_risk")
+
+
+# ── 试跑 / 语料评估 ─────────────────────────────────────────────
+
+def _record(stats: dict, rid: str, hit: bool, ns: int):
+    s = stats.setdefault(rid, [0, 0, 0, 0, 0])  # 命中, 执行次数, 累计 ns, 最大 ns, 超时次数
+    s[0] += 1 if hit else 0
+    s[1] += 1
+    s[2] += ns
+    s[3] = max(s[3], ns)
+
+
+def _timeout_recorder(stats: dict):
+    """试跑时超时只记进报告，不写线上计数。"""
+    def _on_timeout(rid: str):
+        stats.setdefault(rid, [0, 0, 0, 0, 0])[4] += 1
+    return _on_timeout
+
+
+def _trace_filter(text: str, rule: dict, expanded: list, stats: dict) -> tuple[bool, list[str]]:
+    """逐条执行过滤规则（不短路：每条规则都计时，才能发现从不命中的规则），判定结果与 pass_filter 一致。"""
+    if not rule:
+        return True, []
+    matched: list[str] = []
+    on_timeout = _timeout_recorder(stats)
+    for rid, kind, item in expanded:
+        t0 = time.perf_counter_ns()
+        if kind == "keyword":
+            hit = item in text
+        else:
+            hit = _search(rid, item, text, on_timeout)
+        _record(stats, rid, hit, time.perf_counter_ns() - t0)
+        if hit:
+            matched.append(rid)
+
+    if any(m.startswith("filter.block_") for m in matched):
+        return False, matched
+    if rule.get("require_allows", False):
+        has_allow = any(rid.startswith("filter.allow_") for rid, _, _ in expanded)
+        if has_allow and not any(m.startswith("filter.allow_") for m in matched):
+            return False, matched
+    return True, matched
+
+
+def _trace_transforms(text: str, transforms: list[dict], stats: dict) -> tuple[str, list[str]]:
+    """与 normalize_forward_text 相同的清洗流程，逐条计时并记录哪些规则改动了文本。"""
+    if not text:
+        return "", []
+    t = text.replace("\r\n", "\n").replace("\r", "\n")
+    matched: list[str] = []
+    on_timeout = _timeout_recorder(stats)
+    for rule in transforms:
+        t0 = time.perf_counter_ns()
+        if rule["type"] == "regex_replace":
+            t, n = _subn(rule, t, on_timeout)
+            hit = n > 0
+        elif rule["type"] == "append":
+            before = t
+            t = _append(t, rule["text"])
+            hit = t != before
+        else:
+            continue
+        _record(stats, rule["id"], hit, time.perf_counter_ns() - t0)
+        if hit:
+            matched.append(rule["id"])
+    return _finish(t), matched
+
+
+def _diff(before: str, after: str) -> list[str]:
+    return list(difflib.unified_diff(before.splitlines(), after.splitlines(), "before", "after", lineterm="", n=1))
+
+
+def _evaluate_chunk(args: tuple) -> tuple[list[dict], dict]:
+    """进程池入口：规则以原始配置传入，在子进程里编译。"""
+    corpus, filter_rule, raw_transforms, keep_items = args
+    transforms = load_transforms(raw_transforms)
+    expanded = _filter_rules(filter_rule or {})
+    stats: dict = {}
+    items: list[dict] = []
+    for doc in corpus:
+        text = doc["text"]
+        passed, matched = _trace_filter(text, filter_rule, expanded, stats)
+        after, changed_by = _trace_transforms(text, transforms, stats)
+        # 对照组：只做内置收尾（换行统一、多空行收敛、去首尾空白），diff 只反映规则本身的改动
+        before = _finish(text.replace("\r\n", "\n").replace("\r", "\n"))
+        if len(items) < keep_items:
+            items.append({
+                "id": doc["id"],
+                "passed": passed,
+                "matched": matched + changed_by,
+                "changed": after != before,
+                "before": text,
+                "after": after,
+                "diff": _diff(before, after) if after != before else [],
+            })
+        else:
+            # 只统计，不带正文（控制返回体大小）
+            items.append({"passed": passed, "changed": after != before})
+    return items, stats
+
+
+def normalize_corpus(docs) -> list[dict]:
+    """语料统一成 [{id, text}]：元素可以是任务 payload（含 text / chat_id / msg_id）或纯字符串。"""
+    out = []
+    for i, d in enumerate(docs):
+        if isinstance(d, str):
+            out.append({"id": str(i), "text": d})
+        elif isinstance(d, dict):
+            if d.get("chat_id") is not None and d.get("msg_id") is not None:
+                did = f"{d['chat_id']}:{d['msg_id']}"
+            else:
+                did = str(d.get("id", i))
+            out.append({"id": did, "text": str(d.get("text") or "")})
+    return out
+
+
+def evaluate(
+    docs,
+    filter_rule: dict | None = None,
+    raw_transforms: list | None = None,
+    processes: int | None = None,
+    max_items: int = 200,
+) -> dict:
+    """在语料上试跑过滤 + 清洗规则（默认线上规则），返回逐条结果与逐规则统计。
+
+    processes：进程数（None = CPU 数，最多不超过 CPU 数；1 = 不用进程池）；语料不足 _PARALLEL_THRESHOLD 条时总在本进程跑。
+    进程池用 spawn，子进程会重新导入调用方的主模块：只在轻量入口（命令行 rules.py）里开，管理 API 传 1。
+    max_items：返回逐条明细的上限（统计覆盖全部语料）。
+    """
+    if filter_rule is None:
+        filter_rule = cfg_get("rules.filter") or {}
+    if raw_transforms is None:
+        raw_transforms = cfg_get("rules.transforms") or []
+    corpus = normalize_corpus(docs)
+    started = time.perf_counter()
+
+    cpus = os.cpu_count() or 1
+    nproc = min(max(processes or cpus, 1), cpus)
+    if nproc > 1 and len(corpus) >= _PARALLEL_THRESHOLD:
+        size = -(-len(corpus) // nproc)
+        chunks = [corpus[i:i + size] for i in range(0, len(corpus), size)]
+        args, left = [], max_items
+        for chunk in chunks:
+            args.append((chunk, filter_rule, raw_transforms, max(left, 0)))
+            left -= len(chunk)
+        # spawn：listen 进程里有事件循环和后台线程，fork 不安全
+        with ProcessPoolExecutor(max_workers=len(chunks), mp_context=multiprocessing.get_context("spawn")) as pool:
+            results = list(pool.map(_evaluate_chunk, args))
+    else:
+        nproc = 1
+        results = [_evaluate_chunk((corpus, filter_rule, raw_transforms, max_items))]
+
+    items: list[dict] = []
+    stats: dict = {}
+    for part_items, part_stats in results:
+        items.extend(part_items)
+        for rid, (hits, evals, total_ns, max_ns, timeouts) in part_stats.items():
+            s = stats.setdefault(rid, [0, 0, 0, 0, 0])
+            s[0] += hits
+            s[1] += evals
+            s[2] += total_ns
+            s[3] = max(s[3], max_ns)
+            s[4] += timeouts
+
+    patterns = _catalog(filter_rule, raw_transforms)
+    risks = audit(filter_rule, raw_transforms)
+    rules = []
+    for rid, (kind, pattern) in patterns.items():
+        hits, evals, total_ns, max_ns, timeouts = stats.get(rid, (0, 0, 0, 0, 0))
+        rules.append({
+            "id": rid,
+            "kind": kind,
+            "pattern": pattern,
+            "hits": hits,
+            "evals": evals,
+            "total_us": round(total_ns / 1000, 1),
+            "mean_us": round(total_ns / evals / 1000, 2) if evals else 0.0,
+            "max_us": round(max_ns / 1000, 1),
+            "timeouts": timeouts,
+            "risks": risks.get(rid, []),
+        })
+    rules.sort(key=lambda x: -x["total_us"])
+
+    return {
+        "total": len(corpus),
+        "passed": sum(1 for it in items if it["passed"]),
+        "blocked": sum(1 for it in items if not it["passed"]),
+        "changed": sum(1 for it in items if it["changed"]),
+        "elapsed_ms": round((time.perf_counter() - started) * 1000, 1),
+        "processes": nproc,
+        "rules": rules,
+        "unused_rules": [x["id"] for x in rules if x["hits"] == 0],
+        "risky_rules": sorted(risks),
+        "items": [it for it in items if "id" in it],
+    }
+
+
+_SERIES_RE = re.compile(r'^(\w+)\{rule="(.*)"\}$')
+
+
+def live_report(snap: dict) -> dict:
+    """把 metrics 快照（metrics.snapshot() 的结构）里的线上规则计数整理成逐条规则的报告。
+
+    按当前配置列出全部规则（从未执行 / 从未命中的也在），另附配置里已不存在的旧编号；
+    改过规则顺序后编号会错位，用 POST /api/system/rules/reset 清零重新统计。
+    """
+    series: dict[str, dict[str, float]] = {}
+    for kind in ("counters", "gauges"):
+        for key, value in (snap.get(kind) or {}).items():
+            m = _SERIES_RE.match(key)
+            if m and (m.group(1) in RULE_METRICS or m.group(1) == "rule_regex_timeout_total"):
+                series.setdefault(m.group(2), {})[m.group(1)] = float(value)
+
+    patterns = _catalog(cfg_get("rules.filter") or {}, cfg_get("rules.transforms") or [])
+    if (cfg_get("rules.filter") or {}).get("require_allows", False):
+        patterns["filter.require_allows"] = ("require_allows", "")
+    rules = []
+    for rid in list(patterns) + sorted(set(series) - set(patterns)):
+        kind, pattern = patterns.get(rid, ("stale", ""))
+        s = series.get(rid, {})
+        evals = int(s.get("rule_evaluations_total", 0))
+        total = s.get("rule_seconds_total", 0.0)
+        rules.append({
+            "id": rid,
+            "kind": kind,
+            "pattern": pattern,
+            "evals": evals,
+            "hits": int(s.get("rule_matches_total", 0)),
+            "drops": int(s.get("rule_drops_total", 0)),
+            "timeouts": int(s.get("rule_regex_timeout_total", 0)),
+            "total_us": round(total * 1e6, 1),
+            "mean_us": round(total / evals * 1e6, 2) if evals else 0.0,
+            "max_us": round(s.get("rule_max_seconds", 0.0) * 1e6, 1),
+        })
+    rules.sort(key=lambda x: -x["total_us"])
+    return {
+        "flush_seconds": RULE_STATS_FLUSH_SECONDS if RULE_STATS_ENABLED else 0,
+        "rules": rules,
+        "unused_rules": [x["id"] for x in rules if x["evals"] and not x["hits"] and x["kind"] != "require_allows"],
+        "stale_rules": [x["id"] for x in rules if x["kind"] == "stale"],
+    }
+
+
+def parse_jsonl(text: str) -> list:
+    """JSONL 语料：每行一个任务 payload（至少含 text）或一个 JSON 字符串；空行跳过。"""
+    docs = []
+    for n, line in enumerate(text.splitlines(), 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            docs.append(json.loads(line))
+        except ValueError as e:
+            raise ValueError(f"line {n}: {e}") from e
+    return docs
+
+
+def load_candidate(path: str) -> tuple[dict | None, list | None]:
+    """候选规则文件（YAML，与 config.yaml 的 rules 段同形）→ (filter, transforms)，缺省项为 None。"""
+    import yaml
+
+    with open(path, encoding="utf-8") as f:
+        data = yaml.safe_load(f) or {}
+    data = data.get("rules", data)
+    return data.get("filter"), data.get("transforms")
+
+
+def queued_payloads(limit: int) -> list[dict]:
+    """发送队列（queue / backlog / low）里待发任务的 payload，只读不出队。"""
+    import redis
+
+    import task_codec
+    from drain import QUEUE_KEY, BACKLOG_KEY, LOW_KEY
+
+    r = redis.Redis(host=os.getenv("REDIS_HOST"), decode_responses=True)
+    docs: list[dict] = []
+    for key in (QUEUE_KEY, BACKLOG_KEY, LOW_KEY):
+        if len(docs) >= limit:
+            break
+        # 右端是最早入队的
+        for raw in reversed(r.lrange(key, -(limit - len(docs)), -1)):
+            try:
+                docs.append(task_codec.decode(raw))
+            except Exception:
+                continue
+    return docs
+
+
+# ── 命令行 ──────────────────────────────────────────────────────
+
+def _print_report(rep: dict, show: int):
+    print(
+        f"语料 {rep['total']} 条：放行 {rep['passed']} 拦截 {rep['blocked']} 被清洗改动 {rep['changed']}，"
+        f"耗时 {rep['elapsed_ms']}ms（进程数 {rep['processes']}）"
+    )
+    print(f"\n{'规则':28s} {'命中':>6s} {'累计µs':>10s} {'平均µs':>8s} {'最大µs':>8s}  内容")
+    for x in rep["rules"]:
+        print(f"{x['id']:28s} {x['hits']:6d} {x['total_us']:10.1f} {x['mean_us']:8.2f} {x['max_us']:8.1f}  {x['pattern'][:40]!r}")
+    if rep["unused_rules"]:
+        print(f"\n⚠️ 从未命中：{', '.join(rep['unused_rules'])}")
+    for x in rep["rules"]:
+        if x["timeouts"]:
+            print(f"⏱️ {x['id']} 超时 {x['timeouts']} 次（预算 {REGEX_TIMEOUT_MS:.0f}ms）")
+        for risk in x["risks"]:
+            print(f"⚠️ {x['id']} 回溯风险：{risk}")
+    for it in rep["items"][:show]:
+        if it["diff"] or not it["passed"]:
+            print(f"\n── {it['id']} {'放行' if it['passed'] else '拦截'} 命中={it['matched']}")
+            for line in it["diff"]:
+                print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="在语料上试跑过滤 / 清洗规则，输出 diff、命中与逐规则耗时")
+    src = parser.add_mutually_exclusive_group(required=True)
+    src.add_argument("--jsonl", help="JSONL 语料文件（- 表示标准输入）")
+    src.add_argument("--dead", type=int, metavar="N", help="最近 N 条死信的 payload")
+    src.add_argument("--queued", type=int, metavar="N", help="发送队列中待发的前 N 条任务")
+    parser.add_argument("--rules", help="候选规则 YAML（不传则用 config.yaml 的线上规则）")
+    parser.add_argument("--processes", type=int, default=None, help="进程数（默认 CPU 数，1 = 不并行）")
+    parser.add_argument("--show", type=int, default=20, help="输出多少条 diff（默认 20）")
+    parser.add_argument("--json", action="store_true", help="输出完整 JSON 报告")
+    args = parser.parse_args()
+
+    if args.jsonl:
+        text = sys.stdin.read() if args.jsonl == "-" else open(args.jsonl, encoding="utf-8").read()
+        docs = parse_jsonl(text)
+    elif args.dead:
+        from db import list_dead
+
+        docs = [row["payload"] for row in list_dead(limit=args.dead)]
+    else:
+        docs = queued_payloads(args.queued)
+
+    filter_rule, raw_transforms = load_candidate(args.rules) if args.rules else (None, None)
+    rep = evaluate(docs, filter_rule, raw_transforms, args.processes, max_items=max(args.show, 200))
+    if args.json:
+        print(json.dumps(rep, ensure_ascii=False, indent=2))
+    else:
+        _print_report(rep, args.show)
+
+
+if __name__ == "__main__":
+    main()
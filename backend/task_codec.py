@@ -0,0 +1,197 @@
+"""
+队列任务编解码（带版本号）。
+
+以前每条任务都是完整 JSON：模板 dict、channel_name 在每条消息里重复一份，
+静默时段积压几百条时 Redis 内存大头都是这些重复内容；而且没有版本号，改字段很危险。
+
+编码格式（Redis 用 decode_responses=True，值必须是文本）：
+    T1:j:{json}          未压缩
+    T1:z:{base85(zlib)}  压缩（未安装 zstandard 时）
+    T1:s:{base85(zstd)}  压缩
+- 前缀 T{版本}：解码按版本分派，未知版本抛 ValueError
+- 模板按内容哈希驻留在 codec:templates（任务里只放 template_ref）
+- channel_name 按 chat_id 驻留在 codec:channels（任务里不再携带）
+- 序列化后超过 codec.compress_threshold 字节才压缩（base85 膨胀 25%，短文本压缩不划算）
+- 旧格式（以 "{" 开头的 JSON）照常解码：队列里、dead.payload 里的历史数据都兼容
+
+orjson / zstandard 为可选依赖，缺失时退回 json / zlib。
+"""
+
+import base64
+import hashlib
+import json
+import os
+import threading
+import time
+import zlib
+
+import redis
+
+from config import get as cfg_get
+from log import get_logger
+
+try:
+    import orjson
+except Exception:  # pragma: no cover
+    orjson = None
+
+try:
+    import zstandard
+except Exception:  # pragma: no cover
+    zstandard = None
+
+VERSION = 1
+
+_TEMPLATES_KEY = "codec:templates"
+_CHANNELS_KEY = "codec:channels"
+
+try:
+    COMPRESS_THRESHOLD = max(int(cfg_get("codec.compress_threshold", 1024)), 0)
+except Exception:
+    COMPRESS_THRESHOLD = 1024
+
+INTERN_ENABLED = bool(cfg_get("codec.intern", True))
+
+# channel_name 本地缓存有效期（秒）；频道改名后最多这么久生效
+_CHANNEL_CACHE_TTL = 300.0
+
+_r = redis.Redis(host=os.getenv("REDIS_HOST"), decode_responses=True)
+
+_lock = threading.Lock()
+# 模板按内容寻址，不会变：本地只增不删
+_templates: dict[str, dict] = {}
+_channels: dict[str, tuple[str, float]] = {}
+
+
+_log = get_logger("codec")
+
+
+def _dumps(obj) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def _loads(data):
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+# ── 驻留 ────────────────────────────────────────────────────────
+
+def _intern_template(tpl: dict) -> str:
+    blob = json.dumps(tpl, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+    ref = hashlib.sha1(blob.encode("utf-8")).hexdigest()[:12]
+    with _lock:
+        known = ref in _templates
+    if not known:
+        _r.hsetnx(_TEMPLATES_KEY, ref, blob)
+        with _lock:
+            _templates[ref] = tpl
+    return ref
+
+
+def _lookup_template(ref: str) -> dict | None:
+    with _lock:
+        tpl = _templates.get(ref)
+    if tpl is not None:
+        return tpl
+    try:
+        blob = _r.hget(_TEMPLATES_KEY, ref)
+    except Exception:
+        blob = None
+    if not blob:
+        _log("WARN", f"⚠️ 模板引用缺失 ref={ref}，按无模板处理")
+        return None
+    tpl = json.loads(blob)
+    with _lock:
+        _templates[ref] = tpl
+    return tpl
+
+
+def _intern_channel(chat_id: str, name: str):
+    now = time.time()
+    with _lock:
+        cached = _channels.get(chat_id)
+        if cached and cached[0] == name and now - cached[1] < _CHANNEL_CACHE_TTL:
+            return
+        _channels[chat_id] = (name, now)
+    _r.hset(_CHANNELS_KEY, chat_id, name)
+
+
+def _lookup_channel(chat_id: str) -> str:
+    now = time.time()
+    with _lock:
+        cached = _channels.get(chat_id)
+    if cached and now - cached[1] < _CHANNEL_CACHE_TTL:
+        return cached[0]
+    try:
+        name = _r.hget(_CHANNELS_KEY, chat_id) or ""
+    except Exception:
+        return cached[0] if cached else ""
+    with _lock:
+        _channels[chat_id] = (name, now)
+    return name
+
+
+# ── 编解码 ──────────────────────────────────────────────────────
+
+def encode(task: dict, intern: bool = True) -> str:
+    """任务 dict → 队列字符串。
+
+    intern=False 时模板/频道名原样内嵌（写入 dead 表等需要自包含的场景）。
+    驻留写 Redis 失败时自动退回内嵌，不影响入队。
+    """
+    body = dict(task)
+    if intern and INTERN_ENABLED:
+        try:
+            tpl = body.get("template")
+            if tpl:
+                body["template_ref"] = _intern_template(tpl)
+                body.pop("template", None)
+            name = body.get("channel_name")
+            if name and body.get("chat_id") is not None:
+                _intern_channel(str(body["chat_id"]), name)
+                body.pop("channel_name", None)
+                body["channel_ref"] = 1
+        except Exception as e:
+            _log("WARN", f"⚠️ 驻留失败，按内嵌编码：{e}")
+            body = dict(task)
+
+    data = _dumps(body)
+    if COMPRESS_THRESHOLD and len(data) > COMPRESS_THRESHOLD:
+        if zstandard is not None:
+            return f"T{VERSION}:s:" + base64.b85encode(zstandard.ZstdCompressor(level=3).compress(data)).decode("ascii")
+        return f"T{VERSION}:z:" + base64.b85encode(zlib.compress(data, 6)).decode("ascii")
+    return f"T{VERSION}:j:" + data.decode("utf-8")
+
+
+def decode(raw) -> dict:
+    """队列字符串 → 任务 dict（兼容旧 JSON）。"""
+    if isinstance(raw, bytes):
+        raw = raw.decode("utf-8")
+    if raw.startswith("{"):
+        return json.loads(raw)
+
+    head, sep, rest = raw.partition(":")
+    if not sep or head != f"T{VERSION}":
+        raise ValueError(f"unsupported task encoding: {raw[:16]!r}")
+    kind, sep, payload = rest.partition(":")
+    if kind == "j":
+        body = _loads(payload)
+    elif kind == "z":
+        body = _loads(zlib.decompress(base64.b85decode(payload)))
+    elif kind == "s":
+        if zstandard is None:
+            raise ValueError("zstd-compressed task but zstandard is not installed")
+        body = _loads(zstandard.ZstdDecompressor().decompress(base64.b85decode(payload)))
+    else:
+        raise ValueError(f"unsupported task encoding: {raw[:16]!r}")
+
+    ref = body.pop("template_ref", None)
+    if ref:
+        body["template"] = _lookup_template(ref)
+    if body.pop("channel_ref", None):
+        body["channel_name"] = _lookup_channel(str(body.get("chat_id")))
+    return body
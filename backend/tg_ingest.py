@@ -0,0 +1,314 @@
+"""
+TG 消息入队路径：listener（app.py 的实时事件 / 启动补拉）与历史回灌（backfill.py）共用。
+
+这里只放入队需要的东西（Telegram 配置、Redis、转发配置、认领 / 高水位、handle_message），
+不创建 TelegramClient：backfill 导入本模块不会碰 listener 的 session 库。
+"""
+
+import asyncio
+import os
+import random
+import time
+
+import redis
+
+from config import CFG, get as cfg_get
+from log import get_logger
+from db import is_processed, mark_processed
+from image_hash import ImageDupIndex, dhash, IMAGE_DUP_ACTION
+from drain import UPLOAD_KEY, UPLOAD_LOW_KEY
+import task_codec
+from rules import pass_filter
+
+# === Telegram 配置（从 config.yaml）===
+TG_API_ID = int(cfg_get("telegram.api_id"))
+TG_API_HASH = cfg_get("telegram.api_hash")
+SESSION = cfg_get("telegram.session", "userbot")
+TG_SESSION_DIR = (cfg_get("telegram.session_dir") or "/app/sessions").rstrip("/")
+
+# 确保 session 目录存在
+try:
+    os.makedirs(TG_SESSION_DIR, exist_ok=True)
+except Exception:
+    pass
+
+# Redis
+r = redis.Redis(host=os.getenv("REDIS_HOST"), decode_responses=True)
+
+# 图片感知哈希索引（跨源海报去重，从 Redis 重建）
+_image_index = ImageDupIndex(r)
+
+_log = get_logger("listen")
+
+
+def _normalize_gray_ratio(v) -> float:
+    """兼容两种写法：
+    - 0~1 概率（推荐）
+    - 0~100 百分比（旧前端 UI 可能会写入）
+    """
+    try:
+        x = float(v)
+    except Exception:
+        return 1.0
+
+    if x <= 0:
+        return 0.0
+    if x > 1:
+        # 认为是百分比
+        return min(x / 100.0, 1.0)
+    return x
+
+
+def _fanout_targets() -> list[str]:
+    """qq.targets → 目标 channel_id 列表（元素可为字符串或 {channel_id, send_interval}）。"""
+    out: list[str] = []
+    for t in cfg_get("qq.targets") or []:
+        cid = t.get("channel_id") if isinstance(t, dict) else t
+        cid = str(cid or "").strip()
+        if cid and cid not in out:
+            out.append(cid)
+    return out
+
+
+def _build_forward_conf() -> dict:
+    """从 config.yaml 构建转发配置（每次消息调用，支持热重载后的潜在扩展）。"""
+    fwd = CFG.get("forward") or {}
+    fltr = cfg_get("rules.filter") or {}
+    return {
+        "enabled": fwd.get("enabled", True),
+        "qq_channel_id": str(cfg_get("qq.target_channel_id") or "").strip(),
+        "targets": _fanout_targets(),
+        "gray_ratio": fwd.get("gray_ratio", 1),
+        "template": {
+            "prefix": fwd.get("template_prefix", ""),
+            "suffix": fwd.get("template_suffix", ""),
+        },
+        "filter": fltr,
+    }
+
+
+def normalize_source(u) -> str:
+    u = str(u).strip()
+    if u and not u.startswith("@"):
+        u = "@" + u
+    return u
+
+
+def _debug_tg_events_enabled() -> bool:
+    return cfg_get("logging.debug_tg_events", False)
+
+
+# 每个源已见过的最大 msg_id（高水位），listener 重启后从这里补拉停机期间漏掉的消息
+HWM_KEY = "tg:hwm"
+
+_HWM_ADVANCE_LUA = """
+local cur = tonumber(redis.call('hget', KEYS[1], ARGV[1]) or '0')
+if tonumber(ARGV[2]) > cur then
+    redis.call('hset', KEYS[1], ARGV[1], ARGV[2])
+    return 1
+end
+return 0
+"""
+
+# 入队认领：实时事件与启动补拉可能同时拿到同一条消息，而 processed 表要等 worker 发出后才写，
+# 所以入队前先 SET NX 认领 tg:claim:{chat_id}:{msg_id}；认领要活过排队 + 静默时段 + 重试
+_CLAIM_PREFIX = "tg:claim:"
+try:
+    TG_CLAIM_TTL_SECONDS = max(int(cfg_get("telegram.claim_ttl_seconds", 172800)), 60)
+except Exception:
+    TG_CLAIM_TTL_SECONDS = 172800
+
+# 处理失败（下载 / 入队抛异常）的消息：高水位会被同源后面的消息推过去，补拉不会再经过它，
+# 所以记进 tg:failed:{chat_id}（msg_id → 失败次数），下次启动补拉时按 id 重新拉取；失败满次数后放弃
+FAILED_KEY = "tg:failed:{}"
+try:
+    TG_FAILED_MAX_ATTEMPTS = max(int(cfg_get("telegram.failed_max_attempts", 3)), 1)
+except Exception:
+    TG_FAILED_MAX_ATTEMPTS = 3
+
+# 上传阶段：带图任务先交给 uploader.py 预上传（关闭则直接进发送队列，由 worker 发送时上传）
+UPLOAD_STAGE_ENABLED = bool(cfg_get("upload.enabled", True))
+
+
+def advance_hwm(chat_id, msg_id: int):
+    try:
+        r.eval(_HWM_ADVANCE_LUA, 1, HWM_KEY, str(chat_id), int(msg_id))
+    except Exception:
+        pass
+
+
+def _claim(chat_id, msg_id: int) -> bool:
+    """认领一条消息的入队权；Redis 不可用时放行（退回只靠 processed 去重）。"""
+    try:
+        return bool(r.set(f"{_CLAIM_PREFIX}{chat_id}:{msg_id}", 1, nx=True, ex=TG_CLAIM_TTL_SECONDS))
+    except Exception:
+        return True
+
+
+def _release_claim(chat_id, msg_id: int):
+    try:
+        r.delete(f"{_CLAIM_PREFIX}{chat_id}:{msg_id}")
+    except Exception:
+        pass
+
+
+def _record_failed(chat_id, msg_id: int):
+    try:
+        key = FAILED_KEY.format(chat_id)
+        pipe = r.pipeline()
+        pipe.hincrby(key, str(msg_id), 1)
+        pipe.expire(key, TG_CLAIM_TTL_SECONDS)
+        pipe.execute()
+    except Exception:
+        pass
+
+
+async def handle_message(
+    message,
+    origin: str = "live",
+    queue_key: str = "queue",
+    priority: str | None = None,
+) -> bool:
+    """单条 TG 消息的统一处理：去重 → 开关/灰度 → 关键词过滤 → 下载图片 → 图片去重 → 入队。
+
+    实时事件（on_new_message）、启动补拉（catch_up_sources）与历史回灌（backfill.py）共用；
+    回灌传 queue_key="queue:low" + priority="low"，走低优先级通道。
+    返回是否已入队。正常返回（入队或被过滤）才推进该源的高水位；
+    下载 / 入队抛异常的消息记进 FAILED_KEY，由下次启动补拉按 id 重试（高水位不替它兜底）。
+    同一条消息同一时间只有一条路径能处理（_claim）；没入队或出错时释放认领。
+    """
+    if not _claim(message.chat_id, message.id):
+        if _debug_tg_events_enabled():
+            _log("INFO", f"⏭️ 跳过（已被其他路径认领）chat_id={message.chat_id} msg_id={message.id} origin={origin}", event="tg_event")
+        return False
+    try:
+        queued = await _handle_message(message, origin, queue_key, priority)
+    except Exception:
+        _release_claim(message.chat_id, message.id)
+        _record_failed(message.chat_id, message.id)
+        raise
+    if not queued:
+        _release_claim(message.chat_id, message.id)
+    advance_hwm(message.chat_id, message.id)
+    return queued
+
+
+def media_path_for(message) -> str | None:
+    """消息图片的本地落盘路径（确定性命名：预取与入队路径共用，已存在则不重复下载）。"""
+    if message.photo:
+        return f"/tmp/{message.chat_id}_{message.id}.jpg"
+    if message.document:
+        # 部分 TG 频道以 document 形式发送图片（大图/PNG/GIF）
+        mime = getattr(message.document, "mime_type", "") or ""
+        if mime.startswith("image/"):
+            ext = mime.split("/")[-1].replace("jpeg", "jpg")
+            return f"/tmp/{message.chat_id}_{message.id}.{ext}"
+    return None
+
+
+async def _handle_message(message, origin: str, queue_key: str, priority: str | None) -> bool:
+    chat_id_str = str(message.chat_id)
+    msg_id = message.id
+
+    if _debug_tg_events_enabled():
+        _log(
+            "INFO",
+            f"📩 收到消息 chat_id={chat_id_str} msg_id={msg_id} origin={origin}",
+            event="tg_event",
+        )
+
+    # 去重
+    if is_processed(message.chat_id, msg_id):
+        if _debug_tg_events_enabled():
+            _log("INFO", f"⏭️ 跳过（已处理）chat_id={chat_id_str} msg_id={msg_id}", event="tg_event")
+        return False
+
+    conf = _build_forward_conf()
+
+    if not conf.get("enabled", True):
+        if _debug_tg_events_enabled():
+            _log("INFO", "⏭️ 跳过（转发已关闭）", event="tg_event")
+        return False
+
+    if random.random() > _normalize_gray_ratio(conf.get("gray_ratio", 1)):
+        if _debug_tg_events_enabled():
+            _log("INFO", f"⏭️ 跳过（灰度过滤）gray_ratio={conf.get('gray_ratio')}", event="tg_event")
+        return False
+
+    text = message.text or ""
+
+    if not pass_filter(text, conf.get("filter")):
+        if _debug_tg_events_enabled():
+            _log("INFO", "⏭️ 跳过（关键词过滤）", event="tg_event")
+        return False
+
+    media = media_path_for(message)
+    if media and not os.path.exists(media):
+        await message.download_media(media)
+
+    # 图片去重：换了文案/重新压缩的同一张海报，在上传和发布之前就拦下
+    media_phash = None
+    if media:
+        h = await asyncio.to_thread(dhash, media)
+        if h is not None:
+            # query 会先从 Redis 增量同步指纹，同样放到线程里，不占 Telethon 事件循环
+            hit = await asyncio.to_thread(_image_index.query, h)
+            if hit:
+                dup_key, dup_hash, dup_dist = hit
+                if IMAGE_DUP_ACTION == "skip":
+                    mark_processed(message.chat_id, msg_id)
+                    try:
+                        os.remove(media)
+                    except Exception:
+                        pass
+                    if _debug_tg_events_enabled():
+                        _log("INFO", f"⏭️ 跳过（重复图片）chat_id={chat_id_str} msg_id={msg_id} 原帖={dup_key} 距离={dup_dist}", event="tg_event")
+                    return False
+                # flag：照常发送，用原图指纹命中 worker 的上传缓存
+                h = dup_hash
+                _log("INFO", f"🔁 重复图片（仍发送）chat_id={chat_id_str} msg_id={msg_id} 原帖={dup_key} 距离={dup_dist}")
+            # 指纹由 worker 发布成功后登记（image_hash.record）
+            media_phash = f"{h:016x}"
+
+    chat = message.chat
+    if chat is None:
+        try:
+            chat = await message.get_chat()
+        except Exception:
+            chat = None
+
+    payload = {
+        "chat_id": int(message.chat_id),
+        "msg_id": int(msg_id),
+        "text": text,
+        "media": media,
+        # 图片 dHash（16 位 hex），worker 据此复用已上传的图床 URL
+        "media_phash": media_phash,
+        # 纯 env 模式：qq_channel_id 可以为空，worker 会用 QQ_TARGET_GUILD_ID 自动选择
+        "qq_channel_id": conf.get("qq_channel_id") or "",
+        # 多目标 fan-out：非空时 worker 并行发往这些频道（优先于 qq_channel_id）
+        "targets": conf.get("targets") or [],
+        "template": conf.get("template"),
+        "channel_name": getattr(chat, "title", "") or "",
+        # 源标识（与 telegram.sources 写法一致），配额按源分配
+        "source": f"@{chat.username}" if getattr(chat, "username", None) else chat_id_str,
+        # 入队时间：静默时段积压规划按它判断是否过期
+        "ts": int(time.time()),
+    }
+    if priority:
+        payload["priority"] = priority
+
+    # 带图任务先进上传阶段（uploader.py 预上传图片），完成后再推进 queue_key
+    if media and UPLOAD_STAGE_ENABLED:
+        payload["dest"] = queue_key
+        queue_key = UPLOAD_LOW_KEY if priority == "low" else UPLOAD_KEY
+
+    r.lpush(queue_key, task_codec.encode(payload))
+
+    if _debug_tg_events_enabled():
+        _log(
+            "INFO",
+            f"✅ 已入队 chat_id={chat_id_str} msg_id={msg_id} 有图片={bool(media)} origin={origin}",
+            event="tg_event",
+        )
+    return True
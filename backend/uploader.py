@@ -0,0 +1,145 @@
+"""
+上传阶段（upload 服务）：介于 listen 与 publish 之间，专门预上传图片。
+
+以前图片在 worker 发送路径里上传：排在频道限速之后串行执行，一张图上传多久就占用多久发送位。
+现在：
+- listen 下载完图片，把带图任务放进 queue:upload（回灌的低优先级任务进 queue:upload:low），
+  原本要进的发送队列记在任务的 dest 字段
+- 这里并行上传（upload.concurrency），与 QQ 发送节奏无关；成功后把 image_url 写回任务，
+  再推进 dest 队列。worker 看到 image_url 就只剩构造 RichText + PUT 发帖
+- 并行上传、按出队顺序转发：同一队列里的先后不变（慢的一张只会挡住转发，不挡后续上传）
+- 默认不使用 QQ CDN（消耗消息配额、产生空消息、受频道限速）：upload.allow_qq_cdn
+- 上传失败不丢任务：不带 image_url 照常转发，worker 发送时再兜底上传（含 QQ CDN）
+- 进程退出不丢任务：出队用 LMOVE / BLMOVE 挪进 queue:upload:processing，转发成功（推进 dest）与
+  从 processing 删除在同一个事务里；重启时 processing 里的任务先放回 queue:upload 重新处理。
+  推进 dest 失败（Redis 抖动）就退避重试，不会丢；按单实例部署设计（supervisord 一个 uploader）
+
+与 worker 共用 prepare_image_url（上传缓存 / 压缩重试 / 图床路由）。
+"""
+
+import queue
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from config import get as cfg_get
+from drain import QUEUE_KEY, UPLOAD_KEY, UPLOAD_LOW_KEY, UPLOAD_PROCESSING_KEY
+from log import get_logger
+import metrics
+import quota
+import task_codec
+from worker import r, prepare_image_url, _resolve_targets
+
+try:
+    UPLOAD_CONCURRENCY = max(int(cfg_get("upload.concurrency", 4)), 1)
+except Exception:
+    UPLOAD_CONCURRENCY = 4
+
+ALLOW_QQ_CDN = bool(cfg_get("upload.allow_qq_cdn", False))
+
+_log = get_logger("upload")
+
+_pool = ThreadPoolExecutor(max_workers=UPLOAD_CONCURRENCY, thread_name_prefix="upload")
+
+
+def _upload(task: dict) -> str | None:
+    t = time.perf_counter()
+    targets = _resolve_targets(task)
+    url = prepare_image_url(
+        targets[0] if targets else "",
+        task["media"],
+        task.get("media_phash"),
+        quota.source_of(task),
+        allow_quota=ALLOW_QQ_CDN,
+    )
+    metrics.incr("upload_stage_total", result="ok" if url else "error")
+    metrics.set_gauge("upload_stage_last_seconds", round(time.perf_counter() - t, 3))
+    return url
+
+
+def _push_and_ack(dest: str, encoded: str, raw: str):
+    """推进发送队列 + 从 processing 删除（同一事务）；失败退避重试，直到成功。"""
+    delay = 1.0
+    while True:
+        try:
+            pipe = r.pipeline()
+            pipe.lpush(dest, encoded)
+            pipe.lrem(UPLOAD_PROCESSING_KEY, 1, raw)
+            pipe.execute()
+            return
+        except Exception as e:
+            _log("ERROR", f"❌ 推进发送队列失败，{delay:.0f}s 后重试（任务仍在 {UPLOAD_PROCESSING_KEY}）：{e}")
+            time.sleep(delay)
+            delay = min(delay * 2, 30.0)
+
+
+def _forward_in_order(pending: queue.Queue):
+    """按出队顺序等待上传结果，写回 image_url 后推进发送队列。"""
+    while True:
+        fut, task, raw = pending.get()
+        try:
+            url = fut.result()
+        except Exception as e:
+            _log("WARN", f"⚠️ 预上传异常，交给 worker 兜底：{e} chat_id={task.get('chat_id')} msg_id={task.get('msg_id')}")
+            url = None
+        dest = task.pop("dest", None) or QUEUE_KEY
+        if url:
+            task["image_url"] = url
+        _push_and_ack(dest, task_codec.encode(task), raw)
+        _log(
+            "DEBUG",
+            f"📦 预上传完成 chat_id={task.get('chat_id')} msg_id={task.get('msg_id')} → {dest} image_url={'有' if url else '无'}",
+            event="upload_forward",
+        )
+
+
+def _recover_processing() -> int:
+    """上次退出时还没转发完的任务放回 queue:upload 队头（下一个就出队）。"""
+    n = 0
+    while r.lmove(UPLOAD_PROCESSING_KEY, UPLOAD_KEY, "LEFT", "RIGHT") is not None:
+        n += 1
+    if n:
+        _log("WARN", f"♻️ 找回 {n} 条上次未转发完的上传任务")
+    return n
+
+
+def _take() -> str | None:
+    """出队并挪进 processing：实时任务优先，回灌任务在空闲时上传。"""
+    raw = r.lmove(UPLOAD_KEY, UPLOAD_PROCESSING_KEY, "RIGHT", "LEFT")
+    if raw is None:
+        raw = r.lmove(UPLOAD_LOW_KEY, UPLOAD_PROCESSING_KEY, "RIGHT", "LEFT")
+    if raw is None:
+        # 都空：阻塞等实时任务，超时后回到上面再看一眼低优先级队列
+        raw = r.blmove(UPLOAD_KEY, UPLOAD_PROCESSING_KEY, 1, "RIGHT", "LEFT")
+    return raw
+
+
+def main():
+    _log("INFO", f"🚀 Upload 启动：并发={UPLOAD_CONCURRENCY} QQ CDN={'允许' if ALLOW_QQ_CDN else '不用'}")
+    _recover_processing()
+    # 有界：转发跟不上时（如 Redis 抖动）停止出队，任务留在 Redis 里
+    pending: queue.Queue = queue.Queue(maxsize=UPLOAD_CONCURRENCY * 2)
+    threading.Thread(target=_forward_in_order, args=(pending,), name="upload-forward", daemon=True).start()
+
+    while True:
+        raw = _take()
+        if raw is None:
+            continue
+        try:
+            task = task_codec.decode(raw)
+        except Exception as e:
+            _log("ERROR", f"❌ 任务解码失败，丢弃：{e} raw={raw[:120]}")
+            r.lrem(UPLOAD_PROCESSING_KEY, 1, raw)
+            continue
+
+        if task.get("image_url") or not task.get("media"):
+            # 已有 URL（死信重放等）或无图：不上传，但仍按顺序转发
+            fut: Future = Future()
+            fut.set_result(task.get("image_url"))
+        else:
+            fut = _pool.submit(_upload, task)
+        pending.put((fut, task, raw))
+
+
+if __name__ == "__main__":
+    main()
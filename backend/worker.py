@@ -1,17 +1,28 @@
 import os
 import json
 import time
+import datetime
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import requests
 import redis
-from PIL import Image
-import re
-import yaml
 
 from config import CFG, get as cfg_get
+from log import get_logger
 from db import mark_processed, save_dead
 
-from qq_auth import auth_headers, get_token_status
-from qq_ws_keepalive import QQWsKeepAlive
+from qq_auth import auth_headers, get_token_status, get_access_token
+from qq_ws_keepalive import create_keepalive
+import qq_directory
+from drain import BACKLOG_KEY, LOW_KEY, QUEUE_KEY, plan_backlog, backlog_length, drain_interval
+from near_dup import NearDupDetector, NEAR_DUP_ACTION
+import image_hash
+from image_hash import cached_upload_url, remember_upload_url
+from image_hosts import ImageHostRouter
+import quota
+import retry
+import task_codec
+from rules import TRANSFORMS, normalize_forward_text
 
 r = redis.Redis(host=os.getenv("REDIS_HOST"), decode_responses=True)
 
@@ -22,10 +33,7 @@ QQ_TARGET_CHANNEL_ID = str(cfg_get("qq.target_channel_id") or "").strip()
 QQ_TARGET_GUILD_ID = str(cfg_get("qq.target_guild_id") or "").strip()
 
 
-def _log(level: str, msg: str):
-    # 简单结构化，方便 docker logs grep
-    ts = time.strftime("%Y-%m-%d %H:%M:%S")
-    print(f"[{ts}] publish  | {level:5s} | {msg}")
+_log = get_logger("publish")
 
 
 # 防风控：发送间隔（秒）
@@ -34,10 +42,37 @@ try:
 except Exception:
     SEND_INTERVAL = 1.5
 
+# 限流（304045）后该频道的冷却时间（秒）
+try:
+    RATE_LIMIT_COOLDOWN_SECONDS = float(cfg_get("qq.rate_limit_cooldown_seconds", 300))
+except Exception:
+    RATE_LIMIT_COOLDOWN_SECONDS = 300.0
+
+# 多目标 fan-out：qq.targets 里可为每个频道单独配置 send_interval
+_TARGET_INTERVALS: dict[str, float] = {}
+for _t in cfg_get("qq.targets") or []:
+    if isinstance(_t, dict) and _t.get("channel_id") and _t.get("send_interval") is not None:
+        try:
+            _TARGET_INTERVALS[str(_t["channel_id"]).strip()] = float(_t["send_interval"])
+        except Exception:
+            pass
+
+# 并行发布的最大频道数
+try:
+    FANOUT_CONCURRENCY = max(int(cfg_get("qq.fanout_concurrency", 4)), 1)
+except Exception:
+    FANOUT_CONCURRENCY = 4
+
 # 静默时段（QQ 频道 00:00~06:00 禁止主动消息）
 QUIET_HOURS_START = int(cfg_get("qq.quiet_hours_start", 0))
 QUIET_HOURS_END = int(cfg_get("qq.quiet_hours_end", 6))
 
+# 静默时段结束前多少秒开始预热（强制刷新 token + 确认 WS READY）
+try:
+    QUIET_PREWARM_SECONDS = float(cfg_get("qq.quiet_prewarm_seconds", 180))
+except Exception:
+    QUIET_PREWARM_SECONDS = 180.0
+
 
 def _in_quiet_hours() -> bool:
     """检查当前是否处于静默时段。"""
@@ -48,191 +83,60 @@ def _in_quiet_hours() -> bool:
         return hour >= QUIET_HOURS_START or hour < QUIET_HOURS_END
 
 
-def _guess_first_text_channel_id() -> str | None:
-    """从 guild_id 自动挑选一个可用的“可发言频道” channel_id。
-
-    兼容：
-    - 旧逻辑：type=0（文字）
-    - 新频道形态：type=10007/10011 等（你当前实际返回就是这些）
+def _seconds_until_quiet_end() -> float:
+    """距离下一次静默时段结束（QUIET_HOURS_END:00:00）还有多少秒。"""
+    now = datetime.datetime.now()
+    end = now.replace(hour=QUIET_HOURS_END, minute=0, second=0, microsecond=0)
+    if end <= now:
+        end += datetime.timedelta(days=1)
+    return (end - now).total_seconds()
 
-    选择策略：
-    1) 优先选择 speak_permission == 1 的频道
-    2) type 优先顺序：0 -> 10007/10011/…（可扩展）
-    3) 跳过明显的分类节点（常见 type=4）
-    4) 实在找不到就回退到第一个带 id 的频道
-    """
-    if not QQ_TARGET_GUILD_ID:
-        return None
 
-    # 已知可发消息的类型（会因 QQ 频道形态而变化，先覆盖常见）
-    preferred_types = [0, 10007, 10011]
-    skip_types = {4}
+def _prewarm_before_resume():
+    """静默时段结束前预热：强制刷新 token，并确认 WS 已 READY。
 
+    夜里 token 可能过期、WS 可能断开；提前处理好，避免恢复后的第一批发送
+    走鉴权失败 → 刷新 → 重试的路径。
+    """
     try:
-        resp = requests.get(
-            f"{BOT_API_BASE}/guilds/{QQ_TARGET_GUILD_ID}/channels",
-            headers=auth_headers(),
-            timeout=15,
-        )
-        if not resp.ok:
-            _log(
-                "ERROR",
-                f"❌ 频道列表获取失败 guild_id={QQ_TARGET_GUILD_ID} status={resp.status_code} body={resp.text}",
-            )
-            return None
-
-        data = resp.json()
-        channels = data
-        if isinstance(data, dict):
-            channels = data.get("data") or data.get("channels") or data.get("items") or []
-
-        if not isinstance(channels, list):
-            return None
+        get_access_token(force_refresh=True)
+        _log("INFO", f"🔑 预热：token 已刷新 {get_token_status()}")
+    except Exception as e:
+        _log("WARN", f"⚠️ 预热：token 刷新失败 err={e}")
 
-        def _cid(ch: dict) -> str | None:
-            cid = ch.get("id") or ch.get("channel_id")
-            return str(cid) if cid else None
+    if _keepalive.ready:
+        _log("INFO", "✅ 预热：QQ WS 已就绪")
+        return
 
-        def _type_int(ch: dict) -> int | None:
-            try:
-                return int(ch.get("type"))
-            except Exception:
-                return None
+    # 退避/熔断休眠中的保活线程立即重连，不等它自己醒来
+    _keepalive.reconnect_now()
+    timeout = max(_seconds_until_quiet_end() - 1.0, 1.0)
+    if _keepalive.wait_until_ready(timeout=timeout):
+        _log("INFO", "✅ 预热：QQ WS 已重新就绪")
+    else:
+        _log("WARN", f"⚠️ 预热：QQ WS 未就绪 err={_keepalive.last_error}")
 
-        def _can_speak(ch: dict) -> bool:
-            # speak_permission: 1 表示可发言（你返回里有这个字段）
-            try:
-                return int(ch.get("speak_permission", 0)) == 1
-            except Exception:
-                return False
-
-        # 1) 优先：可发言 + 优先类型
-        for t in preferred_types:
-            for ch in channels:
-                if not isinstance(ch, dict):
-                    continue
-                if _type_int(ch) in skip_types:
-                    continue
-                if _type_int(ch) == t and _can_speak(ch):
-                    cid = _cid(ch)
-                    if cid:
-                        return cid
-
-        # 2) 次优：优先类型（不强制 speak_permission 字段存在）
-        for t in preferred_types:
-            for ch in channels:
-                if not isinstance(ch, dict):
-                    continue
-                if _type_int(ch) in skip_types:
-                    continue
-                if _type_int(ch) == t:
-                    cid = _cid(ch)
-                    if cid:
-                        return cid
-
-        # 3) 兜底：任何可发言的频道
-        for ch in channels:
-            if not isinstance(ch, dict):
-                continue
-            if _type_int(ch) in skip_types:
-                continue
-            if _can_speak(ch):
-                cid = _cid(ch)
-                if cid:
-                    return cid
 
-        # 4) 最后兜底：第一个有 id 的
-        for ch in channels:
-            if isinstance(ch, dict) and _cid(ch):
-                return _cid(ch)
+def _guess_first_text_channel_id() -> str | None:
+    """从 guild_id 自动挑选一个可用的“可发言频道” channel_id。
 
-        return None
-    except Exception as e:
-        _log("ERROR", f"❌ 频道列表查询异常 guild_id={QQ_TARGET_GUILD_ID} err={e}")
-        return None
+    读频道目录缓存（qq_directory），选择算法与 /api/qq/pick-default-channel 共用同一实现。
+    """
+    return qq_directory.pick_default_channel_id(QQ_TARGET_GUILD_ID)
 
 
 # worker 侧最终使用的目标 channel_id：
 # - 优先使用 QQ_TARGET_CHANNEL_ID
-# - 若为空且提供了 QQ_TARGET_GUILD_ID，则自动选择
-DEFAULT_SEND_CHANNEL_ID = QQ_TARGET_CHANNEL_ID or _guess_first_text_channel_id() or ""
-
-_log(
-    "INFO",
-    "🚀 Worker 启动："
-    f"api_base={BOT_API_BASE} "
-    f"目标频道={'有' if bool(QQ_TARGET_CHANNEL_ID) else '无'} 目标服务器={'有' if bool(QQ_TARGET_GUILD_ID) else '无'} "
-    f"发送频道={DEFAULT_SEND_CHANNEL_ID or '(空)'} "
-    f"发送间隔={SEND_INTERVAL}s",
-)
-
-# ============================================================
-# YAML 驱动的文案清洗规则引擎
-# ============================================================
-# 规则来源：config.yaml → rules.transforms
-# 修改 config.yaml 后 docker compose restart worker 即可生效。
-# ============================================================
-
-_FLAG_MAP = {
-    "s": re.DOTALL,
-    "m": re.MULTILINE,
-    "i": re.IGNORECASE,
-}
-
-# 多空行收敛（内置，不可关闭）
-_RE_MULTI_NEWLINE = re.compile(r"\n{3,}")
-
-
-def _parse_flags(flags_str: str) -> int:
-    """将 "msi" 这样的 flag 字符串转成 re 标志位组合。"""
-    result = 0
-    for ch in flags_str.lower():
-        if ch in _FLAG_MAP:
-            result |= _FLAG_MAP[ch]
-    return result
-
-
-def _load_transforms() -> list[dict]:
-    """从 config.yaml 的 rules.transforms 加载并预编译清洗规则。
-
-    返回列表，每个元素:
-      - type="regex_replace": {"type", "compiled": re.Pattern, "repl": str}
-      - type="append":        {"type", "text": str}
-    """
-    raw_rules = cfg_get("rules.transforms") or []
-    compiled: list[dict] = []
-
-    for idx, rule in enumerate(raw_rules):
-        rtype = rule.get("type", "")
-        if rtype == "regex_replace":
-            pattern = rule.get("pattern", "")
-            repl = rule.get("repl", "")
-            flags_str = rule.get("flags", "ms")
-            try:
-                compiled.append({
-                    "type": "regex_replace",
-                    "compiled": re.compile(pattern, _parse_flags(flags_str)),
-                    "repl": repl,
-                })
-            except re.error as e:
-                _log("ERROR", f"❌ 清洗规则 #{idx} 正则编译失败：{e} pattern={pattern}")
-        elif rtype == "append":
-            text = rule.get("text", "")
-            compiled.append({"type": "append", "text": text})
-        else:
-            _log("WARN", f"⚠️ 清洗规则 #{idx} 未知类型：{rtype}")
-
-    _log("INFO", f"📋 已加载 {len(compiled)} 条清洗规则")
-    return compiled
-
-
-_TRANSFORMS: list[dict] = _load_transforms()
+# - 若为空且提供了 QQ_TARGET_GUILD_ID，则在 main() 里自动选择（导入时不发网络请求）
+DEFAULT_SEND_CHANNEL_ID = QQ_TARGET_CHANNEL_ID
 
 
 def compress_image(src: str, max_size_mb: int = 9) -> str | None:
     """
     图片超限时压缩一次（质量递减）
     """
+    from PIL import Image  # 只有压缩路径用得到，按需加载
+
     try:
         img = Image.open(src).convert("RGB")
     except Exception:
@@ -375,260 +279,175 @@ def _build_richtext_json(body: str, image_url: str | None = None) -> str:
     return json.dumps({"paragraphs": paragraphs}, ensure_ascii=False)
 
 
-def send_with_image(channel_id: str, text: str, image_path: str):
-    """发送图文帖子到帖子频道。
+def prepare_image_url(
+    channel_id: str,
+    image_path: str,
+    phash: str | None = None,
+    source: str = "",
+    allow_quota: bool = True,
+) -> str | None:
+    """每个任务只上传一次图片，返回所有目标频道共用的图片 URL。
 
     策略（按优先级）：
-    1. 上传图片到 QQ CDN → 用 format=4 (JSON RichText) 发帖，图片用 ImageElem.third_url
-    2. 上传失败 → 降级为纯文本帖子（format=1）
+    1. 上传缓存命中（同一 dHash 的图片已上传过）→ 直接复用 URL
+    2. 原图上传（图床路由按健康度择优，见 image_hosts）
+    3. 原图上传失败 → 压缩后再传一次
+    全部失败返回 None，调用方降级为纯文本帖子。
+    allow_quota=False 时不使用消耗 QQ 配额的图床（upload 服务预上传用）。
     """
-    # 尝试上传图片到 QQ，获取 QQ 内部图片 URL
-    image_url = _upload_image_to_qq(channel_id, image_path)
+    image_url = cached_upload_url(r, phash)
+    if image_url:
+        _log("INFO", f"🖼️ 复用已上传图片：phash={phash} url={image_url[:80]}", event="upload_cache_hit")
+        return image_url
 
-    title, body = _build_title_and_body(text)
+    # 图片文件不存在时（死信重发、容器重启后 /tmp 清空），降级为纯文字
+    if not os.path.exists(image_path):
+        _log("WARN", f"⚠️ 媒体文件不存在，降级为纯文本：{image_path}")
+        return None
 
-    if image_url:
-        # 用 JSON RichText 格式，正文 + 图片
-        richtext_content = _build_richtext_json(body, image_url)
-        _log("INFO", f"📤 发送图文帖子：title={title[:30]} image_url={image_url[:80]}")
-        return requests.put(
-            f"{BOT_API_BASE}/channels/{channel_id}/threads",
-            headers={
-                **auth_headers(),
-                "Content-Type": "application/json",
-            },
-            json={
-                "title": title,
-                "content": richtext_content,
-                "format": 4,  # FORMAT_JSON (RichText)
-            },
-            timeout=15,
-        )
-    else:
-        # 图片上传失败，降级为纯文本帖子
-        _log("WARN", f"⚠️ 图片上传失败，降级为纯文本帖子")
-        return send_text(channel_id, text)
+    image_url = _upload_image(channel_id, image_path, source, allow_quota)
+    if not image_url:
+        compressed = compress_image(image_path)
+        if compressed:
+            image_url = _upload_image(channel_id, compressed, source, allow_quota)
+
+    remember_upload_url(r, phash, image_url or "")
+    return image_url
+
+
+def send_with_image(channel_id: str, text: str, image_url: str):
+    """发送图文帖子：format=4 (JSON RichText)，图片用 ImageElem.third_url。"""
+    title, body = _build_title_and_body(text)
+    richtext_content = _build_richtext_json(body, image_url)
+    _log("DEBUG", f"📤 发送图文帖子：channel={channel_id} title={title[:30]} image_url={image_url[:80]}")
+    return requests.put(
+        f"{BOT_API_BASE}/channels/{channel_id}/threads",
+        headers={
+            **auth_headers(),
+            "Content-Type": "application/json",
+        },
+        json={
+            "title": title,
+            "content": richtext_content,
+            "format": 4,  # FORMAT_JSON (RichText)
+        },
+        timeout=15,
+    )
 
 
-def _upload_image_to_qq(channel_id: str, image_path: str) -> str | None:
+def _upload_image(channel_id: str, image_path: str, source: str = "", allow_quota: bool = True) -> str | None:
     """上传图片并获取可在帖子中使用的图片 URL。
 
-    策略（按优先级）：
-    1. imgbb 图床（首选，不消耗 QQ API 配额，无副作用）
-    2. POST /channels/{channel_id}/messages 上传 file_image（备用，会消耗 QQ 消息配额）
+    由图床路由按健康度选择 imgbb / QQ CDN / 本地图床（见 image_hosts），
+    熔断中的图床直接跳过，首选过慢时对冲备用图床。
     """
-    # ── 首选：imgbb 图床 ──
-    imgbb_url = _upload_image_to_imgbb(image_path)
-    if imgbb_url:
-        return imgbb_url
+    return _image_router.upload(image_path, channel_id, source, allow_quota)
 
-    # ── 备用：QQ CDN（会消耗消息 API 配额，且可能产生空消息副作用）──
-    try:
-        with open(image_path, "rb") as f:
-            files = {
-                "file_image": (os.path.basename(image_path) or "image.jpg", f, "image/jpeg"),
-            }
-            data = {
-                "content": " ",  # 最少需要一个字符
-            }
-            resp = requests.post(
-                f"{BOT_API_BASE}/channels/{channel_id}/messages",
-                headers=auth_headers(),
-                data=data,
-                files=files,
-                timeout=30,
-            )
-        _log("INFO", f"🖼️ 图片上传(QQ CDN) status={resp.status_code} body={resp.text[:500]}")
-        if resp.ok:
-            body = resp.json()
-            attachments = body.get("attachments") or []
-            if attachments and isinstance(attachments, list):
-                url = attachments[0].get("url") or ""
-                if url:
-                    if not url.startswith("http"):
-                        url = "https://" + url
-                    _log("INFO", f"🖼️ 图片已上传 QQ CDN：{url}")
-                    return url
-            _log("WARN", f"⚠️ 图片上传响应无附件 URL")
-        else:
-            _log("WARN", f"⚠️ 图片上传 QQ CDN 失败：status={resp.status_code}")
-    except Exception as e:
-        _log("WARN", f"⚠️ 图片上传(QQ CDN)异常：{e}")
 
-    return None
+# 频道节奏存在 Redis（多副本 worker 共享）：qq:pace:{频道} = 下一个可发送时间点，qq:cooldown:{频道} = 限流冷却结束时间
+# （毫秒时间戳，PX 到点自动过期）；一个副本遇到 304045，其它副本也立刻停发该频道
+_PACE_KEY = "qq:pace:{}"
+_COOLDOWN_KEY = "qq:cooldown:{}"
 
+# KEYS[1] = 节奏 key，KEYS[2] = 冷却 key；ARGV = 当前时间（ms）, 发送间隔（ms）；返回预约到的发送时间点（ms）
+_PACE_RESERVE_LUA = """
+local now = tonumber(ARGV[1])
+local at = math.max(now, tonumber(redis.call('get', KEYS[1]) or '0'), tonumber(redis.call('get', KEYS[2]) or '0'))
+local nxt = at + tonumber(ARGV[2])
+redis.call('set', KEYS[1], nxt, 'PX', nxt - now + 1000)
+return at
+"""
 
-def _upload_image_to_imgbb(image_path: str) -> str | None:
-    """备用图床：使用 imgbb 免费 API 上传图片。
 
-    imgbb 免费账户无需 API key 也可上传（使用匿名上传）。
-    如果 config.yaml 配置了 imgbb_api_key 则使用，否则使用匿名。
+class _ChannelPacer:
+    """每个目标频道独立的发送节奏：最小间隔 + 限流冷却（线程安全）。
+
+    状态放在 Redis 里，多副本共享；Redis 不可用时退回进程内记录。
     """
-    import base64
 
-    try:
-        api_key = str(cfg_get("qq.imgbb_api_key", "")).strip()
+    def __init__(self, r):
+        self._r = r
+        self._lock = threading.Lock()
+        self._next_at: dict[str, float] = {}
+        self._cooldown_until: dict[str, float] = {}
 
-        with open(image_path, "rb") as f:
-            image_data = base64.b64encode(f.read()).decode("utf-8")
+    def _reserve(self, channel_id: str, interval: float) -> float:
+        now = time.time()
+        try:
+            at_ms = self._r.eval(
+                _PACE_RESERVE_LUA, 2, _PACE_KEY.format(channel_id), _COOLDOWN_KEY.format(channel_id),
+                int(now * 1000), int(interval * 1000),
+            )
+            return int(at_ms) / 1000.0
+        except Exception:
+            with self._lock:
+                at = max(now, self._next_at.get(channel_id, 0.0), self._cooldown_until.get(channel_id, 0.0))
+                self._next_at[channel_id] = at + interval
+            return at
+
+    def wait(self, channel_id: str):
+        """预约该频道的下一个发送时间点并等待到点。"""
+        interval = max(_TARGET_INTERVALS.get(channel_id, SEND_INTERVAL), 0.2)
+        at = self._reserve(channel_id, interval)
+        now = time.time()
+        if at > now:
+            time.sleep(at - now)
+
+    def cool_down(self, channel_id: str, seconds: float):
+        until = time.time() + seconds
+        with self._lock:
+            self._cooldown_until[channel_id] = until
+        try:
+            self._r.set(_COOLDOWN_KEY.format(channel_id), int(until * 1000), px=max(int(seconds * 1000), 1))
+        except Exception as e:
+            _log("WARN", f"⚠️ 频道冷却写入 Redis 失败（仅本副本生效）channel={channel_id} err={e}")
 
-        payload = {"image": image_data}
-        if api_key:
-            payload["key"] = api_key
-            upload_url = "https://api.imgbb.com/1/upload"
-        else:
-            # 无 key 时跳过 imgbb
-            _log("INFO", "ℹ️ 未配置 imgbb_api_key，跳过 imgbb 上传")
-            return None
+    def cooling_until(self, channel_id: str) -> float:
+        with self._lock:
+            local = self._cooldown_until.get(channel_id, 0.0)
+        try:
+            shared = self._r.get(_COOLDOWN_KEY.format(channel_id))
+        except Exception:
+            shared = None
+        return max(local, int(shared) / 1000.0 if shared else 0.0)
 
-        resp = requests.post(upload_url, data=payload, timeout=30)
-        if resp.ok:
-            data = resp.json().get("data", {})
-            url = data.get("url") or data.get("display_url") or ""
-            if url:
-                _log("INFO", f"🖼️ 图片已上传 imgbb：{url}")
-                return url
-        _log("WARN", f"⚠️ imgbb 上传失败：status={resp.status_code} body={resp.text[:200]}")
-    except Exception as e:
-        _log("WARN", f"⚠️ imgbb 上传异常：{e}")
-    return None
 
+_pacer = _ChannelPacer(r)
+_image_router = ImageHostRouter(r)
+_fanout_pool = ThreadPoolExecutor(max_workers=FANOUT_CONCURRENCY, thread_name_prefix="publish")
 
-def normalize_forward_text(text: str) -> str:
-    """转发前文案清洗 —— 按 transforms.yaml 里的规则依次执行。
 
-    执行逻辑：
-    1. 遍历 _TRANSFORMS 列表，对每条规则：
-       - regex_replace：re.sub(compiled, repl, text)
-       - append：在文末追加固定文本
-    2. 内置收尾：多空行收敛 (≥3 个换行→2 个) + 首尾去空白
+def _resolve_targets(task: dict) -> list[str]:
+    """任务携带的路由优先：targets（fan-out / 死信按频道重放）→ qq_channel_id → 自动选择的默认频道。"""
+    targets = [str(t).strip() for t in (task.get("targets") or []) if str(t).strip()]
+    if not targets:
+        cid = str(task.get("qq_channel_id") or "").strip() or DEFAULT_SEND_CHANNEL_ID
+        targets = [cid] if cid else []
+    return list(dict.fromkeys(targets))
 
-    规则在 worker 启动时一次性加载并预编译，修改 YAML 后只需重启 worker。
-    """
-    if not text:
-        return ""
-
-    t = text.replace("\r\n", "\n").replace("\r", "\n")
-
-    for rule in _TRANSFORMS:
-        rtype = rule["type"]
-        if rtype == "regex_replace":
-            t = rule["compiled"].sub(rule["repl"], t)
-        elif rtype == "append":
-            # 追加前先去尾部空白，追加后保证以换行分隔
-            t = t.rstrip()
-            if t:
-                append_text = rule["text"]
-                # YAML 的 literal block (|) 会保留尾部换行，strip 一下
-                t += "\n\n" + append_text.strip()
-
-    # 内置：多空行收敛
-    t = _RE_MULTI_NEWLINE.sub("\n\n", t)
-
-    # 去首尾空白
-    t = t.strip()
-
-    return t
-
-
-# 启动 WS 在线保活（后台线程）
-_keepalive = QQWsKeepAlive()
-_keepalive.start()
-
-# ── 首次启动：等待 WS 就绪（最多等 120s，避免 WS 没 ready 就开始发消息全部失败）──
-_log("INFO", "⏳ 等待 QQ WS 连接就绪...")
-if _keepalive.wait_until_ready(timeout=120):
-    _log("INFO", "✅ QQ WS 已就绪，开始处理队列")
-else:
-    _log("WARN", f"⚠️ QQ WS 120s 内未就绪 (err={_keepalive.last_error})，仍将处理队列")
-
-while True:
-    # ── 静默时段：QQ 频道 00:00~06:00 禁止主动消息 ──
-    # 消息留在 Redis 队列，时段结束后自动恢复发送
-    if _in_quiet_hours():
-        _log("INFO", f"🌙 静默时段 ({QUIET_HOURS_START}:00~{QUIET_HOURS_END}:00)，暂停消费队列...")
-        while _in_quiet_hours():
-            time.sleep(60)  # 每分钟检查一次
-        _log("INFO", "☀️ 静默时段结束，恢复消费队列")
-
-    # ── WS 不在线时，不从队列取消息，阻塞等待 ──
-    # 这样消息安全留在 Redis 里，WS 恢复后按顺序发出，不会进死信
-    if not _keepalive.ready:
-        _log("WARN", f"⚠️ QQ WS 未就绪，暂停消费队列... err={_keepalive.last_error}")
-        while not _keepalive.ready:
-            _keepalive.wait_until_ready(timeout=60)
-            if not _keepalive.ready:
-                _log("WARN", f"⚠️ QQ WS 仍未就绪，继续等待... err={_keepalive.last_error}")
-        _log("INFO", "✅ QQ WS 已恢复，继续消费队列")
-
-    _, raw = r.brpop("queue")
-    task = json.loads(raw)
-
-    chat_id = int(task["chat_id"])
-    msg_id = int(task["msg_id"])
-
-    # 纯 env 模式：优先用运行时自动选择到的 DEFAULT_SEND_CHANNEL_ID；否则回退任务内携带的 qq_channel_id
-    qq_channel_id = DEFAULT_SEND_CHANNEL_ID or str(task.get("qq_channel_id") or "")
-
-    if not qq_channel_id:
-        save_dead(chat_id, msg_id, "missing QQ target channel_id (QQ_TARGET_CHANNEL_ID empty)", task)
-        _log("ERROR", f"❌ 进入死信：缺少目标频道 ID chat_id={chat_id} msg_id={msg_id}")
-        time.sleep(1.0)
-        continue
-
-    # 模板处理
-    content = apply_template(
-        task.get("text", ""),
-        task.get("template"),
-        {"channel_name": task.get("channel_name", "")},
-    )
 
-    # 发送前文本规范化（按你的业务清洗规则）
-    content = normalize_forward_text(content)
+def _publish_once(channel_id: str, content: str, image_url: str | None) -> requests.Response:
+    if image_url:
+        resp = send_with_image(channel_id, content, image_url)
+        if resp.ok or _is_rate_limited(resp):
+            return resp
+        # 图文帖子失败，降级为纯文本
+        _log("WARN", f"⚠️ 图文帖子发送失败，降级为纯文本 channel={channel_id} status={resp.status_code}")
+    return send_text(channel_id, content)
+
 
-    success = False
-    err = None
+def publish_to_target(channel_id: str, content: str, image_url: str | None) -> tuple[str, str | None]:
+    """向单个目标频道发帖（频道级限速 + 鉴权重试 + 纯文本兜底）。
 
+    返回 (状态, 错误信息)，状态：ok / rate_limited / server（5xx）/ network（超时、连接失败）/ failed。
+    rate_limited / server / network 由调用方按 retry.classes 退避重试，failed 直接进死信。
+    """
+    _pacer.wait(channel_id)
     try:
-        resp = None
-
-        def _do_send_once() -> tuple[bool, requests.Response | None]:
-            if task.get("media"):
-                media_path = task["media"]
-                # 图片文件不存在时（死信重发、容器重启后 /tmp 清空），降级为纯文字
-                if not os.path.exists(media_path):
-                    _log("WARN", f"⚠️ 媒体文件不存在，降级为纯文本：{media_path}")
-                else:
-                    r1 = send_with_image(qq_channel_id, content, media_path)
-                    if r1.ok:
-                        return True, r1
-
-                    # 原图发送失败，尝试压缩后重试
-                    compressed = compress_image(media_path)
-                    if compressed:
-                        r2 = send_with_image(qq_channel_id, content, compressed)
-                        if r2.ok:
-                            return True, r2
-
-                # 图片发送全部失败，降级为纯文本
-                r3 = send_text(qq_channel_id, content)
-                return bool(r3.ok), r3
-
-            r0 = send_text(qq_channel_id, content)
-            return bool(r0.ok), r0
-
-        success, resp = _do_send_once()
-
-        # ── 限流检测：QQ 频道消息发送达到上限 → 暂停等待 ──
-        if not success and resp is not None and _is_rate_limited(resp):
-            _log("WARN", "⚠️ QQ 频道消息频率限制！推回队列，休眠 300s...")
-            # 把这条消息推回队列头部，不进死信
-            r.rpush("queue", json.dumps(task, ensure_ascii=False))
-            time.sleep(300)  # 等 5 分钟再继续
-            continue
+        resp = _publish_once(channel_id, content, image_url)
 
         # 失败时：鉴权/在线问题 → 强制刷新 token + 等待 WS ready → 再试一次
-        if not success and resp is not None:
+        if not resp.ok and not _is_rate_limited(resp):
             text_blob = None
             try:
                 text_blob = resp.text
@@ -636,7 +455,7 @@ while True:
                 text_blob = None
 
             if _is_auth_error(resp, text_blob) or _is_online_required_error(resp, text_blob):
-                _log("WARN", f"⚠️ 发送失败，刷新鉴权后重试 status={resp.status_code} body={text_blob}")
+                _log("WARN", f"⚠️ 发送失败，刷新鉴权后重试 channel={channel_id} status={resp.status_code} body={text_blob}")
                 _log("INFO", f"🔑 token状态={get_token_status()} ws就绪={_keepalive.ready} ws错误={_keepalive.last_error}")
 
                 # 强制刷新一次 token（如果拿不到新 token，会继续使用旧 token）
@@ -645,34 +464,38 @@ while True:
                 # 等待 WS ready（短等待，避免阻塞太久）
                 _keepalive.wait_until_ready()
 
-                success, resp = _do_send_once()
+                resp = _publish_once(channel_id, content, image_url)
 
-        if not success and resp is not None and err is None:
-            try:
-                err = f"http {resp.status_code}: {resp.text}"
-            except Exception:
-                err = f"http {resp.status_code}"
+        if resp.ok:
+            return "ok", None
+        try:
+            err = f"http {resp.status_code}: {resp.text}"
+        except Exception:
+            err = f"http {resp.status_code}"
+        return _failure_status(resp), err
 
     except Exception as e:
         err = str(e)
         # 最后兜底：能发文字就发文字
         try:
-            resp = send_text(qq_channel_id, content)
-            success = bool(resp.ok)
-            if not success and err is None:
-                err = f"http {resp.status_code}: {resp.text}"
+            resp = send_text(channel_id, content)
+            if resp.ok:
+                return "ok", None
+            return _failure_status(resp), f"{err}; fallback http {resp.status_code}: {resp.text}"
         except Exception as e2:
-            err = err or str(e2)
-            success = False
+            return ("network" if isinstance(e2, requests.RequestException) else "failed"), f"{err}; fallback {e2}"
+
+
+def _failure_status(resp: requests.Response) -> str:
+    if _is_rate_limited(resp):
+        return "rate_limited"
+    if resp.status_code >= 500:
+        return "server"
+    return "failed"
 
-    if success:
-        mark_processed(chat_id, msg_id)
-        _log("INFO", f"✅ 发送成功 chat_id={chat_id} msg_id={msg_id} channel={qq_channel_id}")
-    else:
-        save_dead(chat_id, msg_id, err or "send failed", task)
-        _log("ERROR", f"❌ 发送失败→死信 chat_id={chat_id} msg_id={msg_id} channel={qq_channel_id} err={err}")
 
-    # 清理临时媒体文件，避免 /tmp 积压
+def _cleanup_task_media(task: dict):
+    """清理临时媒体文件，避免 /tmp 积压。"""
     if task.get("media"):
         for f in (task["media"], task["media"].replace(".jpg", "_compressed.jpg")):
             try:
@@ -681,5 +504,246 @@ while True:
             except Exception:
                 pass
 
-    # 防风控：宁慢勿快
-    time.sleep(max(SEND_INTERVAL, 0.2))
+
+# 运行期对象在 main() 里创建：导入 worker 不连 Redis 索引、不起线程、不发网络请求
+_near_dup: NearDupDetector | None = None
+_keepalive = None
+
+
+def _startup() -> dict[str, float]:
+    """启动准备，返回各阶段耗时（毫秒）。
+
+    WS 保活最先启动（后台线程连接网关），默认频道选择与近似去重索引加载
+    与 WS 握手并行进行，最后才等 WS 就绪。
+    """
+    global _keepalive, _near_dup, DEFAULT_SEND_CHANNEL_ID
+    timings: dict[str, float] = {}
+
+    def _mark(name: str, since: float) -> float:
+        now = time.perf_counter()
+        timings[name] = (now - since) * 1000.0
+        return now
+
+    t = time.perf_counter()
+    # 启动 WS 在线保活（按 qq.ws_mode：多副本选主 / 外部服务 / 本进程独占）
+    _keepalive = create_keepalive()
+    _keepalive.start()
+    t = _mark("keepalive_start", t)
+
+    # 延迟重试：到期任务搬回发送队列
+    retry.start_mover(r)
+
+    # 上次排空途中重启：已有积压先重新规划（只清洗积压，不动新消息队列）
+    if backlog_length(r) > 0:
+        plan_backlog(r, save_dead, absorb_queue=False)
+
+    if not DEFAULT_SEND_CHANNEL_ID and QQ_TARGET_GUILD_ID:
+        DEFAULT_SEND_CHANNEL_ID = _guess_first_text_channel_id() or ""
+    t = _mark("default_channel", t)
+
+    # 文案清洗规则（rules.transforms）导入 rules 时已预编译
+    _log("INFO", f"📋 已加载 {len(TRANSFORMS)} 条清洗规则")
+
+    # 跨源近似重复检测（索引从 Redis 重建）
+    _near_dup = NearDupDetector(r)
+    t = _mark("near_dup_index", t)
+
+    _log(
+        "INFO",
+        "🚀 Worker 启动："
+        f"api_base={BOT_API_BASE} "
+        f"目标频道={'有' if bool(QQ_TARGET_CHANNEL_ID) else '无'} 目标服务器={'有' if bool(QQ_TARGET_GUILD_ID) else '无'} "
+        f"发送频道={DEFAULT_SEND_CHANNEL_ID or '(空)'} "
+        f"发送间隔={SEND_INTERVAL}s",
+    )
+
+    # ── 首次启动：等待 WS 就绪（最多等 120s，避免 WS 没 ready 就开始发消息全部失败）──
+    _log("INFO", "⏳ 等待 QQ WS 连接就绪...")
+    if _keepalive.wait_until_ready(timeout=120):
+        _log("INFO", "✅ QQ WS 已就绪，开始处理队列")
+    else:
+        _log("WARN", f"⚠️ QQ WS 120s 内未就绪 (err={_keepalive.last_error})，仍将处理队列")
+    _mark("ws_ready", t)
+    return timings
+
+
+def main():
+    t0 = time.perf_counter()
+    timings = _startup()
+    total = (time.perf_counter() - t0) * 1000.0
+    _log(
+        "INFO",
+        f"⏱️ 启动耗时 total={total:.0f}ms "
+        + " ".join(f"{k}={v:.0f}ms" for k, v in timings.items()),
+    )
+
+    while True:
+        # ── 静默时段：QQ 频道 00:00~06:00 禁止主动消息 ──
+        # 消息留在 Redis 队列，时段结束后自动恢复发送
+        if _in_quiet_hours():
+            _log("INFO", f"🌙 静默时段 ({QUIET_HOURS_START}:00~{QUIET_HOURS_END}:00)，暂停消费队列...")
+            # 精确睡到结束前 QUIET_PREWARM_SECONDS，预热后再睡到整点
+            remaining = _seconds_until_quiet_end()
+            if remaining > QUIET_PREWARM_SECONDS:
+                time.sleep(remaining - QUIET_PREWARM_SECONDS)
+            _prewarm_before_resume()
+            # 循环兜底：sleep 可能提前返回或系统时钟被调整
+            while _in_quiet_hours():
+                time.sleep(min(max(_seconds_until_quiet_end(), 0.05), 60))
+            _log("INFO", "☀️ 静默时段结束，恢复消费队列")
+
+            # 积压规划：过期/重复条目先剔除，剩余积压与新消息穿插、限速排空
+            plan_backlog(r, save_dead)
+
+        # ── WS 不在线时，不从队列取消息，阻塞等待 ──
+        # 这样消息安全留在 Redis 里，WS 恢复后按顺序发出，不会进死信
+        if not _keepalive.ready:
+            _log("WARN", f"⚠️ QQ WS 未就绪，暂停消费队列... err={_keepalive.last_error}")
+            while not _keepalive.ready:
+                _keepalive.wait_until_ready(timeout=60)
+                if not _keepalive.ready:
+                    _log("WARN", f"⚠️ QQ WS 仍未就绪，继续等待... err={_keepalive.last_error}")
+            _log("INFO", "✅ QQ WS 已恢复，继续消费队列")
+
+        # 配额跨天重置后，前一天延后的任务进积压，与积压一起过期 / 折叠后限速排空
+        if quota.release_deferred(r, BACKLOG_KEY):
+            plan_backlog(r, save_dead, absorb_queue=False)
+
+        # 新消息（queue）优先，积压（queue:backlog）在无新消息时才消费，历史回灌（queue:low）最后
+        # 带超时：队列空闲时也能定期执行上面的周期性检查
+        item = r.brpop([QUEUE_KEY, BACKLOG_KEY, LOW_KEY], timeout=60)
+        if item is None:
+            continue
+        popped_key, raw = item
+        try:
+            task = task_codec.decode(raw)
+        except Exception as e:
+            _log("ERROR", f"❌ 任务解码失败，丢弃：{e} raw={raw[:120]}")
+            continue
+
+        chat_id = int(task["chat_id"])
+        msg_id = int(task["msg_id"])
+
+        targets = _resolve_targets(task)
+
+        if not targets:
+            save_dead(chat_id, msg_id, "missing QQ target channel_id (QQ_TARGET_CHANNEL_ID empty)", task)
+            _log("ERROR", f"❌ 进入死信：缺少目标频道 ID chat_id={chat_id} msg_id={msg_id}")
+            time.sleep(1.0)
+            continue
+
+        # 模板处理
+        content = apply_template(
+            task.get("text", ""),
+            task.get("template"),
+            {"channel_name": task.get("channel_name", "")},
+        )
+
+        # 发送前文本规范化（按你的业务清洗规则）：清洗规则作用于套好模板的全文，与以前一致
+        content = normalize_forward_text(content)
+
+        # 跨源近似重复：不带模板/追加段的清洗正文做 SimHash（同一 chat 的帖子互不比对）；
+        # 这一遍不计入规则命中计数，避免每条消息算两次
+        body = normalize_forward_text(task.get("text", ""), apply_append=False, observe=False)
+        near_dup_fp, near_dup_hit = _near_dup.check(body, chat_id)
+        if near_dup_hit:
+            dup_key, dup_dist = near_dup_hit
+            if NEAR_DUP_ACTION == "skip":
+                mark_processed(chat_id, msg_id)
+                _cleanup_task_media(task)
+                _log("INFO", f"⏭️ 跳过（近似重复）chat_id={chat_id} msg_id={msg_id} 原帖={dup_key} 距离={dup_dist}", event="near_dup_skip")
+                continue
+            _log("WARN", f"🔁 近似重复（仍发送）chat_id={chat_id} msg_id={msg_id} 原帖={dup_key} 距离={dup_dist}")
+
+        # ── 限流冷却中的频道本轮不发；全部在冷却 → 放进延迟队列等冷却结束，worker 继续处理后面的任务 ──
+        now = time.time()
+        cooling = [ch for ch in targets if _pacer.cooling_until(ch) > now]
+        active = [ch for ch in targets if ch not in cooling]
+        if not active:
+            due = min(_pacer.cooling_until(ch) for ch in cooling)
+            retry.delay_until(r, popped_key, task, due)
+            _log("WARN", f"⏸️ 目标频道均在限流冷却中，{due - now:.0f}s 后重试 chat_id={chat_id} msg_id={msg_id} targets={cooling}")
+            continue
+
+        # 每日配额：按源份额决定发送 / 延后到次日 / 舍弃；本轮发往几个频道就按几条配额判断
+        # （冷却中的频道排到冷却结束后重新走这里）
+        source = quota.source_of(task)
+        decision = quota.decide(r, source, str(task.get("priority") or "normal"), units=len(active))
+        if decision == "defer":
+            quota.defer(r, raw)
+            _log("WARN", f"⏸️ 配额不足，延后到次日 chat_id={chat_id} msg_id={msg_id} source={source} targets={len(active)}")
+            continue
+        if decision == "shed":
+            save_dead(chat_id, msg_id, f"shed by daily quota (source={source})", task)
+            _cleanup_task_media(task)
+            _log("WARN", f"🗑️ 配额预测超额，舍弃低优先级任务→死信 chat_id={chat_id} msg_id={msg_id} source={source}")
+            continue
+
+        # ── 共享预处理：图片只上传一次，所有目标频道复用同一 URL ──
+        # 通常 upload 服务（uploader.py）已预先上传并写入 image_url；没有时在这里兜底上传
+        image_url = task.get("image_url")
+        if not image_url and task.get("media"):
+            try:
+                image_url = prepare_image_url(active[0], task["media"], task.get("media_phash"), source)
+            except Exception as e:
+                _log("WARN", f"⚠️ 图片预处理异常，降级为纯文本：{e}")
+                image_url = None
+
+        # ── 并行发布：每个频道独立限速、独立成功/死信状态 ──
+        results = dict(zip(
+            active,
+            _fanout_pool.map(lambda ch: publish_to_target(ch, content, image_url), active),
+        ))
+
+        ok_targets = [ch for ch, (st, _) in results.items() if st == "ok"]
+        failed = {ch: err for ch, (st, err) in results.items() if st == "failed"}
+
+        if ok_targets:
+            mark_processed(chat_id, msg_id)
+            _near_dup.record(f"{chat_id}:{msg_id}", near_dup_fp)
+            # 发布成功才登记图片指纹：被舍弃 / 跳过 / 进死信的帖子不挡后来的转发
+            image_hash.record(r, f"{chat_id}:{msg_id}", task.get("media_phash"))
+            quota.record(r, source, "publish", len(ok_targets))
+            _log("INFO", f"✅ 发送成功 chat_id={chat_id} msg_id={msg_id} channels={ok_targets}", event="publish_ok")
+
+        # 冷却中没发的频道：排到冷却结束（不计重试次数）
+        if cooling:
+            retry.delay_until(
+                r, popped_key, {**task, "targets": cooling, "image_url": image_url},
+                min(_pacer.cooling_until(ch) for ch in cooling),
+            )
+
+        # 限流 / 临时故障的频道按类别退避重试（同类频道合成一个任务），其余频道不受影响
+        requeued = bool(cooling)
+        for cls in retry.CLASSES:
+            chs = [ch for ch, (st, _) in results.items() if st == cls]
+            if not chs:
+                continue
+            if cls == "rate_limited":
+                for ch in chs:
+                    _pacer.cool_down(ch, RATE_LIMIT_COOLDOWN_SECONDS)
+            delay = retry.schedule(r, popped_key, {**task, "targets": chs, "image_url": image_url}, cls)
+            if delay is not None:
+                requeued = True
+                _log("WARN", f"⚠️ 发送失败（{cls}），{delay:.0f}s 后重试 chat_id={chat_id} msg_id={msg_id} channels={chs}", event="retry_scheduled")
+            else:
+                failed.update({ch: f"retries exhausted ({cls}): {results[ch][1]}" for ch in chs})
+
+        # 死信按频道拆分：重放时只发给失败的那个频道
+        for ch, err in failed.items():
+            save_dead(chat_id, msg_id, err or "send failed", {**retry.clear(task), "targets": [ch], "image_url": image_url})
+            _log("ERROR", f"❌ 发送失败→死信 chat_id={chat_id} msg_id={msg_id} channel={ch} err={err}")
+
+        # 还要重发且图片没传成功时保留文件，其余情况清理
+        if not (requeued and not image_url):
+            _cleanup_task_media(task)
+
+        # 防风控：频道级间隔由 _pacer 保证；积压 / 低优先级任务按 drain.rate_per_minute 放慢，新消息不受影响
+        interval = 0.2
+        if popped_key in (BACKLOG_KEY, LOW_KEY):
+            interval = drain_interval(max(SEND_INTERVAL, interval))
+        time.sleep(interval)
+
+
+if __name__ == "__main__":
+    main()
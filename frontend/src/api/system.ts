@@ -1,12 +1,57 @@
 import request from "./request";
 
+export interface QuotaStats {
+  limit: number;
+  used: number;
+  publish: number;
+  upload: number;
+  remaining?: number;
+  rate_per_hour: number;
+  projected_total: number;
+  exhaust_at: number | null;
+  by_source: Record<string, number>;
+}
+
 export interface SystemStats {
   queue_length: number;
+  backlog_length: number;
+  low_length: number;
+  upload_length: number;
+  delayed_length: number;
   success_today: number;
   failed_today: number;
   dead_count: number;
+  quota: QuotaStats;
 }
 
 export function fetchSystemStats() {
   return request.get<SystemStats>("/system/stats");
 }
+
+export interface RuleStat {
+  id: string;
+  kind: string;
+  pattern: string;
+  evals: number;
+  hits: number;
+  drops: number;
+  timeouts: number;
+  total_us: number;
+  mean_us: number;
+  max_us: number;
+}
+
+export interface RuleStatsReport {
+  flush_seconds: number;
+  rules: RuleStat[];
+  unused_rules: string[];
+  stale_rules: string[];
+}
+
+export function fetchRuleStats() {
+  return request.get<RuleStatsReport>("/system/rules");
+}
+
+export function resetRuleStats() {
+  return request.post<{ ok: boolean }>("/system/rules/reset");
+}